@@ -48,10 +48,17 @@
 #
 # NB this code has been written to be readable/intelligible, not efficient!
 
+import io
 import os
 import sys
+import bz2
+import gzip
+import lzma
 import math
+import pickle
+import queue
 import random
+import threading
 import time as chrono
 
 # a bunch of system constants (globals)
@@ -61,6 +68,82 @@ bse_sys_maxprice = 500                  # maximum price in the system, in cents/
 # todo: change this, so ticksize no longer global. 
 ticksize = 1  # minimum change in price, in cents/pennies
 
+dump_buffer_size = 1 << 20              # write buffer of dump files, in bytes
+# streaming compression of dump files, the file name gets the extension of the compression
+dump_compressions = {None: ('', None), 'gzip': ('.gz', gzip.open), 'lzma': ('.xz', lzma.open), 'bz2': ('.bz2', bz2.open)}
+checkpoint_version = 1                  # version of the session state pickled by market_session checkpoints
+
+
+# open a text dump file with a large write buffer, optionally compressed
+def open_dump_file(fname, fmode='w', compression=None):
+    ext, open_compressed = dump_compressions[compression]
+    if open_compressed is None:
+        return open(fname, fmode, buffering=dump_buffer_size)
+    binary_file = io.BufferedWriter(open_compressed(fname + ext, fmode[0] + 'b'), buffer_size=dump_buffer_size)
+    return io.TextIOWrapper(binary_file)
+
+
+# formats and writes the dump records of a session in a background thread, so slow writes don't stall the simulation
+# a record is a function with its arguments, put() blocks while the bounded queue is full (back-pressure)
+class DumpWriter:
+
+    def __init__(self, queue_size):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                self.queue.task_done()
+                return
+            # after an error the queue is still drained, so put() never blocks forever
+            if self.error is None:
+                func, args = record
+                try:
+                    func(*args)
+                except BaseException as e:
+                    self.error = e
+            self.queue.task_done()
+
+    def put(self, func, *args):
+        if self.error is not None:
+            # stops the thread and raises the error
+            self.close()
+        self.queue.put((func, args))
+
+    # wait until every record so far is written, the thread keeps running
+    def sync(self):
+        self.queue.join()
+        if self.error is not None:
+            self.close()
+
+    # wait until every record is written
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+# call func now, or hand it to the dump writer if there is one
+def dump_call(dump_writer, func, *args):
+    if dump_writer is None:
+        func(*args)
+    else:
+        dump_writer.put(func, *args)
+
+
+def write_record(dumpfile, format_fn, *args):
+    dumpfile.write(format_fn(*args))
+
+
+# format a record now, or in the dump writer if there is one
+def dump_record(dump_writer, dumpfile, format_fn, *args):
+    dump_call(dump_writer, write_record, dumpfile, format_fn, *args)
+
 
 # an Order/quote has a trader id, a type (buy/sell) price, quantity, timestamp, and unique i.d.
 class Order:
@@ -219,6 +302,7 @@ class Orderbook(Orderbook_half):
         self.tape_length = 10000    # max number of events on tape (so we can do millions of orders without crashing)
         self.quote_id = 0           # unique ID code for each quote accepted onto the book
         self.lob_string = ''        # character-string linearization of public lob items with nonzero quantities
+        self.lob_frame = None       # anonymized bids and asks of the last LOB frame handed to a dump writer
 
 
 # Exchange's internal orderbook
@@ -346,18 +430,17 @@ class Exchange(Orderbook):
             return None
 
     # Currently tape_dump only writes a list of transactions (ignores cancellations)
-    def tape_dump(self, fname, fmode, tmode):
-        with open(fname, fmode) as dumpfile:
+    def tape_dump(self, fname, fmode, tmode, compression=None):
+        with open_dump_file(fname, fmode, compression) as dumpfile:
             # dumpfile.write('type, time, price\n')
-            for tapeitem in self.tape:
-                if tapeitem['type'] == 'Trade':
-                    dumpfile.write('Trd, %010.3f, %s\n' % (tapeitem['time'], tapeitem['price']))
+            dumpfile.writelines(['Trd, %010.3f, %s\n' % (tapeitem['time'], tapeitem['price'])
+                                 for tapeitem in self.tape if tapeitem['type'] == 'Trade'])
         if tmode == 'wipe':
             self.tape = []
 
     # this returns the LOB data "published" by the exchange,
     # i.e., what is accessible to the traders
-    def publish_lob(self, time, lob_file, verbose):
+    def publish_lob(self, time, lob_file, verbose, dump_writer=None):
         public_data = {}
         public_data['time'] = time
         public_data['bids'] = {'best': self.bids.best_price,
@@ -372,28 +455,15 @@ class Exchange(Orderbook):
         public_data['QID'] = self.quote_id
         public_data['tape'] = self.tape
 
-        if lob_file is not None:
-            # build a linear character-string summary of only those prices on LOB with nonzero quantities
-            lobstring ='Bid:,'
-            n_bids = len(self.bids.lob_anon)
-            if n_bids > 0:
-                lobstring += '%d,' % n_bids
-                for lobitem in self.bids.lob_anon:
-                    price_str = '%d,' % lobitem[0]
-                    qty_str = '%d,' % lobitem[1]
-                    lobstring = lobstring + price_str + qty_str
-            else:
-                lobstring += '0,'
-            lobstring += 'Ask:,'
-            n_asks = len(self.asks.lob_anon)
-            if n_asks > 0:
-                lobstring += '%d,' % n_asks
-                for lobitem in self.asks.lob_anon:
-                    price_str = '%d,' % lobitem[0]
-                    qty_str = '%d,' % lobitem[1]
-                    lobstring = lobstring + price_str + qty_str
-            else:
-                lobstring += '0,'
+        if lob_file is not None and dump_writer is not None:
+            # the dump writer builds the string, the anonymized lobs are rebuilt on every change, so they
+            # are compared and handed over as they are: equal lobs give equal strings
+            lobframe = (self.bids.lob_anon, self.asks.lob_anon)
+            if lobframe != self.lob_frame:
+                dump_writer.put(write_record, lob_file, lob_frame_line, time, lobframe[0], lobframe[1])
+                self.lob_frame = lobframe
+        elif lob_file is not None:
+            lobstring = lob_frame_string(self.bids.lob_anon, self.asks.lob_anon)
             # is this different to the last lob_string?
             if lobstring != self.lob_string:
                 # write it
@@ -411,6 +481,35 @@ class Exchange(Orderbook):
         return public_data
 
 
+# build a linear character-string summary of only those prices on LOB with nonzero quantities
+def lob_frame_string(bids_anon, asks_anon):
+    lobstring ='Bid:,'
+    n_bids = len(bids_anon)
+    if n_bids > 0:
+        lobstring += '%d,' % n_bids
+        for lobitem in bids_anon:
+            price_str = '%d,' % lobitem[0]
+            qty_str = '%d,' % lobitem[1]
+            lobstring = lobstring + price_str + qty_str
+    else:
+        lobstring += '0,'
+    lobstring += 'Ask:,'
+    n_asks = len(asks_anon)
+    if n_asks > 0:
+        lobstring += '%d,' % n_asks
+        for lobitem in asks_anon:
+            price_str = '%d,' % lobitem[0]
+            qty_str = '%d,' % lobitem[1]
+            lobstring = lobstring + price_str + qty_str
+    else:
+        lobstring += '0,'
+    return lobstring
+
+
+def lob_frame_line(time, bids_anon, asks_anon):
+    return '%.3f, %s\n' % (time, lob_frame_string(bids_anon, asks_anon))
+
+
 ##################--Traders below here--#############
 
 
@@ -1509,7 +1608,13 @@ class Trader_ZIP(Trader):
 # the number of traders of any one type -- allows either/both to change
 # between successive calls, but that does make it inefficient as it has to
 # re-analyse the entire set of traders on each call
-def trade_stats(expid, traders, dumpfile, time, lob):
+def trade_stats(expid, traders, dumpfile, time, lob, dump_writer=None):
+    dump_record(dump_writer, dumpfile, trade_stats_row, expid, time, lob['bids']['best'], lob['asks']['best'],
+                trade_type_stats(traders))
+
+
+# (trader type, balance sum, number of traders) for each trader type, sorted by type
+def trade_type_stats(traders):
 
     # Analyse the set of traders, to see what types we have
     trader_types = {}
@@ -1523,28 +1628,34 @@ def trade_stats(expid, traders, dumpfile, time, lob):
             n = 1
         trader_types[ttype] = {'n': n, 'balance_sum': t_balance}
 
+    return [(ttype, trader_types[ttype]['balance_sum'], trader_types[ttype]['n'])
+            for ttype in sorted(list(trader_types.keys()))]
+
+
+# one row of trade_stats, formatted in pieces and written at once
+def trade_stats_row(expid, time, best_bid, best_ask, type_stats):
+
     # first two columns of output are the session_id and the time
-    dumpfile.write('%s, %06d, ' % (expid, time))
+    row = ['%s, %06d, ' % (expid, time)]
 
     # second two columns of output are the LOB best bid and best offer (or 'None' if they're undefined)
-    if lob['bids']['best'] is not None:
-        dumpfile.write('%d, ' % (lob['bids']['best']))
+    if best_bid is not None:
+        row.append('%d, ' % best_bid)
     else:
-        dumpfile.write('None, ')
-    if lob['asks']['best'] is not None:
-        dumpfile.write('%d, ' % (lob['asks']['best']))
+        row.append('None, ')
+    if best_ask is not None:
+        row.append('%d, ' % best_ask)
     else:
-        dumpfile.write('None, ')
+        row.append('None, ')
 
     # total remaining number of columns printed depends on number of different trader-types at this timestep
     # for each trader type we print FOUR columns...
     # TraderTypeCode, TotalProfitForThisTraderType, NumberOfTradersOfThisType, AverageProfitPerTraderOfThisType
-    for ttype in sorted(list(trader_types.keys())):
-        n = trader_types[ttype]['n']
-        s = trader_types[ttype]['balance_sum']
-        dumpfile.write('%s, %d, %d, %f, ' % (ttype, s, n, s / float(n)))
+    for ttype, s, n in type_stats:
+        row.append('%s, %d, %d, %f, ' % (ttype, s, n, s / float(n)))
 
-    dumpfile.write('\n')
+    row.append('\n')
+    return ''.join(row)
 
 
 # create a bunch of traders from traders_spec
@@ -1668,6 +1779,7 @@ def populate_market(traders_spec, traders, shuffle, verbose):
 # drip-poisson sequences will be normalised to ensure time of last replenishment <= interval
 # parameter "pending" is the list of future orders (if this is empty, generates a new one from os)
 # revised "pending" is the returned value
+# parameter "rng" generates the issue times and prices of new orders, the global random by default
 #
 # also returns a list of "cancellations": trader-ids for those traders who are now working a new order and hence
 # need to kill quotes already on LOB from working previous order
@@ -1686,7 +1798,7 @@ def populate_market(traders_spec, traders, shuffle, verbose):
 # the interface on this is a bit of a mess... could do with refactoring
 
 
-def customer_orders(time, last_update, traders, trader_stats, os, pending, verbose):
+def customer_orders(time, last_update, traders, trader_stats, os, pending, verbose, rng=random):
 
     def sysmin_check(price):
         if price < bse_sys_minprice:
@@ -1731,14 +1843,14 @@ def customer_orders(time, last_update, traders, trader_stats, os, pending, verbo
         if mode == 'fixed':
             orderprice = pmin + int(i * stepsize)
         elif mode == 'jittered':
-            orderprice = pmin + int(i * stepsize) + random.randint(-halfstep, halfstep)
+            orderprice = pmin + int(i * stepsize) + rng.randint(-halfstep, halfstep)
         elif mode == 'random':
             if len(sched) > 1:
                 # more than one schedule: choose one equiprobably
-                s = random.randint(0, len(sched) - 1)
+                s = rng.randint(0, len(sched) - 1)
                 pmin = sysmin_check(min(sched[s][0], sched[s][1]))
                 pmax = sysmax_check(max(sched[s][0], sched[s][1]))
-            orderprice = random.randint(pmin, pmax)
+            orderprice = rng.randint(pmin, pmax)
         else:
             sys.exit('FAIL: Unknown mode in schedule')
         orderprice = sysmin_check(sysmax_check(orderprice))
@@ -1760,10 +1872,10 @@ def customer_orders(time, last_update, traders, trader_stats, os, pending, verbo
             elif mode == 'drip-fixed':
                 arrtime = t * tstep
             elif mode == 'drip-jitter':
-                arrtime = t * tstep + tstep * random.random()
+                arrtime = t * tstep + tstep * rng.random()
             elif mode == 'drip-poisson':
                 # poisson requires a bit of extra work
-                interarrivaltime = random.expovariate(n_traders / interval)
+                interarrivaltime = rng.expovariate(n_traders / interval)
                 arrtime += interarrivaltime
             else:
                 sys.exit('FAIL: unknown time-mode in getissuetimes()')
@@ -1779,7 +1891,7 @@ def customer_orders(time, last_update, traders, trader_stats, os, pending, verbo
         if shuffle:
             for t in range(n_traders):
                 i = (n_traders - 1) - t
-                j = random.randint(0, i)
+                j = rng.randint(0, i)
                 tmp = issuetimes[i]
                 issuetimes[i] = issuetimes[j]
                 issuetimes[j] = tmp
@@ -1854,14 +1966,173 @@ def customer_orders(time, last_update, traders, trader_stats, os, pending, verbo
     return [new_pending, cancellations]
 
 
-# one session in the market
-def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, avg_bals, dump_all, verbose, dump_dir=None):
+def strats_frame_line(time, trader_strats, best_buyer, best_seller):
+    line_str = ['t=,%.0f, ' % time]
+    for tid, ttype, act_strat, act_prof in trader_strats:
+        line_str.append('id=,%s, %s,' % (tid, ttype))
+        line_str.append('actvstrat=,%f, actvprof=,%f, ' % (act_strat, act_prof))
+    line_str.append('best_B_id=,%s, best_B_prof=,%f, best_B_strat=,%f, ' % best_buyer)
+    line_str.append('best_S_id=,%s, best_S_prof=,%f, best_S_strat=,%f, \n' % best_seller)
+    # no flush here, the buffered file is written when it is full or closed
+    return ''.join(line_str)
+
+
+def blotter_dump(fname, traders, compression):
+    with open_dump_file(fname, 'w', compression) as bdump:
+        for t in traders:
+            bdump.write('%s, %d\n'% (traders[t].tid, len(traders[t].blotter)))
+            bdump.writelines(['%s, %s, %.3f, %d, %s, %s, %d\n'
+                              % (traders[t].tid, b['type'], b['time'], b['price'], b['party1'], b['party2'], b['qty'])
+                              for b in traders[t].blotter])
+
+
+# receives the events of one market session, see market_session(sink=...)
+# every callback does nothing here, so a sink only overrides the events it needs
+# callbacks run in the simulation loop: the arguments must not be modified, and should be copied if kept
+class SessionSink:
+
+    # a trade record of the exchange: type, time, price, party1, party2, qty
+    def on_trade(self, time, trade):
+        pass
+
+    # a quote cancelled because its trader got a new customer order
+    def on_cancel(self, time, order):
+        pass
+
+    # one avg_balance sample, sampled as selected by outputs['avg_balance'], and the end-of-session sample
+    # type_stats is a list of (trader type, balance sum, number of traders) sorted by type
+    def on_stats(self, sess_id, time, best_bid, best_ask, type_stats):
+        pass
+
+    # one frame of PRSH/PRDE strategies, (tid, ttype, active strat, active profit) for each trader
+    # best_buyer and best_seller are (tid, profit, strat)
+    def on_strats_frame(self, time, trader_strats, best_buyer, best_seller):
+        pass
+
+    # the session has ended, the exchange and the traders are in their final state
+    def on_session_end(self, sess_id, time, exchange, traders):
+        pass
+
+    # picklable state saved in a checkpoint of the session, see market_session(checkpoint_file=...)
+    # a sink which keeps state across events returns it here, so a resumed session gets the same results
+    def get_state(self):
+        return None
+
+    # state of get_state() when the session is resumed from a checkpoint
+    def set_state(self, state):
+        pass
+
+
+# the file outputs of a session: avg_balance rows to avg_bals, the outputs selected by outputs into dump_dir
+# with offsets of a checkpoint, the files are reopened and cut back to them, see get_offsets()
+class FileSink(SessionSink):
+
+    def __init__(self, sess_id, dump_dir, avg_bals, outputs, legacy_outputs=False, offsets=None):
+        self.sess_id = sess_id
+        self.dump_dir = dump_dir
+        self.avg_bals = avg_bals
+        self.outputs = outputs
+        self.compression = outputs.get('compression', None)
+
+        # with a queue size, records are formatted and written by a background thread, otherwise inline
+        self.dump_writer = None
+        if outputs.get('writer_queue_size', 0) > 0:
+            self.dump_writer = DumpWriter(outputs['writer_queue_size'])
+
+        # a resumed session writes on from the end of the rows of the checkpoint
+        fmode = 'w' if offsets is None else 'r+'
+
+        self.strat_dump = None
+        if outputs['strats']:
+            strat_dump_file = os.path.join(dump_dir, sess_id + '_strats.csv')
+            self.strat_dump = open_dump_file(strat_dump_file, fmode, self.compression)
+
+        # LOB frames are written by Exchange.publish_lob
+        self.lobframes = None # None disables writing of the LOB frames (which can generate HUGE files)
+        if outputs['lob_frames'] or legacy_outputs:
+            lobframes_dump_file = os.path.join(dump_dir, sess_id + '_LOB_frames.csv')
+            self.lobframes = open_dump_file(lobframes_dump_file, 'w' if legacy_outputs else fmode, self.compression)
+            if legacy_outputs:
+                self.lobframes.close()
+                self.lobframes = None
+
+        if offsets is not None:
+            for f, offset in zip(self.get_files(), offsets):
+                if f is None:
+                    continue
+                if f.seek(0, 2) < offset:
+                    raise ValueError('%s is shorter than at the checkpoint, it must be opened without truncating '
+                                     'it! Offset: %d' % (getattr(f, 'name', f), offset))
+                f.seek(offset)
+                f.truncate()
+
+    # the files written while the session runs, tape and blotters are only written when it ends
+    def get_files(self):
+        return [self.avg_bals, self.strat_dump, self.lobframes]
+
+    # end of the rows written so far in each file of get_files(), after waiting for the dump writer
+    def get_offsets(self):
+        if self.dump_writer is not None:
+            self.dump_writer.sync()
+        offsets = []
+        for f in self.get_files():
+            if f is None:
+                offsets.append(None)
+            else:
+                f.flush()
+                offsets.append(f.tell())
+        return offsets
+
+    def on_stats(self, sess_id, time, best_bid, best_ask, type_stats):
+        if self.avg_bals is not None:
+            dump_record(self.dump_writer, self.avg_bals, trade_stats_row, sess_id, time, best_bid, best_ask, type_stats)
+
+    def on_strats_frame(self, time, trader_strats, best_buyer, best_seller):
+        if self.strat_dump is not None:
+            dump_record(self.dump_writer, self.strat_dump, strats_frame_line, time, trader_strats, best_buyer,
+                        best_seller)
+
+    def on_session_end(self, sess_id, time, exchange, traders):
+        # files written by the dump writer are closed by it, after their last record
+        if self.strat_dump is not None:
+            dump_call(self.dump_writer, self.strat_dump.close)
+
+        if self.lobframes is not None:
+            dump_call(self.dump_writer, self.lobframes.close)
+            self.lobframes = None
+
+        if self.outputs['tape']:
+            # dump the tape (transactions only -- not writing cancellations)
+            tape_dump_file = os.path.join(self.dump_dir, sess_id + '_tape.csv')
+            dump_call(self.dump_writer, exchange.tape_dump, tape_dump_file, 'w', 'keep', self.compression)
+
+        if self.outputs['blotters']:
+            # record the blotter for each trader
+            blotter_dump_file = os.path.join(self.dump_dir, sess_id + '_blotters.csv')
+            dump_call(self.dump_writer, blotter_dump, blotter_dump_file, traders, self.compression)
 
+        # avg_bals belongs to the caller, so every record is written before returning
+        if self.dump_writer is not None:
+            self.dump_writer.close()
 
-    def dump_strats_frame(time, stratfile, trdrs):
+
+# one session in the market
+# the file outputs are one sink of the session, sink is an optional SessionSink of the caller which gets the same events
+# order_rng is an optional random.Random which alone generates the customer orders, so that sessions of different
+# trader mixes with the same order_rng seed get the same customer orders (common random numbers)
+# with checkpoint_file and checkpoint_interval, the whole state of the session is pickled into checkpoint_file every
+# checkpoint_interval simulated seconds: exchange, traders, pending orders, random states and the offsets of the files
+# if checkpoint_file exists when the session starts, the session resumes from it and gives the same outputs as
+# if it had never stopped: avg_bals must then be the same file, opened without truncating it (e.g. mode 'a')
+# the checkpoint is deleted when the session ends, compressed outputs can't be checkpointed
+def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, avg_bals, dump_all, verbose, dump_dir=None,
+                   outputs=None, sink=None, order_rng=None, checkpoint_file=None, checkpoint_interval=None):
+
+
+    def dump_strats_frame(time, trdrs):
         # write one frame of strategy snapshot
 
-        line_str = 't=,%.0f, ' % time
+        trader_strats = []
 
         best_buyer_id = None
         best_buyer_prof = 0
@@ -1875,15 +2146,12 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, avg
 
             # print('PRSH/PRDE recording, t=%s' % trader)
             if trader.ttype == 'PRSH' or trader.ttype == 'PRDE':
-                line_str += 'id=,%s, %s,' % (trader.tid, trader.ttype)
-
                 # line_str += 'bal=$,%f, n_trades=,%d, n_strats=,2, ' % (trader.balance, trader.n_trades)
 
                 act_strat = trader.strats[trader.active_strat]['stratval']
                 act_prof = trader.strats[trader.active_strat]['pps']
 
-                line_str += 'actvstrat=,%f, ' % act_strat
-                line_str += 'actvprof=,%f, ' % act_prof
+                trader_strats.append((trader.tid, trader.ttype, act_strat, act_prof))
 
                 if trader.tid[:1] == 'B':
                     # this trader is a buyer
@@ -1901,22 +2169,32 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, avg
                     # wtf?
                     sys.exit('unknown trader id type in market_session')
 
-        line_str += 'best_B_id=,%s, best_B_prof=,%f, best_B_strat=,%f, ' % \
-                    (best_buyer_id, best_buyer_prof, best_buyer_strat)
-        line_str += 'best_S_id=,%s, best_S_prof=,%f, best_S_strat=,%f, ' % \
-                    (best_seller_id, best_seller_prof, best_seller_strat)
-        line_str += '\n'
-        stratfile.write(line_str)
-        stratfile.flush()
+        for s in sinks:
+            s.on_strats_frame(time, trader_strats, (best_buyer_id, best_buyer_prof, best_buyer_strat),
+                              (best_seller_id, best_seller_prof, best_seller_strat))
 
 
-    def blotter_dump(fname, traders):
-        with open(fname, 'w') as bdump:
-            for t in traders:
-                bdump.write('%s, %d\n'% (traders[t].tid, len(traders[t].blotter)))
-                for b in traders[t].blotter:
-                    bdump.write('%s, %s, %.3f, %d, %s, %s, %d\n'
-                                % (traders[t].tid, b['type'], b['time'], b['price'], b['party1'], b['party2'], b['qty']))
+    def stats_sample(time, lob):
+        # one avg_balance sample for every sink
+        type_stats = trade_type_stats(traders)
+        for s in sinks:
+            s.on_stats(sess_id, time, lob['bids']['best'], lob['asks']['best'], type_stats)
+
+
+    def save_checkpoint():
+        # everything the rest of the session depends on, written to a temp file first so a crash keeps the old one
+        state = {'version': checkpoint_version, 'sess_id': sess_id, 'time': time, 'exchange': exchange,
+                 'traders': traders, 'trader_stats': trader_stats, 'pending_cust_orders': pending_cust_orders,
+                 'frames_done': frames_done, 'n_trades': n_trades, 'next_sample_time': next_sample_time,
+                 'next_checkpoint_time': next_checkpoint_time, 'random_state': random.getstate(),
+                 'order_rng_state': None if order_rng is None else order_rng.getstate(),
+                 'offsets': file_sink.get_offsets(), 'sink_state': None if sink is None else sink_get_state()}
+        temp_file = checkpoint_file + '.tmp'
+        with open(temp_file, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, checkpoint_file)
 
 
     orders_verbose = False
@@ -1933,19 +2211,45 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, avg
     elif not os.path.isdir(dump_dir):
         raise FileExistsError(f"A file with the same name already exists but is not a folder! '{dump_dir}'")
 
-    strat_dump_file = os.path.join(dump_dir, sess_id + '_strats.csv')
-    strat_dump = open(strat_dump_file, 'w')
-
-    lobframes_dump_file = os.path.join(dump_dir, sess_id + '_LOB_frames.csv')
-    lobframes = open(lobframes_dump_file, 'w')
-    lobframes = None # this disables writing of the LOB frames (which can generate HUGE files)
-
-    # initialise the exchange
-    exchange = Exchange()
-
-    # create a bunch of traders
-    traders = {}
-    trader_stats = populate_market(trader_spec, traders, True, populate_verbose)
+    # outputs selects what is written, anything not selected is never opened
+    # None keeps the original behaviour: strats, an empty LOB frames file, tape and blotters
+    legacy_outputs = outputs is None
+    if legacy_outputs:
+        outputs = {'avg_balance': 'trades' if dump_all else 'end',
+                   'strats': True, 'tape': True, 'blotters': True, 'lob_frames': False, 'compression': None,
+                   'writer_queue_size': 0}
+
+    # a sink of the caller only has state in a checkpoint if it implements get_state() and set_state()
+    sink_get_state = getattr(sink, 'get_state', lambda: None)
+    sink_set_state = getattr(sink, 'set_state', lambda state: None)
+
+    checkpoint = None
+    if checkpoint_file is not None:
+        if outputs.get('compression', None) is not None:
+            raise ValueError('Compressed outputs can\'t be checkpointed! Value: %s' % outputs['compression'])
+        if os.path.isfile(checkpoint_file):
+            with open(checkpoint_file, 'rb') as f:
+                checkpoint = pickle.load(f)
+            if checkpoint['version'] != checkpoint_version or checkpoint['sess_id'] != sess_id:
+                raise ValueError('Checkpoint doesn\'t match the session! Value: %s' % checkpoint_file)
+
+    file_sink = FileSink(sess_id, dump_dir, avg_bals, outputs, legacy_outputs,
+                         None if checkpoint is None else checkpoint['offsets'])
+    sinks = [file_sink] if sink is None else [file_sink, sink]
+    lobframes = file_sink.lobframes
+    dump_writer = file_sink.dump_writer
+
+    if checkpoint is None:
+        # initialise the exchange
+        exchange = Exchange()
+
+        # create a bunch of traders
+        traders = {}
+        trader_stats = populate_market(trader_spec, traders, True, populate_verbose)
+    else:
+        exchange = checkpoint['exchange']
+        traders = checkpoint['traders']
+        trader_stats = checkpoint['trader_stats']
 
     # timestep set so that can process all traders in one second
     # NB minimum interarrival time of customer orders may be much less than this!!
@@ -1965,8 +2269,42 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, avg
     # frames_done is record of what frames we have printed data for thus far
     frames_done = set()
 
+    # avg_balance rows while the session runs, sampled from the rows written after every trade:
+    # 'trades' after every n-th trade, 'seconds' after the first trade in every interval of simulated seconds
+    # trade_stats (and its publish_lob) is only called for a sampled row, so the other rows cost nothing
+    avg_balance_mode = outputs['avg_balance']
+    avg_balance_every = outputs.get('avg_balance_interval', None) or 1
+    n_trades = 0
+    next_sample_time = starttime
+
+    # checkpoints are saved at the start of a timestep, the first after checkpoint_interval simulated seconds
+    save_checkpoints = checkpoint_file is not None and checkpoint_interval is not None
+    next_checkpoint_time = starttime + (checkpoint_interval or 0)
+
+    if checkpoint is not None:
+        time = checkpoint['time']
+        pending_cust_orders = checkpoint['pending_cust_orders']
+        frames_done = checkpoint['frames_done']
+        n_trades = checkpoint['n_trades']
+        next_sample_time = checkpoint['next_sample_time']
+        next_checkpoint_time = checkpoint['next_checkpoint_time']
+        random.setstate(checkpoint['random_state'])
+        if order_rng is not None:
+            order_rng.setstate(checkpoint['order_rng_state'])
+        if sink is not None:
+            sink_set_state(checkpoint['sink_state'])
+        checkpoint = None
+
+    # strategy frames are only built if the strats file or the sink of the caller may use them
+    want_strats = file_sink.strat_dump is not None or sink is not None
+
     while time < endtime:
 
+        if save_checkpoints and time >= next_checkpoint_time:
+            next_checkpoint_time = starttime + (math.floor((time - starttime) / checkpoint_interval) + 1) * \
+                checkpoint_interval
+            save_checkpoint()
+
         # how much time left, as a percentage?
         time_left = (endtime - time) / duration
 
@@ -1975,7 +2313,8 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, avg
         trade = None
 
         [pending_cust_orders, kills] = customer_orders(time, last_update, traders, trader_stats,
-                                                       order_schedule, pending_cust_orders, orders_verbose)
+                                                       order_schedule, pending_cust_orders, orders_verbose,
+                                                       random if order_rng is None else order_rng)
 
         # if any newly-issued customer orders mean quotes on the LOB need to be cancelled, kill them
         if len(kills) > 0:
@@ -1985,10 +2324,12 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, avg
                 if traders[kill].lastquote is not None:
                     # if verbose : print('Killing order %s' % (str(traders[kill].lastquote)))
                     exchange.del_order(time, traders[kill].lastquote, verbose)
+                    for s in sinks:
+                        s.on_cancel(time, traders[kill].lastquote)
 
         # get a limit-order quote (or None) from a randomly chosen trader
         tid = list(traders.keys())[random.randint(0, len(traders) - 1)]
-        order = traders[tid].getorder(time, time_left, exchange.publish_lob(time, lobframes, lob_verbose))
+        order = traders[tid].getorder(time, time_left, exchange.publish_lob(time, lobframes, lob_verbose, dump_writer))
 
         # if verbose: print('Trader Quote: %s' % (order))
 
@@ -2005,11 +2346,23 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, avg
                 # so the counterparties update order lists and blotters
                 traders[trade['party1']].bookkeep(trade, order, bookkeep_verbose, time)
                 traders[trade['party2']].bookkeep(trade, order, bookkeep_verbose, time)
-                if dump_all:
-                    trade_stats(sess_id, traders, avg_bals, time, exchange.publish_lob(time, lobframes, lob_verbose))
+                for s in sinks:
+                    s.on_trade(time, trade)
+                if avg_balance_mode == 'trades':
+                    n_trades += 1
+                    sample_trade = n_trades % avg_balance_every == 0
+                elif avg_balance_mode == 'seconds' and time >= next_sample_time:
+                    sample_trade = True
+                    # start of the next interval after this trade
+                    next_sample_time = starttime + (math.floor((time - starttime) / avg_balance_every) + 1) * \
+                        avg_balance_every
+                else:
+                    sample_trade = False
+                if sample_trade:
+                    stats_sample(time, exchange.publish_lob(time, lobframes, lob_verbose, dump_writer))
 
             # traders respond to whatever happened
-            lob = exchange.publish_lob(time, lobframes, lob_verbose)
+            lob = exchange.publish_lob(time, lobframes, lob_verbose, dump_writer)
             for t in traders:
                 # NB respond just updates trader's internal variables
                 # doesn't alter the LOB, so processing each trader in
@@ -2019,9 +2372,9 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, avg
             # log all the PRSH/PRD/etc strategy info for this timestep?
             frame_rate = 60 * 60     # print one frame every this many simulated seconds
 
-            if int(time) % frame_rate == 0 and int(time) not in frames_done:
+            if want_strats and int(time) % frame_rate == 0 and int(time) not in frames_done:
                 # print one more frame to strategy dumpfile
-                dump_strats_frame(time, strat_dump, traders)
+                dump_strats_frame(time, traders)
                 # record that we've written this frame
                 frames_done.add(int(time))
 
@@ -2029,26 +2382,16 @@ def market_session(sess_id, starttime, endtime, trader_spec, order_schedule, avg
 
     # session has ended
 
-    strat_dump.close()
-
-    if lobframes is not None:
-        lobframes.close()
-
-    dump_all = True
-
-    if dump_all:
-
-        # dump the tape (transactions only -- not writing cancellations)
-        tape_dump_file = os.path.join(dump_dir, sess_id + '_tape.csv')
-        exchange.tape_dump(tape_dump_file, 'w', 'keep')
-
-        # record the blotter for each trader
-        blotter_dump_file = os.path.join(dump_dir, sess_id + '_blotters.csv')
-        blotter_dump(blotter_dump_file, traders)
+    # write trade_stats for this session (NB end-of-session summary only), no more LOB frames are written
+    if outputs['avg_balance'] != 'none':
+        stats_sample(time, exchange.publish_lob(time, None, lob_verbose))
 
+    for s in sinks:
+        s.on_session_end(sess_id, time, exchange, traders)
 
-    # write trade_stats for this session (NB end-of-session summary only)
-    trade_stats(sess_id, traders, avg_bals, time, exchange.publish_lob(time, lobframes, lob_verbose))
+    # the session is complete, so it is never resumed
+    if checkpoint_file is not None and os.path.isfile(checkpoint_file):
+        os.remove(checkpoint_file)
 
 
 
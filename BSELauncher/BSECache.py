@@ -0,0 +1,208 @@
+import os
+import json
+import uuid
+import shutil
+import inspect
+import hashlib
+from typing import Optional, TextIO, Dict, List, Tuple
+
+from .utils.files import get_session_output_files, get_compression_extension, SESSION_OUTPUT_SUFFIXES
+
+BSE_RESULT_CACHE_VERSION = 1
+
+_CACHE_META_FILE = "meta.json"
+_CACHE_AVG_BALANCE_FILE = "avg_balance.csv"
+# A full cache is evicted down to this fraction of max_size, so it is not scanned again on every store
+_CACHE_EVICT_FRACTION = 0.9
+
+
+def _canonical_json_default(obj):
+    # Offset functions in 'PriceStrategy' are hashed by their source code
+    if callable(obj):
+        try:
+            source = inspect.getsource(obj)
+        except (OSError, TypeError):
+            source = ""
+        return f"{getattr(obj, '__module__', '')}.{getattr(obj, '__qualname__', repr(obj))}:{source}"
+    raise TypeError(f"Object of type {type(obj).__name__} can't be hashed!")
+
+
+def _get_file_sha256(file_path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _get_dir_size(dir_path: str) -> int:
+    size = 0
+    for root, _, files in os.walk(dir_path):
+        for f_name in files:
+            size += os.path.getsize(os.path.join(root, f_name))
+    return size
+
+
+# Cache directory layout: <cache_dir>/<key[:2]>/<key>/{meta.json, avg_balance.csv, <output name>.csv}
+# Only sessions with a seed can be cached, otherwise the result is not reproducible
+class BSEResultCache:
+
+    def __init__(
+            self,
+            cache_dir: str,
+            max_size: Optional[int] = None,
+            hard_link: bool = False
+    ):
+        self.cache_dir: str = cache_dir
+        # Max total size of the cache in bytes, None means unlimited
+        self.max_size: Optional[int] = max_size
+        # Hard links save disk space, but the outputs must never be modified in place
+        self.hard_link: bool = hard_link
+        self._fingerprints: Dict[str, Tuple[float, str]] = {}
+        # Running total size of the cache, scanned on the first store and after each eviction
+        # NB: between scans it only counts the stores of this process, so with several processes the cache
+        # can exceed max_size by what the others stored until the next scan
+        self._size: Optional[int] = None
+
+    def _get_entry_dir(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get_market_session_fingerprint(self, market_session_func: callable) -> str:
+        try:
+            source_path = inspect.getfile(market_session_func)
+        except TypeError:
+            source_path = None
+        if source_path is None or not os.path.isfile(source_path):
+            return f"{market_session_func.__module__}.{market_session_func.__qualname__}"
+        mtime = os.path.getmtime(source_path)
+        if source_path not in self._fingerprints or self._fingerprints[source_path][0] != mtime:
+            self._fingerprints[source_path] = (mtime, _get_file_sha256(source_path))
+        return self._fingerprints[source_path][1]
+
+    def get_session_key(self, market_session_func: callable, spec_dict: dict, seed: int, session_index: int) -> str:
+        content = json.dumps(
+            {
+                "version": BSE_RESULT_CACHE_VERSION,
+                "bse": self.get_market_session_fingerprint(market_session_func),
+                "market_params": spec_dict,
+                "seed": seed,
+                "session_index": session_index
+            },
+            sort_keys=True,
+            ensure_ascii=False,
+            default=_canonical_json_default
+        )
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def _put_file(self, src: str, dst: str):
+        if self.hard_link:
+            try:
+                os.link(src, dst)
+                return
+            except OSError:
+                pass
+        shutil.copyfile(src, dst)
+
+    # Write the cached outputs of the session with a new session id, return False if there is no such entry
+    def restore(self, key: str, session_id: str, output_dir: str, avg_balance_file: TextIO) -> bool:
+        entry_dir = self._get_entry_dir(key)
+        meta_path = os.path.join(entry_dir, _CACHE_META_FILE)
+        if not os.path.isfile(meta_path):
+            return False
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            with open(os.path.join(entry_dir, _CACHE_AVG_BALANCE_FILE), "r", encoding="utf-8") as f:
+                avg_balance = f.read()
+            for name, f_name in meta["files"].items():
+                ext = get_compression_extension(f_name)
+                dst = os.path.join(output_dir, f"{session_id}{SESSION_OUTPUT_SUFFIXES[name]}{ext}")
+                if os.path.exists(dst):
+                    os.remove(dst)
+                self._put_file(os.path.join(entry_dir, f_name), dst)
+        except (OSError, ValueError, KeyError):
+            # Entry was evicted or broken by another process
+            return False
+        old_prefix = f"{meta['session_id']},"
+        new_prefix = f"{session_id},"
+        avg_balance_file.writelines(
+            new_prefix + line[len(old_prefix):] if line.startswith(old_prefix) else line
+            for line in avg_balance.splitlines(keepends=True)
+        )
+        # Recently used entries are kept longer when evicting
+        os.utime(entry_dir)
+        return True
+
+    def store(self, key: str, session_id: str, output_dir: str, avg_balance: str):
+        entry_dir = self._get_entry_dir(key)
+        if os.path.isdir(entry_dir):
+            return
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        temp_dir = os.path.join(self.cache_dir, f"tmp-{uuid.uuid4().hex}")
+        os.makedirs(temp_dir)
+        entry_size = 0
+        try:
+            files = {}
+            for name, f_path in get_session_output_files(output_dir, session_id).items():
+                if name != "avg_balance":
+                    files[name] = f"{name}.csv{get_compression_extension(f_path)}"
+                    self._put_file(f_path, os.path.join(temp_dir, files[name]))
+            with open(os.path.join(temp_dir, _CACHE_AVG_BALANCE_FILE), "w", encoding="utf-8") as f:
+                f.write(avg_balance)
+            with open(os.path.join(temp_dir, _CACHE_META_FILE), "w", encoding="utf-8") as f:
+                json.dump({"session_id": session_id, "files": files}, f, ensure_ascii=False)
+            size = _get_dir_size(temp_dir)
+            # Another process may have stored the same session at the same time
+            os.rename(temp_dir, entry_dir)
+            entry_size = size
+        except OSError:
+            pass
+        finally:
+            if os.path.isdir(temp_dir):
+                shutil.rmtree(temp_dir, ignore_errors=True)
+        if self.max_size is not None:
+            # The whole cache is only scanned when the running total exceeds max_size
+            if self._size is None:
+                self._size = self.get_size()
+            else:
+                self._size += entry_size
+            if self._size > self.max_size:
+                self.evict(int(self.max_size * _CACHE_EVICT_FRACTION))
+
+    def _list_entries(self) -> List[str]:
+        result = []
+        if not os.path.isdir(self.cache_dir):
+            return result
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if len(prefix) == 2 and os.path.isdir(prefix_dir):
+                result += [os.path.join(prefix_dir, key) for key in os.listdir(prefix_dir)]
+        return result
+
+    def get_size(self) -> int:
+        return sum(_get_dir_size(entry_dir) for entry_dir in self._list_entries())
+
+    # Remove least recently used entries until the cache is not larger than max_size bytes
+    def evict(self, max_size: int):
+        entries = []
+        for entry_dir in self._list_entries():
+            try:
+                entries.append((os.path.getmtime(entry_dir), _get_dir_size(entry_dir), entry_dir))
+            except OSError:
+                pass
+        total_size = sum(i[1] for i in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total_size <= max_size:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+        self._size = total_size
+
+    # Remove one entry, or all entries if key is None
+    def invalidate(self, key: Optional[str] = None):
+        if key is None:
+            for entry_dir in self._list_entries():
+                shutil.rmtree(entry_dir, ignore_errors=True)
+        else:
+            shutil.rmtree(self._get_entry_dir(key), ignore_errors=True)
+        self._size = None
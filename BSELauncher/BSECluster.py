@@ -0,0 +1,325 @@
+import os
+import sys
+import time
+import uuid
+import random
+import socket
+import tempfile
+import threading
+import traceback
+from multiprocessing import Process
+from multiprocessing.managers import BaseManager
+from typing import Optional, List, Dict, Tuple
+
+try:
+    from tqdm import tqdm
+except ModuleNotFoundError:
+    print("Dependency 'tqdm' is required! Please run 'python -m pip install tqdm' to install it!")
+    sys.exit(1)
+
+from .BSETask import BSEMarketTask
+from .BSEInterface import _call_market_session_func
+from .utils.process import get_session_seed, get_session_order_seed
+from .utils.files import get_session_output_files, read_last_avg_balance_row, combine_session_avg_balance_csv_files
+from .utils.files import SESSION_OUTPUT_SUFFIXES, is_avg_balance_file
+
+
+# Shared state of the coordinator, only lives in the manager server process
+# Jobs of workers without a heartbeat for 'heartbeat_timeout' seconds are put back to the queue
+class _WorkQueue:
+
+    def __init__(self, heartbeat_timeout: float, max_retries: int):
+        self._lock = threading.Lock()
+        self._heartbeat_timeout: float = heartbeat_timeout
+        self._max_retries: int = max_retries
+        self._pending: List[dict] = []
+        self._running: Dict[str, Tuple[str, dict]] = {}
+        self._finished: set = set()
+        self._attempts: Dict[str, int] = {}
+        self._heartbeats: Dict[str, float] = {}
+        self._results: List[dict] = []
+        self._closed: bool = False
+
+    def _requeue_expired_jobs(self):
+        now = time.monotonic()
+        dead_workers = {k for k, v in self._heartbeats.items() if now - v > self._heartbeat_timeout}
+        for job_id, (worker_id, job) in list(self._running.items()):
+            if worker_id in dead_workers:
+                del self._running[job_id]
+                self._pending.insert(0, job)
+        for worker_id in dead_workers:
+            del self._heartbeats[worker_id]
+
+    def put_jobs(self, jobs: List[dict]):
+        with self._lock:
+            self._pending += jobs
+
+    def heartbeat(self, worker_id: str):
+        with self._lock:
+            self._heartbeats[worker_id] = time.monotonic()
+
+    def get_job(self, worker_id: str) -> Optional[dict]:
+        with self._lock:
+            self._heartbeats[worker_id] = time.monotonic()
+            self._requeue_expired_jobs()
+            if len(self._pending) == 0:
+                return None
+            job = self._pending.pop(0)
+            self._running[job["job_id"]] = (worker_id, job)
+            return job
+
+    def complete_job(self, worker_id: str, job_id: str, result: dict):
+        with self._lock:
+            self._heartbeats[worker_id] = time.monotonic()
+            # A requeued job may be finished twice, the first result is kept
+            if job_id in self._finished:
+                return
+            self._running.pop(job_id, None)
+            self._pending = [i for i in self._pending if i["job_id"] != job_id]
+            self._finished.add(job_id)
+            self._results.append(result)
+
+    def fail_job(self, worker_id: str, job_id: str, error: str):
+        with self._lock:
+            self._heartbeats[worker_id] = time.monotonic()
+            if job_id in self._finished or job_id not in self._running:
+                return
+            _, job = self._running.pop(job_id)
+            self._attempts[job_id] = self._attempts.get(job_id, 0) + 1
+            if self._attempts[job_id] > self._max_retries:
+                self._finished.add(job_id)
+                self._results.append({"job": job, "error": error})
+            else:
+                self._pending.append(job)
+
+    def pop_results(self) -> List[dict]:
+        with self._lock:
+            self._requeue_expired_jobs()
+            results = self._results
+            self._results = []
+            return results
+
+    def get_worker_size(self) -> int:
+        with self._lock:
+            return len(self._heartbeats)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+
+    def is_closed(self) -> bool:
+        with self._lock:
+            return self._closed
+
+
+_work_queue: Optional[_WorkQueue] = None
+
+
+def _init_work_queue(heartbeat_timeout: float, max_retries: int):
+    global _work_queue
+    _work_queue = _WorkQueue(heartbeat_timeout, max_retries)
+
+
+def _get_work_queue() -> _WorkQueue:
+    return _work_queue
+
+
+class _BSEClusterManager(BaseManager):
+    pass
+
+
+_BSEClusterManager.register("get_work_queue", callable=_get_work_queue)
+
+
+def _connect_work_queue(address: Tuple[str, int], authkey: bytes):
+    manager = _BSEClusterManager(address=address, authkey=authkey)
+    manager.connect()
+    return manager.get_work_queue()
+
+
+def _run_job(market_session_func: callable, job: dict) -> dict:
+    session_id = job["session_id"]
+    with tempfile.TemporaryDirectory(prefix="bse_") as temp_dir:
+        csv_path = os.path.join(temp_dir, f"{session_id}{SESSION_OUTPUT_SUFFIXES['avg_balance']}")
+        session_seed = get_session_seed(job["seed"], job["session_index"])
+        if session_seed is not None:
+            random.seed(session_seed)
+        order_rng = None
+        if job.get("common_orders", False):
+            order_rng = random.Random(get_session_order_seed(job["seed"], job["session_index"]))
+        with open(csv_path, mode="w", encoding="utf-8") as f:
+            _call_market_session_func(
+                market_session_func, session_id, job["spec_dict"], f, temp_dir, order_rng=order_rng
+            )
+        # Keyed by file name, compressed files keep their extension
+        files = {}
+        for f_path in get_session_output_files(temp_dir, session_id).values():
+            with open(f_path, mode="rb") as f:
+                files[os.path.basename(f_path)] = f.read()
+        return {"job": job, "summary": read_last_avg_balance_row(csv_path), "files": files}
+
+
+# Pull session jobs from the coordinator until it is closed
+# Run this on every host with the same BSE.py as the coordinator
+def run_cluster_worker(
+        market_session_func: callable,
+        address: Tuple[str, int],
+        authkey: bytes,
+        heartbeat_interval: float = 5.0,
+        poll_interval: float = 1.0
+):
+    worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    work_queue = _connect_work_queue(address, authkey)
+    stop_event = threading.Event()
+
+    # Proxies open a new connection for each thread, so heartbeats can be sent while the session is running
+    def _heartbeat_loop():
+        while not stop_event.wait(heartbeat_interval):
+            try:
+                work_queue.heartbeat(worker_id)
+            except (OSError, EOFError):
+                return
+
+    heartbeat_thread = threading.Thread(target=_heartbeat_loop, daemon=True)
+    heartbeat_thread.start()
+    try:
+        while True:
+            try:
+                job = work_queue.get_job(worker_id)
+                if job is None:
+                    if work_queue.is_closed():
+                        break
+                    time.sleep(poll_interval)
+                    continue
+            except (OSError, EOFError):
+                # Coordinator has gone
+                break
+            try:
+                result = _run_job(market_session_func, job)
+            except Exception:  # pylint: disable=broad-except
+                work_queue.fail_job(worker_id, job["job_id"], traceback.format_exc())
+            else:
+                work_queue.complete_job(worker_id, job["job_id"], result)
+    finally:
+        stop_event.set()
+
+
+# Start workers on this host, e.g. for testing the cluster on localhost
+def start_local_cluster_workers(
+        market_session_func: callable,
+        address: Tuple[str, int],
+        authkey: bytes,
+        workers: int,
+        heartbeat_interval: float = 5.0
+) -> List[Process]:
+    processes = [
+        Process(
+            target=run_cluster_worker,
+            args=(market_session_func, address, authkey, heartbeat_interval,),
+            daemon=True
+        )
+        for _ in range(workers)
+    ]
+    for p in processes:
+        p.start()
+    return processes
+
+
+def _write_file_atomically(file_path: str, content: bytes):
+    temp_path = f"{file_path}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(temp_path, mode="wb") as f:
+        f.write(content)
+    os.replace(temp_path, file_path)
+
+
+# Serve the sessions of all tasks to cluster workers and write their outputs to each task's output dir
+# 'address' must be reachable by the workers, e.g. ("0.0.0.0", 50000) when workers run on other hosts
+# Return the jobs which still failed after 'max_retries' retries
+def launch_tasks_sessions_on_cluster(
+        market_session_func: Optional[callable],
+        *tasks: BSEMarketTask,
+        authkey: bytes,
+        session_num: int = 1,
+        address: Tuple[str, int] = ("127.0.0.1", 0),
+        seed: Optional[int] = None,
+        combine_avg_balances: bool = True,
+        local_workers: int = 0,
+        heartbeat_interval: float = 5.0,
+        heartbeat_timeout: float = 30.0,
+        max_retries: int = 2,
+        poll_interval: float = 0.5
+) -> List[dict]:
+    if session_num < 1:
+        raise ValueError
+    if local_workers > 0 and market_session_func is None:
+        raise ValueError("Local workers require the 'market_session' function!")
+    jobs = []
+    task_remaining = {}
+    tasks_by_id = {task.task_id: task for task in tasks}
+    for task in tasks:
+        market_params = task._build_market_params()
+        task._prepare_output_dir()
+        session_ids = task._generate_session_ids(session_num)
+        csv_paths = [task._generate_avg_balance_path(session_id) for session_id in session_ids]
+        task._save_task_config(session_num, market_params, session_ids, csv_paths, seed)
+        task._reset_manifest(False)
+        task_remaining[task.task_id] = session_num
+        jobs += [
+            {
+                "job_id": f"{task.task_id}/{session_id}",
+                "task_id": task.task_id,
+                "output_dir": task.output_dir,
+                "session_index": i,
+                "session_id": session_id,
+                "spec_dict": market_params,
+                "seed": seed,
+                "common_orders": task.common_orders
+            }
+            for i, session_id in enumerate(session_ids)
+        ]
+
+    failed_results = []
+    manager = _BSEClusterManager(address=address, authkey=authkey)
+    manager.start(initializer=_init_work_queue, initargs=(heartbeat_timeout, max_retries,))
+    worker_processes = []
+    try:
+        work_queue = manager.get_work_queue()
+        work_queue.put_jobs(jobs)
+        if local_workers > 0:
+            worker_processes = start_local_cluster_workers(
+                market_session_func, manager.address, authkey, local_workers, heartbeat_interval
+            )
+        with tqdm(total=len(jobs)) as pbar:
+            finished = 0
+            while finished < len(jobs):
+                results = work_queue.pop_results()
+                if len(results) == 0:
+                    time.sleep(poll_interval)
+                    continue
+                for result in results:
+                    job = result["job"]
+                    if "error" in result:
+                        print(f"Session '{job['session_id']}' failed:\n{result['error']}", file=sys.stderr)
+                        failed_results.append(result)
+                    else:
+                        # The avg_balance file comes last, so a session is never regarded as finished without
+                        # its other outputs
+                        file_names = sorted(result["files"], key=is_avg_balance_file)
+                        for file_name in file_names:
+                            content = result["files"][file_name]
+                            _write_file_atomically(os.path.join(job["output_dir"], file_name), content)
+                        tasks_by_id[job["task_id"]]._add_session_to_manifest(job["session_index"], job["session_id"])
+                    task_remaining[job["task_id"]] -= 1
+                    if task_remaining[job["task_id"]] == 0 and combine_avg_balances:
+                        combine_session_avg_balance_csv_files(job["output_dir"], job["task_id"])
+                    finished += 1
+                    pbar.update()
+        work_queue.close()
+        for p in worker_processes:
+            p.join()
+    finally:
+        for p in worker_processes:
+            if p.is_alive():
+                p.terminate()
+        manager.shutdown()
+    return failed_results
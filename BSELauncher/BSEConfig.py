@@ -34,6 +34,22 @@ class TimeMode(str, Enum):
     DRIP_POISSON = "drip-poisson"
 
 
+class AvgBalanceMode(str, Enum):
+    # A row after every trade, or every 'avg_balance_interval' trades, and at the end of the session
+    TRADES = "trades"
+    # The row of the first trade in every 'avg_balance_interval' simulated seconds, and at the end of the session
+    SECONDS = "seconds"
+    # Only the end-of-session row
+    END = "end"
+    NONE = "none"
+
+
+class Compression(str, Enum):
+    GZIP = "gzip"
+    LZMA = "lzma"
+    BZ2 = "bz2"
+
+
 class TraderSpec:
     def __init__(
             self,
@@ -150,6 +166,66 @@ class OrderSpec:
         return str(self.build())
 
 
+# Outputs written by a session, outputs which are not selected are never opened
+# 'compression' applies to all outputs written by 'market_session', but not to avg_balance files
+class SessionOutputs:
+    def __init__(
+            self,
+            avg_balance: Union[AvgBalanceMode, str] = AvgBalanceMode.END,
+            strats: bool = False,
+            tape: bool = False,
+            blotters: bool = False,
+            lob_frames: bool = False,
+            compression: Optional[Union[Compression, str]] = None,
+            writer_queue_size: int = 0,
+            avg_balance_interval: Optional[Union[int, float]] = None
+    ):
+        self.avg_balance: Union[AvgBalanceMode, str] = avg_balance
+        self.strats: bool = strats
+        self.tape: bool = tape
+        self.blotters: bool = blotters
+        self.lob_frames: bool = lob_frames
+        self.compression: Optional[Union[Compression, str]] = compression
+        # > 0: records are written by a background thread of the session through a queue of this size
+        self.writer_queue_size: int = writer_queue_size
+        # Trades for 'AvgBalanceMode.TRADES' (default 1), simulated seconds for 'AvgBalanceMode.SECONDS' (required)
+        self.avg_balance_interval: Optional[Union[int, float]] = avg_balance_interval
+
+    def build(self) -> Dict[str, Union[str, bool, int, None]]:
+        if isinstance(self.avg_balance, AvgBalanceMode):
+            avg_balance = self.avg_balance.value
+        else:
+            avg_balance = str(self.avg_balance)
+        assert avg_balance in [i.value for i in AvgBalanceMode], f"Avg balance mode error! Value: {avg_balance}"
+        if avg_balance == AvgBalanceMode.TRADES.value:
+            assert self.avg_balance_interval is None or \
+                (isinstance(self.avg_balance_interval, int) and self.avg_balance_interval >= 1), \
+                f"Avg balance interval error! Value: {self.avg_balance_interval}"
+        elif avg_balance == AvgBalanceMode.SECONDS.value:
+            assert self.avg_balance_interval is not None and self.avg_balance_interval > 0, \
+                f"Avg balance interval error! Value: {self.avg_balance_interval}"
+        if isinstance(self.compression, Compression):
+            compression = self.compression.value
+        else:
+            compression = None if self.compression is None else str(self.compression)
+        assert compression is None or compression in [i.value for i in Compression], \
+            f"Compression error! Value: {compression}"
+        assert self.writer_queue_size >= 0, f"Writer queue size error! Value: {self.writer_queue_size}"
+        return {
+            "avg_balance": avg_balance,
+            "strats": self.strats,
+            "tape": self.tape,
+            "blotters": self.blotters,
+            "lob_frames": self.lob_frames,
+            "compression": compression,
+            "writer_queue_size": self.writer_queue_size,
+            "avg_balance_interval": self.avg_balance_interval
+        }
+
+    def __repr__(self) -> str:
+        return str(self.build())
+
+
 class MarketSessionSpec:
     def __init__(
             self,
@@ -158,7 +234,8 @@ class MarketSessionSpec:
             buyers: List[TraderSpec],
             orders_spec: OrderSpec,
             dump_all: bool = True,
-            verbose: bool = False
+            verbose: bool = False,
+            outputs: Optional[SessionOutputs] = None
     ):
         # start_time, end_time
         self.session_time: Tuple[int, int] = session_time
@@ -170,6 +247,8 @@ class MarketSessionSpec:
         # dump
         self.dump_all: bool = dump_all
         self.verbose: bool = verbose
+        # None keeps the outputs of 'market_session' as they are, 'dump_all' is ignored otherwise
+        self.outputs: Optional[SessionOutputs] = outputs
 
     def set_sellers_and_buyers(self, traders: List[TraderSpec]):
         self.sellers = traders
@@ -183,7 +262,7 @@ class MarketSessionSpec:
 
     def build(self) -> Dict[str, Union[int, dict, bool]]:
         assert self.session_time[1] >= self.session_time[0] >= 0, f"Market session time error! Value: {self.session_time}"
-        return {
+        result = {
             "starttime": self.session_time[0],
             "endtime": self.session_time[1],
             "trader_spec": self._build_traders_spec(),
@@ -191,6 +270,9 @@ class MarketSessionSpec:
             "dump_all": self.dump_all,
             "verbose": self.verbose
         }
+        if self.outputs is not None:
+            result["outputs"] = self.outputs.build()
+        return result
 
     def __repr__(self) -> str:
         return str(self.build())
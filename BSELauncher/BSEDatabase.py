@@ -0,0 +1,251 @@
+import os
+import sqlite3
+from typing import Optional, List, Dict, Tuple, Iterable
+
+from .utils.files import get_session_output_files, parse_avg_balance_line, open_output_file
+
+BSE_RESULT_DATABASE_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    task_id TEXT NOT NULL,
+    session_index INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS avg_balances (
+    session_id TEXT NOT NULL,
+    time INTEGER NOT NULL,
+    best_bid INTEGER,
+    best_ask INTEGER,
+    trader_type TEXT NOT NULL,
+    balance_sum INTEGER NOT NULL,
+    n INTEGER NOT NULL,
+    avg_balance REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS strats (
+    session_id TEXT NOT NULL,
+    time REAL NOT NULL,
+    trader_id TEXT NOT NULL,
+    trader_type TEXT NOT NULL,
+    active_strat REAL NOT NULL,
+    active_profit REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tape (
+    session_id TEXT NOT NULL,
+    time REAL NOT NULL,
+    price INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blotters (
+    session_id TEXT NOT NULL,
+    trader_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    time REAL NOT NULL,
+    price INTEGER NOT NULL,
+    party1 TEXT NOT NULL,
+    party2 TEXT NOT NULL,
+    qty INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_task_id ON sessions (task_id, session_index);
+CREATE INDEX IF NOT EXISTS avg_balances_session_id ON avg_balances (session_id, time);
+CREATE INDEX IF NOT EXISTS strats_session_id ON strats (session_id, time);
+CREATE INDEX IF NOT EXISTS tape_session_id ON tape (session_id, time);
+CREATE INDEX IF NOT EXISTS blotters_session_id ON blotters (session_id, trader_id);
+"""
+
+_SESSION_TABLES = ("avg_balances", "strats", "tape", "blotters")
+
+
+def _read_lines(file_path: Optional[str]) -> List[str]:
+    if file_path is None:
+        return []
+    with open_output_file(file_path) as f:
+        return [line for line in f if line.endswith("\n")]
+
+
+def _parse_avg_balance_rows(session_id: str, lines: Iterable[str]) -> List[tuple]:
+    result = []
+    for line in lines:
+        row = parse_avg_balance_line(line)
+        if row is None:
+            continue
+        for trader_type, stats in row["traders"].items():
+            result.append((
+                session_id, row["time"], row["best_bid"], row["best_ask"], trader_type,
+                stats["balance_sum"], stats["n"], stats["avg_balance"]
+            ))
+    return result
+
+
+# One frame of 'dump_strats_frame': t=,<time>, then id=,<tid>, <type>,actvstrat=,<strat>, actvprof=,<profit>, per trader
+def _parse_strats_rows(session_id: str, lines: Iterable[str]) -> List[tuple]:
+    result = []
+    for line in lines:
+        cols = [i.strip() for i in line.split(",")]
+        if len(cols) < 2 or cols[0] != "t=":
+            continue
+        time = float(cols[1])
+        for i, col in enumerate(cols):
+            if col == "id=" and i + 7 < len(cols) and cols[i + 3] == "actvstrat=" and cols[i + 5] == "actvprof=":
+                result.append((session_id, time, cols[i + 1], cols[i + 2], float(cols[i + 4]), float(cols[i + 6])))
+    return result
+
+
+def _parse_tape_rows(session_id: str, lines: Iterable[str]) -> List[tuple]:
+    result = []
+    for line in lines:
+        cols = [i.strip() for i in line.split(",")]
+        if len(cols) == 3 and cols[0] == "Trd":
+            result.append((session_id, float(cols[1]), int(cols[2])))
+    return result
+
+
+# Rows of a trader follow a '<tid>, <amount>' line
+def _parse_blotters_rows(session_id: str, lines: Iterable[str]) -> List[tuple]:
+    result = []
+    for line in lines:
+        cols = [i.strip() for i in line.split(",")]
+        if len(cols) == 7:
+            result.append((
+                session_id, cols[0], cols[1], float(cols[2]), int(cols[3]), cols[4], cols[5], int(cols[6])
+            ))
+    return result
+
+
+# Results of sessions in one SQLite database, e.g. one per task or one per sweep
+# Only the process which created it writes, sessions are inserted in batches of 'batch_sessions' in WAL mode,
+# so the database can be queried by other processes while sessions are added
+class BSEResultDatabase:
+
+    def __init__(self, db_path: str, batch_sessions: int = 32):
+        self.db_path: str = db_path
+        self.batch_sessions: int = batch_sessions
+        db_dir = os.path.dirname(db_path)
+        if db_dir != "" and not os.path.isdir(db_dir):
+            os.makedirs(db_dir)
+        self._conn: sqlite3.Connection = sqlite3.connect(db_path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._conn.execute(
+            "INSERT OR IGNORE INTO meta (key, value) VALUES ('version', ?)", (str(BSE_RESULT_DATABASE_VERSION),)
+        )
+        self._conn.commit()
+        self._pending: Dict[str, List[tuple]] = {}
+        self._pending_sessions: List[tuple] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    # Parse the output files of a finished session, they are written on the next flush
+    def add_session(self, task_id: str, session_id: str, session_index: int, output_dir: str):
+        output_files = get_session_output_files(output_dir, session_id)
+        self._pending_sessions.append((session_id, task_id, session_index))
+        for table, output_name, parse_func in (
+                ("avg_balances", "avg_balance", _parse_avg_balance_rows),
+                ("strats", "strats", _parse_strats_rows),
+                ("tape", "tape", _parse_tape_rows),
+                ("blotters", "blotters", _parse_blotters_rows)
+        ):
+            rows = parse_func(session_id, _read_lines(output_files.get(output_name, None)))
+            self._pending.setdefault(table, []).extend(rows)
+        if len(self._pending_sessions) >= self.batch_sessions:
+            self.flush()
+
+    def flush(self):
+        if len(self._pending_sessions) == 0:
+            return
+        with self._conn:
+            # A session added again, e.g. after resuming, replaces its old rows
+            session_ids = [(i[0],) for i in self._pending_sessions]
+            for table in _SESSION_TABLES:
+                self._conn.executemany(f"DELETE FROM {table} WHERE session_id = ?", session_ids)
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO sessions (session_id, task_id, session_index) VALUES (?, ?, ?)",
+                self._pending_sessions
+            )
+            for table, rows in self._pending.items():
+                if len(rows) > 0:
+                    placeholders = ", ".join(["?"] * len(rows[0]))
+                    self._conn.executemany(f"INSERT INTO {table} VALUES ({placeholders})", rows)
+        self._pending = {}
+        self._pending_sessions = []
+
+    def close(self):
+        if self._conn is not None:
+            self.flush()
+            self._conn.close()
+            self._conn = None
+
+    def _query(self, sql: str, params: tuple = ()) -> List[sqlite3.Row]:
+        self.flush()
+        self._conn.row_factory = sqlite3.Row
+        try:
+            return self._conn.execute(sql, params).fetchall()
+        finally:
+            self._conn.row_factory = None
+
+    def get_task_ids(self) -> List[str]:
+        return [row["task_id"] for row in self._query("SELECT DISTINCT task_id FROM sessions ORDER BY task_id")]
+
+    # (session_id, session_index) in order, like 'get_session_avg_balance_csv_files'
+    def get_sessions(self, task_id: str) -> List[Tuple[str, int]]:
+        rows = self._query(
+            "SELECT session_id, session_index FROM sessions WHERE task_id = ? ORDER BY session_index", (task_id,)
+        )
+        return [(row["session_id"], row["session_index"]) for row in rows]
+
+    # Rows of a session as dicts in the format of 'parse_avg_balance_line'
+    # With 'end_only', only the end-of-session summary row
+    def get_avg_balances(self, session_id: str, end_only: bool = False) -> List[dict]:
+        sql = "SELECT * FROM avg_balances WHERE session_id = ?"
+        if end_only:
+            sql += " AND time = (SELECT MAX(time) FROM avg_balances WHERE session_id = ?)"
+        rows = self._query(sql + " ORDER BY rowid", (session_id, session_id) if end_only else (session_id,))
+        result = []
+        for row in rows:
+            if len(result) == 0 or result[-1]["time"] != row["time"] or row["trader_type"] in result[-1]["traders"]:
+                result.append({
+                    "session_id": row["session_id"],
+                    "time": row["time"],
+                    "best_bid": row["best_bid"],
+                    "best_ask": row["best_ask"],
+                    "traders": {}
+                })
+            result[-1]["traders"][row["trader_type"]] = {
+                "balance_sum": row["balance_sum"],
+                "n": row["n"],
+                "avg_balance": row["avg_balance"]
+            }
+        return result
+
+    # Average of the end-of-session average balance of each trader type over all sessions of a task
+    def get_task_avg_balances(self, task_id: str) -> Dict[str, float]:
+        rows = self._query(
+            "SELECT a.trader_type, AVG(a.avg_balance) AS avg_balance FROM avg_balances a "
+            "JOIN sessions s ON a.session_id = s.session_id "
+            "WHERE s.task_id = ? AND a.time = (SELECT MAX(time) FROM avg_balances WHERE session_id = a.session_id) "
+            "GROUP BY a.trader_type",
+            (task_id,)
+        )
+        return {row["trader_type"]: row["avg_balance"] for row in rows}
+
+    def get_strategy_frames(self, session_id: str) -> List[dict]:
+        rows = self._query("SELECT * FROM strats WHERE session_id = ? ORDER BY rowid", (session_id,))
+        return [dict(row) for row in rows]
+
+    def get_tape(self, session_id: str) -> List[Tuple[float, int]]:
+        rows = self._query("SELECT time, price FROM tape WHERE session_id = ? ORDER BY rowid", (session_id,))
+        return [(row["time"], row["price"]) for row in rows]
+
+    def get_blotters(self, session_id: str, trader_id: Optional[str] = None) -> List[dict]:
+        if trader_id is None:
+            rows = self._query("SELECT * FROM blotters WHERE session_id = ? ORDER BY rowid", (session_id,))
+        else:
+            rows = self._query(
+                "SELECT * FROM blotters WHERE session_id = ? AND trader_id = ? ORDER BY rowid", (session_id, trader_id)
+            )
+        return [dict(row) for row in rows]
@@ -0,0 +1,16 @@
+from typing import Optional
+
+
+# A session which did not finish
+# Sessions of a failed task which never ran have 0 attempts and no error
+class BSESessionFailure:
+    def __init__(self, task_id: str, session_id: str, session_index: int, attempts: int, error: Optional[str]):
+        self.task_id: str = task_id
+        self.session_id: str = session_id
+        self.session_index: int = session_index
+        self.attempts: int = attempts
+        # Formatted traceback of the last attempt
+        self.error: Optional[str] = error
+
+    def __repr__(self) -> str:
+        return f"BSESessionFailure({self.session_id}, attempts={self.attempts})"
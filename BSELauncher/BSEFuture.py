@@ -0,0 +1,205 @@
+import os
+import asyncio
+import threading
+import functools
+from concurrent.futures import Future, Executor, ProcessPoolExecutor
+from typing import Optional, List, Dict
+
+from .BSETask import BSEMarketTask
+from .utils.process import get_default_worker_size
+from .utils.files import get_session_output_files, read_last_avg_balance_row, AvgBalanceCombiner
+
+
+class BSESessionResult:
+    def __init__(
+            self,
+            task_id: str,
+            session_id: str,
+            session_index: int,
+            output_files: Dict[str, str],
+            summary: Optional[dict]
+    ):
+        self.task_id: str = task_id
+        self.session_id: str = session_id
+        self.session_index: int = session_index
+        # Output file paths keyed by the names in 'SESSION_OUTPUT_SUFFIXES'
+        self.output_files: Dict[str, str] = output_files
+        # Parsed end-of-session 'trade_stats' row
+        self.summary: Optional[dict] = summary
+
+    def __repr__(self) -> str:
+        return f"BSESessionResult({self.session_id}, {self.summary})"
+
+
+class BSETaskResult:
+    def __init__(
+            self,
+            task_id: str,
+            output_dir: Optional[str],
+            sessions: List[BSESessionResult],
+            avg_balance_file: Optional[str] = None
+    ):
+        self.task_id: str = task_id
+        self.output_dir: Optional[str] = output_dir
+        self.sessions: List[BSESessionResult] = sessions
+        # Combined avg_balance file of all sessions
+        self.avg_balance_file: Optional[str] = avg_balance_file
+
+    def __repr__(self) -> str:
+        return f"BSETaskResult({self.task_id}, sessions={len(self.sessions)})"
+
+
+# Cancelling a task future also cancels all of its sessions which have not started yet
+class BSETaskFuture(Future):
+    def __init__(self, task_id: str, session_futures: List[Future]):
+        super().__init__()
+        self.task_id: str = task_id
+        self.session_futures: List[Future] = session_futures
+
+    def cancel(self) -> bool:
+        for session_future in self.session_futures:
+            session_future.cancel()
+        return super().cancel()
+
+
+# Run in the worker process, so reading the summary overlaps with other sessions
+def _run_session(
+        task: BSEMarketTask,
+        market_session_func: callable,
+        session_index: int,
+        session_id: str,
+        spec_dict: dict,
+        csv_path: str,
+        seed: Optional[int] = None
+) -> BSESessionResult:
+    task._launch_in_parallel(market_session_func, session_index, session_id, spec_dict, csv_path, seed)
+    return BSESessionResult(
+        task_id=task.task_id,
+        session_id=session_id,
+        session_index=session_index,
+        output_files=get_session_output_files(task.output_dir, session_id),
+        summary=read_last_avg_balance_row(csv_path)
+    )
+
+
+class BSEFutureLauncher:
+
+    def __init__(
+            self,
+            market_session_func: callable,
+            workers: Optional[int] = None,
+            executor: Optional[Executor] = None
+    ):
+        self.market_session_func: callable = market_session_func
+        if executor is None:
+            self._executor: Executor = ProcessPoolExecutor(max_workers=get_default_worker_size(os.cpu_count(), workers))
+            self._own_executor: bool = True
+        else:
+            self._executor: Executor = executor
+            self._own_executor: bool = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(wait=exc_type is None, cancel_futures=exc_type is not None)
+
+    def shutdown(self, wait: bool = True, cancel_futures: bool = False):
+        if self._own_executor:
+            self._executor.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+    # Like 'BSEMarketTask.launch_in_pool', every session is submitted separately
+    def submit_task(
+            self,
+            task: BSEMarketTask,
+            session_num: int = 1,
+            combine_avg_balances: bool = True,
+            seed: Optional[int] = None
+    ) -> BSETaskFuture:
+        if session_num <= 0:
+            raise ValueError("n <= 0")
+        market_params = task._build_market_params()
+        task._prepare_output_dir()
+        session_ids = task._generate_session_ids(session_num)
+        csv_paths = [task._generate_avg_balance_path(session_id) for session_id in session_ids]
+        task._save_task_config(session_num, market_params, session_ids, csv_paths, seed)
+        task._reset_manifest(False)
+        session_futures = [
+            self._executor.submit(
+                _run_session, task, self.market_session_func, i, session_id, market_params, csv_path, seed
+            )
+            for i, (session_id, csv_path) in enumerate(zip(session_ids, csv_paths))
+        ]
+        task_future = BSETaskFuture(task.task_id, session_futures)
+        combiner = AvgBalanceCombiner(task.output_dir, task.task_id, csv_paths) if combine_avg_balances else None
+        lock = threading.Lock()
+        remaining = session_num
+
+        # Done callbacks run in the management thread of the executor, so each one only appends its own session
+        # to the combined file, failed and cancelled sessions are skipped
+        def _session_done_handler(csv_path: str, session_future: Future):
+            nonlocal remaining
+            with lock:
+                if combiner is not None:
+                    if session_future.cancelled() or session_future.exception() is not None:
+                        combiner.skip(csv_path)
+                    else:
+                        combiner.finish(csv_path)
+                remaining -= 1
+                if remaining > 0:
+                    return
+            if any(f.cancelled() for f in session_futures):
+                Future.cancel(task_future)
+                return
+            if not task_future.set_running_or_notify_cancel():
+                return
+            try:
+                sessions = [f.result() for f in session_futures]
+                avg_balance_file = None if combiner is None else combiner.close()
+                task_future.set_result(BSETaskResult(task.task_id, task.output_dir, sessions, avg_balance_file))
+            except BaseException as e:
+                task_future.set_exception(e)
+
+        def _add_session_to_manifest(session_future: Future):
+            if not session_future.cancelled() and session_future.exception() is None:
+                session_result = session_future.result()
+                task._add_session_to_manifest(session_result.session_index, session_result.session_id)
+
+        for session_future, csv_path in zip(session_futures, csv_paths):
+            session_future.add_done_callback(_add_session_to_manifest)
+            session_future.add_done_callback(functools.partial(_session_done_handler, csv_path))
+        return task_future
+
+    def submit_tasks(
+            self,
+            *tasks: BSEMarketTask,
+            session_num: int = 1,
+            combine_avg_balances: bool = True,
+            seed: Optional[int] = None
+    ) -> List[BSETaskFuture]:
+        return [self.submit_task(task, session_num, combine_avg_balances, seed) for task in tasks]
+
+
+# Awaitable version of 'launch_tasks_sessions_in_parallel', which never blocks the event loop
+async def launch_tasks_sessions_async(
+        market_session_func: callable,
+        *tasks: BSEMarketTask,
+        session_num: int = 1,
+        combine_avg_balances: bool = True,
+        workers: Optional[int] = None,
+        seed: Optional[int] = None
+) -> List[BSETaskResult]:
+    if session_num < 1:
+        raise ValueError
+    workers = get_default_worker_size(len(tasks) * session_num, workers)
+    launcher = BSEFutureLauncher(market_session_func, workers)
+    try:
+        task_futures = launcher.submit_tasks(
+            *tasks,
+            session_num=session_num,
+            combine_avg_balances=combine_avg_balances,
+            seed=seed
+        )
+        return list(await asyncio.gather(*[asyncio.wrap_future(f) for f in task_futures]))
+    finally:
+        launcher.shutdown(wait=False, cancel_futures=True)
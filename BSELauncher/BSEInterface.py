@@ -1,12 +1,27 @@
+import random
 import inspect
 from typing import Optional, TextIO
 from .BSEConfig import MarketSessionSpec
 
 
-def _check_market_session_func(market_session_func: callable):
+def _check_market_session_func(
+        market_session_func: callable,
+        spec_dict: Optional[dict] = None,
+        sink=None,
+        order_rng: Optional[random.Random] = None,
+        checkpoint_file: Optional[str] = None
+):
     spec = inspect.getfullargspec(market_session_func)
     if "dump_dir" not in spec.args:
         raise TypeError("The 'market_session' function expects a parameter named 'dump_dir'!")
+    if spec_dict is not None and "outputs" in spec_dict and "outputs" not in spec.args:
+        raise TypeError("The 'market_session' function expects a parameter named 'outputs'!")
+    if sink is not None and "sink" not in spec.args:
+        raise TypeError("The 'market_session' function expects a parameter named 'sink'!")
+    if order_rng is not None and "order_rng" not in spec.args:
+        raise TypeError("The 'market_session' function expects a parameter named 'order_rng'!")
+    if checkpoint_file is not None and "checkpoint_file" not in spec.args:
+        raise TypeError("The 'market_session' function expects a parameter named 'checkpoint_file'!")
 
 
 def _call_market_session_func(
@@ -14,30 +29,56 @@ def _call_market_session_func(
         session_id: str,
         spec_dict: dict,
         avg_balance_file: TextIO,
-        output_dir: Optional[str] = None
+        output_dir: Optional[str] = None,
+        sink=None,
+        order_rng: Optional[random.Random] = None,
+        checkpoint_file: Optional[str] = None,
+        checkpoint_interval: Optional[float] = None
 ):
-    _check_market_session_func(market_session_func)
+    _check_market_session_func(market_session_func, spec_dict, sink, order_rng, checkpoint_file)
+    # Only passed if given, so functions without a 'sink', 'order_rng' or checkpoint parameters keep working
+    extra_kwargs = {}
+    if sink is not None:
+        extra_kwargs["sink"] = sink
+    if order_rng is not None:
+        extra_kwargs["order_rng"] = order_rng
+    if checkpoint_file is not None:
+        extra_kwargs["checkpoint_file"] = checkpoint_file
+        extra_kwargs["checkpoint_interval"] = checkpoint_interval
     market_session_func(
         sess_id=session_id,
         avg_bals=avg_balance_file,
         dump_dir=output_dir,
-        **spec_dict
+        **spec_dict,
+        **extra_kwargs
     )
 
 
 # Simple spec wrapper
 # Not recommended if there is no special need
+# 'sink' receives the events of the session in this process, e.g. a 'SessionSink' of BSE.py
+# 'order_rng' alone generates the customer orders, see 'common_orders' of 'BSEMarketTask'
+# With 'checkpoint_file', the session is checkpointed every 'checkpoint_interval' simulated seconds and resumes from it
+# if it exists, 'avg_balance_file' must then be opened without truncating it, e.g. with mode "a"
 def launch_market_session(
         market_session_func: callable,
         session_id: str,
         spec: MarketSessionSpec,
-        avg_balance_file: TextIO,
-        output_dir: Optional[str] = None
+        avg_balance_file: Optional[TextIO],
+        output_dir: Optional[str] = None,
+        sink=None,
+        order_rng: Optional[random.Random] = None,
+        checkpoint_file: Optional[str] = None,
+        checkpoint_interval: Optional[float] = None
 ):
     _call_market_session_func(
         market_session_func=market_session_func,
         session_id=session_id,
         spec_dict=spec.build(),
         avg_balance_file=avg_balance_file,
-        output_dir=output_dir
+        output_dir=output_dir,
+        sink=sink,
+        order_rng=order_rng,
+        checkpoint_file=checkpoint_file,
+        checkpoint_interval=checkpoint_interval
     )
@@ -1,5 +1,7 @@
 import sys
-from typing import Optional
+import functools
+import traceback
+from typing import Optional, Tuple, List, Dict
 from multiprocessing import Pool
 
 try:
@@ -9,64 +11,220 @@ except ModuleNotFoundError:
     sys.exit(1)
 
 from .BSETask import BSEMarketTask
+from .BSEShard import get_session_cost, select_shard
+from .BSEScheduler import BSESessionScheduler
+from .BSEFailure import BSESessionFailure
+from .BSEDatabase import BSEResultDatabase
+from .BSEStats import BSESessionStats, BSEStatsCollector, BSEStopRule
 from .utils.process import raise_process_error, get_default_worker_size
+from .utils.affinity import get_worker_cpus, assign_worker_cpus, create_cpu_slots, pin_worker_to_cpu
+
+
+def _get_worker_size(
+        min_size: int,
+        workers: Optional[int],
+        cpu_affinity: bool,
+        physical_cores_only: bool
+) -> Tuple[int, Optional[List[int]]]:
+    if not cpu_affinity:
+        return get_default_worker_size(min_size, workers), None
+    workers = get_default_worker_size(min_size, workers, len(get_worker_cpus(physical_cores_only)))
+    return workers, assign_worker_cpus(workers, physical_cores_only)
+
+
+# Failed attempts resume the task, so the sessions which already finished are kept
+# Sessions run in order, so the first unfinished session after a failed attempt is the one which failed
+# Return the stats of the task and the sessions which still did not finish, the ones after the failed session
+# never ran and have 0 attempts
+# NB: an error after all sessions finished, e.g. while appending avg_balance columns, is raised
+def _launch_task_with_retries(
+        task: BSEMarketTask,
+        market_session_func: callable,
+        session_num: int,
+        seed: Optional[int],
+        resume: bool,
+        session_stats: bool,
+        retries: int
+) -> Tuple[Optional[BSESessionStats], List[BSESessionFailure]]:
+    attempts: Dict[str, int] = {}
+    error = None
+    unfinished_sessions = []
+    for attempt in range(retries + 1):
+        try:
+            task_stats = task.launch(
+                market_session_func, session_num, seed, resume=resume or attempt > 0, session_stats=session_stats
+            )
+            return task_stats, []
+        except Exception as ex:  # pylint: disable=broad-except
+            unfinished_sessions = task._get_unfinished_sessions(session_num)
+            if len(unfinished_sessions) == 0:
+                if attempt == retries:
+                    raise
+                continue
+            session_id = unfinished_sessions[0][1]
+            attempts[session_id] = attempts.get(session_id, 0) + 1
+            error = "".join(traceback.format_exception(ex))
+    session_index, session_id = unfinished_sessions[0]
+    failures = [BSESessionFailure(task.task_id, session_id, session_index, attempts[session_id], error)]
+    for session_index, session_id in unfinished_sessions[1:]:
+        failures.append(BSESessionFailure(task.task_id, session_id, session_index, 0, None))
+    return None, failures
+
+
+def _print_failures(failures: List[BSESessionFailure]):
+    for failure in failures:
+        if failure.error is None:
+            print(f"Session '{failure.session_id}' did not run", file=sys.stderr)
+        else:
+            print(
+                f"Session '{failure.session_id}' failed after {failure.attempts} attempts:\n{failure.error}",
+                file=sys.stderr
+            )
 
 
 # Create a process for each task and run it in parallel
+# With 'shard=(i, n)', only the i-th of n cost-balanced parts of the tasks is run
+# With 'cpu_affinity', each worker is pinned to its own CPU (Linux only), NUMA nodes are filled one by one
+# With 'physical_cores_only', SMT siblings are skipped
+# With 'stats', the stats of the sessions are computed in the workers and merged into it by task, see 'BSESessionStats'
+# A failed task is resumed up to 'retries' times, return the sessions which still did not finish,
+# see '_launch_task_with_retries'
+# 'maxtasksperchild' recycles workers after the given amount of tasks
+# NB: a worker which crashes hard is not detected, use 'launch_tasks_sessions_in_parallel' for that
 # Note: Running multiple processes does not produce any output on the console
 def launch_tasks_in_parallel(
         market_session_func: callable,
         *tasks: BSEMarketTask,
         session_num: int = 1,
         seed: Optional[int] = None,
-        workers: Optional[int] = None
-):
+        workers: Optional[int] = None,
+        resume: bool = False,
+        shard: Optional[Tuple[int, int]] = None,
+        cpu_affinity: bool = False,
+        physical_cores_only: bool = False,
+        stats: Optional[BSEStatsCollector] = None,
+        retries: int = 0,
+        maxtasksperchild: Optional[int] = None
+) -> List[BSESessionFailure]:
     if session_num < 1:
         raise ValueError
+    failures: List[BSESessionFailure] = []
+    if shard is not None:
+        shard_task_ids = select_shard([(task.task_id, get_session_cost(task.spec)) for task in tasks], shard)
+        tasks = [task for task in tasks if task.task_id in shard_task_ids]
     tasks_size = len(tasks)
-    if tasks_size == 1:
-        tasks[0].launch(session_num, seed)
+    if tasks_size == 0:
+        return failures
+    elif tasks_size == 1:
+        try:
+            task_stats, failures = _launch_task_with_retries(
+                tasks[0], market_session_func, session_num, seed, resume, stats is not None, retries
+            )
+        except Exception as ex:  # pylint: disable=broad-except
+            raise_process_error(ex)
+        else:
+            if stats is not None and task_stats is not None:
+                stats.add(tasks[0].task_id, task_stats)
     else:
-        workers = get_default_worker_size(tasks_size, workers)
+        workers, worker_cpus = _get_worker_size(tasks_size, workers, cpu_affinity, physical_cores_only)
+        if worker_cpus is None:
+            pool_args = {}
+        else:
+            pool_args = {"initializer": pin_worker_to_cpu, "initargs": (worker_cpus, create_cpu_slots(worker_cpus),)}
         with tqdm(total=len(tasks)) as pbar:
-            with Pool(processes=workers) as p:
+
+            def _task_complete_handler(task_id: str, result: Tuple[Optional[BSESessionStats], list]):
+                pbar.update()
+                task_stats, task_failures = result
+                if stats is not None and task_stats is not None:
+                    stats.add(task_id, task_stats)
+                failures.extend(task_failures)
+
+            def _task_error_handler(ex):
+                pbar.update()
+                raise_process_error(ex)
+
+            with Pool(processes=workers, maxtasksperchild=maxtasksperchild, **pool_args) as p:
                 for task in tasks:
                     p.apply_async(
-                        task.launch,
-                        args=(market_session_func, session_num, seed,),
-                        callback=lambda _: pbar.update(),
-                        error_callback=raise_process_error
+                        _launch_task_with_retries,
+                        args=(task, market_session_func, session_num, seed, resume, stats is not None, retries,),
+                        callback=functools.partial(_task_complete_handler, task.task_id),
+                        error_callback=_task_error_handler
                     )
                 p.close()
                 p.join()
+    _print_failures(failures)
+    return failures
 
 
 # Create a process for each session in each task and run it in parallel
-# Since the random number seed cannot be customized, the result cannot be completely reproduced
+# Sessions are seeded separately, so the results are the same as 'launch_tasks_in_parallel' with the same seed
 # Faster than 'launch_market_tasks_in_parallel' only when the amount of tasks is small but the amount of sessions is large
+# avg_balance files are combined in order while the sessions finish
+# With 'delete_session_avg_balances', the avg_balance file of each session is deleted after combined
+# With 'shard=(i, n)', only the i-th of n cost-balanced parts of all sessions is run
+# With 'speculative=x', a copy of a session running x times longer than the median of its task is started on an idle worker
+# A failed session is retried up to 'retries' times, return the sessions which still failed
+# 'cpu_affinity' and 'physical_cores_only' are the same as 'launch_tasks_in_parallel'
+# With 'adaptive_workers', 'workers' is the maximum, the sessions running at the same time follow
+# the measured peak RSS of sessions, the available memory and the load average, and pause while the system is swapping
+# With 'database', outputs of every finished session are added to it by this process
+# With 'keep_session_files=False', the output files of a session are deleted after added to the database
+# 'stats' is the same as 'launch_tasks_in_parallel', stats of resumed sessions are read from their stats files
+# With 'stop_rule', 'session_num' is the maximum, the sessions of a task are launched in waves until the stats
+# of every trader type are precise enough, the reason of the stop is recorded in the task config
 # Note: Running multiple processes does not produce any output on the console
 def launch_tasks_sessions_in_parallel(
         market_session_func: callable,
         *tasks: BSEMarketTask,
         session_num: int = 1,
         combine_avg_balances: bool = True,
-        workers: Optional[int] = None
-):
+        workers: Optional[int] = None,
+        seed: Optional[int] = None,
+        resume: bool = False,
+        shard: Optional[Tuple[int, int]] = None,
+        delete_session_avg_balances: bool = False,
+        speculative: Optional[float] = None,
+        retries: int = 0,
+        maxtasksperchild: Optional[int] = None,
+        cpu_affinity: bool = False,
+        physical_cores_only: bool = False,
+        adaptive_workers: bool = False,
+        database: Optional[BSEResultDatabase] = None,
+        keep_session_files: bool = True,
+        stats: Optional[BSEStatsCollector] = None,
+        stop_rule: Optional[BSEStopRule] = None
+) -> List[BSESessionFailure]:
     if session_num < 1:
         raise ValueError
-    if session_num == 1:
-        launch_tasks_in_parallel(
-            market_session_func=market_session_func,
-            *tasks,
-            session_num=session_num,
-            workers=workers
+    tasks_sessions = {task.task_id: list(range(session_num)) for task in tasks}
+    if shard is not None:
+        shard_sessions = select_shard(
+            [((task.task_id, i), get_session_cost(task.spec)) for task in tasks for i in range(session_num)],
+            shard
         )
-    else:
-        tasks_size = len(tasks) * session_num
-        workers = get_default_worker_size(tasks_size, workers)
-        with tqdm(total=tasks_size) as pbar:
-            with Pool(processes=workers) as p:
-                for task in tasks:
-                    task.launch_in_pool(market_session_func, session_num, p, combine_avg_balances, pbar.update)
-                p.close()
-                p.join()
+        tasks_sessions = {k: [i for i in v if (k, i) in shard_sessions] for k, v in tasks_sessions.items()}
+    tasks_size = sum(len(i) for i in tasks_sessions.values())
+    workers, worker_cpus = _get_worker_size(tasks_size, workers, cpu_affinity, physical_cores_only)
+    with tqdm(total=tasks_size) as pbar:
+        scheduler = BSESessionScheduler(
+            market_session_func, workers,
+            combine_avg_balances=combine_avg_balances,
+            delete_session_avg_balances=delete_session_avg_balances,
+            speculative=speculative,
+            retries=retries,
+            maxtasksperchild=maxtasksperchild,
+            worker_cpus=worker_cpus,
+            adaptive=adaptive_workers,
+            database=database,
+            keep_session_files=keep_session_files,
+            stats=stats,
+            stop_rule=stop_rule,
+            session_complete_callback=pbar.update
+        )
+        for task in tasks:
+            scheduler.add_task(task, session_num, seed, resume, tasks_sessions[task.task_id])
+        failures = scheduler.run()
+    _print_failures(failures)
+    return failures
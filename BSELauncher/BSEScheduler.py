@@ -0,0 +1,420 @@
+import os
+import copy
+import time
+import shutil
+import statistics
+import traceback
+import multiprocessing
+from multiprocessing import Pool, SimpleQueue
+from multiprocessing.pool import AsyncResult
+from typing import Optional, List, Dict, Iterable, Tuple
+
+from .BSETask import BSEMarketTask, _get_session_file_index
+from .BSEFailure import BSESessionFailure
+from .BSEDatabase import BSEResultDatabase
+from .BSEStats import BSESessionStats, BSEStatsCollector, BSEStopRule
+from .utils.files import AvgBalanceCombiner, get_session_output_files, publish_staged_outputs
+from .utils.files import get_session_stats_path, get_avg_balance_session_id
+from .utils.affinity import create_cpu_slots, pin_worker_to_cpu
+from .utils.resources import AdaptiveWorkerSize, get_peak_rss
+
+# A worker may exit right after sending its result, so it is regarded as crashed only after this delay
+_CRASH_GRACE_SECONDS = 1.0
+
+# Set in each pool worker, workers report (session key, attempt, pid) when an attempt starts
+_start_queue: Optional[SimpleQueue] = None
+
+
+def _init_scheduler_worker(start_queue: SimpleQueue, worker_cpus: Optional[List[int]], cpu_slots):
+    global _start_queue
+    _start_queue = start_queue
+    if worker_cpus is not None:
+        pin_worker_to_cpu(worker_cpus, cpu_slots)
+
+
+# Staged attempts write into their own dir inside the output dir, so the outputs can be published by renaming
+# Return the peak RSS of the worker and the stats of the session if 'session_stats'
+def _run_session_attempt(
+        task: BSEMarketTask,
+        market_session_func: callable,
+        session_index: int,
+        session_id: str,
+        spec_dict: dict,
+        csv_path: str,
+        seed: Optional[int],
+        staging_dir: Optional[str],
+        attempt_key: Tuple[str, int],
+        session_stats: bool = False
+) -> Tuple[Optional[int], Optional[BSESessionStats]]:
+    if _start_queue is not None:
+        _start_queue.put((attempt_key, os.getpid()))
+    if staging_dir is None:
+        stats = task._launch_in_parallel(
+            market_session_func, session_index, session_id, spec_dict, csv_path, seed, session_stats
+        )
+    else:
+        os.makedirs(staging_dir)
+        staged_task = copy.copy(task)
+        staged_task.output_dir = staging_dir
+        staged_csv_path = os.path.join(staging_dir, os.path.basename(csv_path))
+        stats = staged_task._launch_in_parallel(
+            market_session_func, session_index, session_id, spec_dict, staged_csv_path, seed, session_stats
+        )
+    return get_peak_rss(), stats
+
+
+class _SessionAttempt:
+    def __init__(self, result: AsyncResult, staging_dir: Optional[str]):
+        self.result: AsyncResult = result
+        self.staging_dir: Optional[str] = staging_dir
+        self.start_time: float = time.monotonic()
+        # Worker process of this attempt, known after it starts
+        self.pid: Optional[int] = None
+        self.lost_time: Optional[float] = None
+        self.handled: bool = False
+
+
+class _SessionJob:
+    def __init__(self, task_state: "_TaskState", session_index: int, session_id: str, csv_path: str):
+        self.task_state: _TaskState = task_state
+        self.session_index: int = session_index
+        self.session_id: str = session_id
+        self.csv_path: str = csv_path
+        self.attempts: List[_SessionAttempt] = []
+        self.failures: int = 0
+        self.done: bool = False
+
+    def get_key(self) -> str:
+        return f"{self.task_state.task.task_id}/{self.session_id}"
+
+
+class _TaskState:
+    def __init__(
+            self,
+            task: BSEMarketTask,
+            market_params: dict,
+            seed: Optional[int],
+            combiner: Optional[AvgBalanceCombiner],
+            stats: Optional[BSESessionStats]
+    ):
+        self.task: BSEMarketTask = task
+        self.market_params: dict = market_params
+        self.seed: Optional[int] = seed
+        self.combiner: Optional[AvgBalanceCombiner] = combiner
+        # Merged stats of the finished sessions of this task
+        self.stats: Optional[BSESessionStats] = stats
+        # Wall time of finished sessions in seconds
+        self.durations: List[float] = []
+        # With a stop rule, sessions not released yet, and sessions of the current wave which are not done
+        self.waiting: List[_SessionJob] = []
+        self.wave_running: int = 0
+
+
+# Schedule sessions of tasks into a pool, at most one session per worker is submitted at the same time
+# With 'speculative', a copy of a session is started on an idle worker once it has run longer than
+# 'speculative' times the median wall time of the finished sessions of its task, the first finished copy is kept
+# A failed session is retried up to 'retries' times, also when its worker process has crashed hard
+# With 'worker_cpus', each worker is pinned to its own CPU in the list
+# With 'adaptive', fewer sessions than 'workers' may run, see 'AdaptiveWorkerSize'
+# avg_balance files are combined in order while the sessions finish, see 'AvgBalanceCombiner'
+# With 'database', outputs of finished sessions are added to it, and deleted unless 'keep_session_files'
+# With 'stats', workers compute the stats of their sessions, which are merged into it by task
+# With 'stop_rule', sessions of a task are released in waves until its stats are precise enough, see 'BSEStopRule'
+# 'session_num' of a task is then the maximum, why it stopped is recorded in its task config
+class BSESessionScheduler:
+
+    def __init__(
+            self,
+            market_session_func: callable,
+            workers: int,
+            combine_avg_balances: bool = True,
+            delete_session_avg_balances: bool = False,
+            speculative: Optional[float] = None,
+            speculative_min_finished: int = 3,
+            retries: int = 0,
+            maxtasksperchild: Optional[int] = None,
+            worker_cpus: Optional[List[int]] = None,
+            adaptive: bool = False,
+            database: Optional[BSEResultDatabase] = None,
+            keep_session_files: bool = True,
+            stats: Optional[BSEStatsCollector] = None,
+            stop_rule: Optional[BSEStopRule] = None,
+            session_complete_callback: Optional[callable] = None,
+            poll_interval: float = 0.05
+    ):
+        self.market_session_func: callable = market_session_func
+        self.workers: int = workers
+        self.combine_avg_balances: bool = combine_avg_balances
+        self.delete_session_avg_balances: bool = delete_session_avg_balances
+        self.speculative: Optional[float] = speculative
+        self.speculative_min_finished: int = speculative_min_finished
+        self.retries: int = retries
+        self.maxtasksperchild: Optional[int] = maxtasksperchild
+        self.worker_cpus: Optional[List[int]] = worker_cpus
+        self.adaptive_worker_size: Optional[AdaptiveWorkerSize] = None
+        if adaptive:
+            cpus = None if worker_cpus is None else len(set(worker_cpus))
+            self.adaptive_worker_size = AdaptiveWorkerSize(workers, cpus=cpus)
+        if database is None and not keep_session_files:
+            raise ValueError("Session files can only be deleted when they are added to a database!")
+        if combine_avg_balances and not keep_session_files:
+            raise ValueError("Session files are required to combine avg_balance files!")
+        self.database: Optional[BSEResultDatabase] = database
+        self.keep_session_files: bool = keep_session_files
+        self.stats: Optional[BSEStatsCollector] = stats
+        self.stop_rule: Optional[BSEStopRule] = stop_rule
+        self.session_complete_callback: Optional[callable] = session_complete_callback
+        self.poll_interval: float = poll_interval
+        self._pool: Optional[Pool] = None
+        self._start_queue: Optional[SimpleQueue] = None
+        self._pending: List[_SessionJob] = []
+        self._running: List[_SessionJob] = []
+        self._task_states: Dict[str, _TaskState] = {}
+        self._failures: List[BSESessionFailure] = []
+
+    def add_task(
+            self,
+            task: BSEMarketTask,
+            session_num: int,
+            seed: Optional[int] = None,
+            resume: bool = False,
+            session_indices: Optional[Iterable[int]] = None
+    ):
+        market_params, seed, sessions, finished_files = task._prepare_pool_sessions(
+            session_num, seed, resume, session_indices, self._is_computing_stats()
+        )
+        if len(sessions) + len(finished_files) == 0:
+            return
+        combiner = None
+        if self.combine_avg_balances:
+            combiner = AvgBalanceCombiner(
+                task.output_dir,
+                task.task_id,
+                sorted(finished_files + [csv_path for _, _, csv_path in sessions], key=_get_session_file_index),
+                self.delete_session_avg_balances
+            )
+        stats = BSESessionStats() if self._is_computing_stats() else None
+        task_state = _TaskState(task, market_params, seed, combiner, stats)
+        self._task_states[task.task_id] = task_state
+        for csv_path in finished_files:
+            if task_state.stats is not None:
+                stats_path = get_session_stats_path(task.output_dir, get_avg_balance_session_id(csv_path))
+                self._add_session_stats(task_state, BSESessionStats.load(stats_path))
+            self._on_session_complete(task_state, csv_path)
+        jobs = [_SessionJob(task_state, i, session_id, csv_path) for i, session_id, csv_path in sessions]
+        if self.stop_rule is None:
+            self._pending += jobs
+        else:
+            task_state.waiting = jobs
+            self._release_wave(task_state)
+
+    def _is_computing_stats(self) -> bool:
+        return self.stats is not None or self.stop_rule is not None
+
+    def _add_session_stats(self, task_state: _TaskState, stats: Optional[BSESessionStats]):
+        if stats is None:
+            return
+        task_state.stats.merge(stats)
+        if self.stats is not None:
+            self.stats.add(task_state.task.task_id, stats)
+
+    # Check the stop rule after each wave of a task, then release its next wave or skip its other sessions
+    # The first wave runs at least until 'min_sessions' of the stop rule
+    def _release_wave(self, task_state: _TaskState):
+        if self.stop_rule.is_converged(task_state.stats):
+            reason = "converged"
+        elif len(task_state.waiting) == 0:
+            reason = "session_cap"
+        else:
+            wave_size = max(
+                self.stop_rule.wave_size or self.workers, self.stop_rule.min_sessions - task_state.stats.sessions
+            )
+            wave, task_state.waiting = task_state.waiting[:wave_size], task_state.waiting[wave_size:]
+            task_state.wave_running = len(wave)
+            self._pending += wave
+            return
+        for job in task_state.waiting:
+            self._skip_job(job)
+        task_state.waiting = []
+        task_state.task._save_stop_reason(self.stop_rule.describe(task_state.stats, reason))
+
+    def _skip_job(self, job: _SessionJob):
+        job.done = True
+        if job.task_state.combiner is not None:
+            job.task_state.combiner.skip(job.csv_path)
+        if self.session_complete_callback is not None:
+            self.session_complete_callback()
+
+    def _get_running_attempts(self) -> int:
+        return sum(1 for job in self._running for attempt in job.attempts if not attempt.handled)
+
+    def _get_worker_size(self) -> int:
+        if self.adaptive_worker_size is None:
+            return self.workers
+        return self.adaptive_worker_size.get_worker_size(self._get_running_attempts())
+
+    def _submit(self, job: _SessionJob):
+        task_state = job.task_state
+        attempt_no = len(job.attempts)
+        if self.speculative is None:
+            staging_dir = None
+        else:
+            staging_dir = os.path.join(task_state.task.output_dir, f".{job.session_id}.{attempt_no}")
+            if os.path.exists(staging_dir):
+                shutil.rmtree(staging_dir)
+        result = self._pool.apply_async(
+            _run_session_attempt,
+            args=(
+                task_state.task, self.market_session_func, job.session_index, job.session_id,
+                task_state.market_params, job.csv_path, task_state.seed, staging_dir, (job.get_key(), attempt_no),
+                self._is_computing_stats(),
+            )
+        )
+        job.attempts.append(_SessionAttempt(result, staging_dir))
+
+    def _find_straggler(self) -> Optional[_SessionJob]:
+        now = time.monotonic()
+        straggler, straggler_ratio = None, self.speculative
+        for job in self._running:
+            durations = job.task_state.durations
+            running_attempts = [i for i in job.attempts if not i.handled]
+            if job.done or len(running_attempts) != 1 or len(durations) < self.speculative_min_finished:
+                continue
+            ratio = (now - running_attempts[0].start_time) / max(statistics.median(durations), 1e-6)
+            if ratio > straggler_ratio:
+                straggler, straggler_ratio = job, ratio
+        return straggler
+
+    def _on_session_complete(self, task_state: _TaskState, csv_path: str):
+        if task_state.combiner is not None:
+            task_state.combiner.finish(csv_path)
+        if self.session_complete_callback is not None:
+            self.session_complete_callback()
+
+    def _on_job_done(self, job: _SessionJob):
+        job.done = True
+        self._on_session_complete(job.task_state, job.csv_path)
+        if self.stop_rule is not None:
+            job.task_state.wave_running -= 1
+            if job.task_state.wave_running == 0:
+                self._release_wave(job.task_state)
+
+    def _add_session_to_database(self, job: _SessionJob):
+        if self.database is None:
+            return
+        task = job.task_state.task
+        self.database.add_session(task.task_id, job.session_id, job.session_index, task.output_dir)
+        if not self.keep_session_files:
+            for f_path in get_session_output_files(task.output_dir, job.session_id).values():
+                os.remove(f_path)
+
+    def _on_attempt_failed(self, job: _SessionJob, attempt: _SessionAttempt, error: str):
+        if attempt.staging_dir is not None:
+            shutil.rmtree(attempt.staging_dir, ignore_errors=True)
+        # Another copy of this session is still running
+        if not all(i.handled for i in job.attempts):
+            return
+        job.failures += 1
+        if job.failures <= self.retries:
+            self._pending.insert(0, job)
+        else:
+            self._failures.append(
+                BSESessionFailure(job.task_state.task.task_id, job.session_id, job.session_index, job.failures, error)
+            )
+            self._on_job_done(job)
+
+    def _update_attempt_pids(self):
+        attempts = {(job.get_key(), i): attempt for job in self._running for i, attempt in enumerate(job.attempts)}
+        while not self._start_queue.empty():
+            attempt_key, pid = self._start_queue.get()
+            if attempt_key in attempts:
+                attempts[attempt_key].pid = pid
+
+    def _poll(self):
+        self._update_attempt_pids()
+        alive_pids = {p.pid for p in multiprocessing.active_children()}
+        for job in list(self._running):
+            for attempt in job.attempts:
+                if attempt.handled:
+                    continue
+                if not attempt.result.ready():
+                    # The pool replaces a crashed worker, but the result of its session never arrives
+                    if attempt.pid is not None and attempt.pid not in alive_pids:
+                        if attempt.lost_time is None:
+                            attempt.lost_time = time.monotonic()
+                        elif time.monotonic() - attempt.lost_time > _CRASH_GRACE_SECONDS:
+                            attempt.handled = True
+                            error = f"Worker process {attempt.pid} exited unexpectedly"
+                            if job.done and attempt.staging_dir is not None:
+                                shutil.rmtree(attempt.staging_dir, ignore_errors=True)
+                            elif not job.done:
+                                self._on_attempt_failed(job, attempt, error)
+                    continue
+                duration = time.monotonic() - attempt.start_time
+                attempt.handled = True
+                if job.done:
+                    # The losing copy, its outputs are dropped
+                    if attempt.staging_dir is not None:
+                        shutil.rmtree(attempt.staging_dir, ignore_errors=True)
+                    continue
+                try:
+                    peak_rss, session_stats = attempt.result.get()
+                except Exception as e:  # pylint: disable=broad-except
+                    self._on_attempt_failed(job, attempt, "".join(traceback.format_exception(e)))
+                    continue
+                if self.adaptive_worker_size is not None:
+                    self.adaptive_worker_size.add_peak_rss(peak_rss)
+                if attempt.staging_dir is not None:
+                    publish_staged_outputs(attempt.staging_dir, job.task_state.task.output_dir)
+                self._add_session_stats(job.task_state, session_stats)
+                self._add_session_to_database(job)
+                job.task_state.task._add_session_to_manifest(job.session_index, job.session_id)
+                job.task_state.durations.append(duration)
+                self._on_job_done(job)
+        self._running = [job for job in self._running if not all(i.handled for i in job.attempts)]
+
+    def _schedule(self):
+        while len(self._pending) > 0 or any(not job.done for job in self._running):
+            self._poll()
+            while len(self._pending) > 0 and self._get_running_attempts() < self._get_worker_size():
+                job = self._pending.pop(0)
+                self._submit(job)
+                self._running.append(job)
+            if self.speculative is not None and len(self._pending) == 0:
+                while self._get_running_attempts() < self._get_worker_size():
+                    job = self._find_straggler()
+                    if job is None:
+                        break
+                    self._submit(job)
+            time.sleep(self.poll_interval)
+
+    # Return sessions which still failed after all retries
+    # The pool is terminated at the end, so losing copies which are still running don't hold it
+    def run(self) -> List[BSESessionFailure]:
+        self._start_queue = SimpleQueue()
+        self._pool = Pool(
+            processes=self.workers,
+            initializer=_init_scheduler_worker,
+            initargs=(
+                self._start_queue,
+                self.worker_cpus,
+                None if self.worker_cpus is None else create_cpu_slots(self.worker_cpus),
+            ),
+            maxtasksperchild=self.maxtasksperchild
+        )
+        try:
+            self._schedule()
+        finally:
+            self._pool.terminate()
+            self._pool.join()
+            for job in self._running:
+                for attempt in job.attempts:
+                    if not attempt.handled and attempt.staging_dir is not None:
+                        shutil.rmtree(attempt.staging_dir, ignore_errors=True)
+            self._pool = None
+            for task_state in self._task_states.values():
+                if task_state.combiner is not None:
+                    task_state.combiner.close()
+            if self.database is not None:
+                self.database.flush()
+        return self._failures
@@ -0,0 +1,134 @@
+import os
+import sys
+import json
+from typing import Optional, List, Dict
+
+try:
+    from tqdm import tqdm
+except ModuleNotFoundError:
+    print("Dependency 'tqdm' is required! Please run 'python -m pip install tqdm' to install it!")
+    sys.exit(1)
+
+from .BSETask import BSEMarketTask
+from .BSEScheduler import BSESessionScheduler
+from .BSEFailure import BSESessionFailure
+from .BSEStats import BSESessionStats, BSEStatsCollector, SESSION_STATS_METRICS
+from .utils.process import get_default_worker_size
+
+BSE_SEARCH_REPORT_VERSION = 1
+
+
+def get_search_report_path(output_dir: str, search_id: str) -> str:
+    return os.path.join(output_dir, f"{search_id}_search.json")
+
+
+# Mean of 'metric' of 'trader_type', None if the trader type has no sessions
+def _get_score(stats: BSESessionStats, trader_type: str, metric: str) -> Optional[float]:
+    metrics = stats.trader_types.get(trader_type, None)
+    if metrics is None or metrics[metric].count == 0:
+        return None
+    return metrics[metric].mean
+
+
+# Candidates without a score are ranked last
+def _get_rank_key(score: Optional[float], maximize: bool) -> tuple:
+    if score is None:
+        return True, 0.0
+    return False, -score if maximize else score
+
+
+# Successive halving over candidate tasks, e.g. tasks built from different spec parameters
+# Round k runs every remaining candidate until it has 'min_sessions * eta^k' sessions, at most 'max_sessions',
+# then only the best 1/eta of them by the mean of 'metric' of 'trader_type' go on to the next round
+# Rounds go on until one candidate is left or the candidates have 'max_sessions' sessions
+# Session indices are kept across rounds, so the sessions of a candidate are the same as launching it alone
+# with 'session_num=max_sessions' and the same seed, later rounds resume the sessions of the earlier ones
+# With 'resume', the first round resumes too, e.g. after the search was interrupted
+# The report is saved as '<search_id>_search.json' in 'output_dir' and returned:
+# every evaluated candidate with its sessions, score and last round, and the candidates of each round
+def launch_successive_halving(
+        market_session_func: callable,
+        search_id: str,
+        tasks: List[BSEMarketTask],
+        trader_type: str,
+        output_dir: str,
+        metric: str = "profit",
+        maximize: bool = True,
+        min_sessions: int = 4,
+        max_sessions: int = 64,
+        eta: int = 2,
+        seed: Optional[int] = None,
+        workers: Optional[int] = None,
+        retries: int = 0,
+        resume: bool = False
+) -> dict:
+    if len(tasks) == 0:
+        raise ValueError("No candidate tasks!")
+    if len(set(task.task_id for task in tasks)) != len(tasks):
+        raise ValueError(f"Task ids of candidates must be unique! Value: {[task.task_id for task in tasks]}")
+    if metric not in SESSION_STATS_METRICS:
+        raise ValueError(f"Unknown metric! Value: {metric} Expected: {SESSION_STATS_METRICS}")
+    if not 1 <= min_sessions <= max_sessions or eta < 2:
+        raise ValueError(f"Halving error! Min sessions: {min_sessions} Max sessions: {max_sessions} Eta: {eta}")
+    workers = get_default_worker_size(len(tasks) * min_sessions, workers)
+    candidates: Dict[str, dict] = {
+        task.task_id: {"task_id": task.task_id, "sessions": 0, "score": None, "last_round": 0} for task in tasks
+    }
+    rounds = []
+    failures: List[BSESessionFailure] = []
+    remaining = list(tasks)
+    target = min(min_sessions, max_sessions)
+    while True:
+        stats = BSEStatsCollector()
+        with tqdm(total=len(remaining) * target) as pbar:
+            scheduler = BSESessionScheduler(
+                market_session_func, workers,
+                combine_avg_balances=False,
+                retries=retries,
+                stats=stats,
+                session_complete_callback=pbar.update
+            )
+            for task in remaining:
+                scheduler.add_task(task, max_sessions, seed, resume or len(rounds) > 0, range(target))
+            failures += scheduler.run()
+        for task in remaining:
+            task_stats = stats.get_task_stats(task.task_id)
+            candidates[task.task_id].update({
+                "sessions": task_stats.sessions,
+                "score": _get_score(task_stats, trader_type, metric),
+                "last_round": len(rounds)
+            })
+        remaining.sort(key=lambda x: _get_rank_key(candidates[x.task_id]["score"], maximize))
+        is_last = len(remaining) == 1 or target >= max_sessions
+        kept = remaining[:1] if is_last else remaining[:max(1, len(remaining) // eta)]
+        rounds.append({
+            "round": len(rounds),
+            "sessions": target,
+            "candidates": [task.task_id for task in remaining],
+            "kept": [task.task_id for task in kept]
+        })
+        if is_last:
+            break
+        remaining = kept
+        target = min(target * eta, max_sessions)
+    for failure in failures:
+        print(
+            f"Session '{failure.session_id}' failed after {failure.attempts} attempts:\n{failure.error}",
+            file=sys.stderr
+        )
+    report = {
+        "version": BSE_SEARCH_REPORT_VERSION,
+        "search_id": search_id,
+        "trader_type": trader_type,
+        "metric": metric,
+        "maximize": maximize,
+        "seed": seed,
+        "best": remaining[0].task_id,
+        "candidates": [candidates[task.task_id] for task in tasks],
+        "rounds": rounds,
+        "failures": [failure.session_id for failure in failures]
+    }
+    os.makedirs(output_dir, exist_ok=True)
+    with open(get_search_report_path(output_dir, search_id), "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False)
+    return report
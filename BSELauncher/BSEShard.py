@@ -0,0 +1,121 @@
+import os
+import json
+from typing import List, Tuple, Dict, Iterable, Hashable, Set
+
+from .BSEConfig import MarketSessionSpec
+from .utils.files import read_avg_balance_csv_sessions, get_task_output_dir
+
+
+def _check_shard(shard: Tuple[int, int]):
+    index, count = shard
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Shard error! Value: {shard}")
+
+
+# Each timestep processes one trader and then every trader responds, so a session costs about duration * traders^2
+def get_session_cost(spec: MarketSessionSpec) -> float:
+    traders = sum(i.amount for i in spec.sellers) + sum(i.amount for i in spec.buyers)
+    return float(spec.session_time[1] - spec.session_time[0]) * traders * traders
+
+
+# Longest processing time first, ties are broken by key, so every machine gets the same split without coordination
+def split_into_shards(units: Iterable[Tuple[Hashable, float]], shard_count: int) -> List[Set[Hashable]]:
+    shards = [set() for _ in range(shard_count)]
+    loads = [0.0] * shard_count
+    for key, cost in sorted(units, key=lambda x: (-x[1], str(x[0]))):
+        target = min(range(shard_count), key=lambda i: (loads[i], i))
+        shards[target].add(key)
+        loads[target] += cost
+    return shards
+
+
+def select_shard(units: Iterable[Tuple[Hashable, float]], shard: Tuple[int, int]) -> Set[Hashable]:
+    _check_shard(shard)
+    return split_into_shards(units, shard[1])[shard[0]]
+
+
+def _session_index(session_id: str) -> int:
+    return int(session_id[session_id.rindex("_S") + 2:])
+
+
+# Combine the task configs and avg_balance files written by all shards of a task into output_dir
+# Sessions whose avg_balance file was deleted are read from the combined avg_balance file of their shard
+# Return the path of the merged task config
+def merge_task_shards(
+        shard_output_dirs: Iterable[str],
+        output_dir: str,
+        task_id: str,
+        task_subdir: bool = False
+) -> str:
+    output_dir = get_task_output_dir(output_dir, task_id, task_subdir)
+    configs = []
+    for shard_dir in shard_output_dirs:
+        shard_dir = get_task_output_dir(shard_dir, task_id, task_subdir)
+        config_path = os.path.join(shard_dir, f"{task_id}.json")
+        if os.path.isfile(config_path):
+            with open(config_path, "r", encoding="utf-8") as f:
+                configs.append((shard_dir, json.load(f)))
+    if len(configs) == 0:
+        raise FileNotFoundError(f"No task config of '{task_id}' found!")
+
+    session_rows: Dict[str, List[str]] = {}
+    for shard_dir, config in configs:
+        is_file_missing = False
+        for csv_path in config["dump_avg_balance"]:
+            csv_path = os.path.join(shard_dir, os.path.basename(csv_path))
+            if os.path.isfile(csv_path):
+                session_rows.update(read_avg_balance_csv_sessions(csv_path))
+            else:
+                is_file_missing = True
+        # Shards run with 'delete_session_avg_balances' only keep the combined file of the task
+        if is_file_missing:
+            combined_rows = read_avg_balance_csv_sessions(os.path.join(shard_dir, f"{task_id}_avg_balance.csv"))
+            for session_id in config["session_ids"]:
+                if session_id not in session_rows and session_id in combined_rows:
+                    session_rows[session_id] = combined_rows[session_id]
+    session_ids = sorted(set(i for _, config in configs for i in config["session_ids"]), key=_session_index)
+    missing = [i for i in session_ids if i not in session_rows]
+    if len(missing) > 0:
+        raise FileNotFoundError(f"Missing avg_balance outputs of sessions: {missing}")
+
+    os.makedirs(output_dir, exist_ok=True)
+    avg_balance_path = os.path.join(output_dir, f"{task_id}_avg_balance.csv")
+    with open(avg_balance_path, mode="w", encoding="utf-8") as f:
+        for session_id in session_ids:
+            f.writelines(session_rows[session_id])
+
+    task_config = dict(configs[0][1])
+    task_config.pop("shard", None)
+    task_config["session_num"] = max(config["session_num"] for _, config in configs)
+    task_config["session_ids"] = session_ids
+    task_config["output_dir"] = output_dir
+    task_config["dump_avg_balance"] = [avg_balance_path]
+    config_path = os.path.join(output_dir, f"{task_id}.json")
+    with open(config_path, mode="w", encoding="utf-8") as f:
+        json.dump(task_config, f, ensure_ascii=False)
+    return config_path
+
+
+def merge_shards(
+        shard_output_dirs: Iterable[str],
+        output_dir: str,
+        task_ids: Iterable[str],
+        task_subdir: bool = False
+) -> List[str]:
+    shard_output_dirs = list(shard_output_dirs)
+    return [merge_task_shards(shard_output_dirs, output_dir, task_id, task_subdir) for task_id in task_ids]
+
+
+# Concatenate the aggregated tables of 'launch_trader_mix_sweep' written by all shards
+def merge_sweep_tables(table_paths: Iterable[str], output_path: str) -> str:
+    with open(output_path, mode="w", encoding="utf-8") as f_out:
+        header_written = False
+        for table_path in table_paths:
+            with open(table_path, mode="r", encoding="utf-8") as f_in:
+                header = f_in.readline()
+                if not header_written:
+                    f_out.write(header)
+                    header_written = True
+                for line in f_in:
+                    f_out.write(line)
+    return output_path
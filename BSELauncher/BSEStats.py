@@ -0,0 +1,377 @@
+import math
+import json
+import statistics
+from typing import Optional, List, Dict, Iterable
+
+BSE_SESSION_STATS_VERSION = 1
+
+# Statistics of each trader type in a session, the mean over the traders of the type
+# profit: final balance, profit_per_trade: balance per trade (skipped without trades), trades: number of trades
+SESSION_STATS_METRICS = ("profit", "profit_per_trade", "trades")
+
+SUMMARY_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+
+# Mergeable quantile sketch with relative error, values are counted in logarithmic buckets (DDSketch)
+# Memory grows with the log of the value range, not with the amount of values
+class QuantileSketch:
+
+    def __init__(self, relative_accuracy: float = 0.01):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError(f"Relative accuracy must be in (0, 1)! Value: {relative_accuracy}")
+        self.relative_accuracy: float = relative_accuracy
+        self._gamma: float = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma: float = math.log(self._gamma)
+        self.positive: Dict[int, int] = {}
+        self.negative: Dict[int, int] = {}
+        self.zero: int = 0
+        self.count: int = 0
+
+    def _get_key(self, value: float) -> int:
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def _get_value(self, key: int) -> float:
+        return 2 * self._gamma ** key / (self._gamma + 1)
+
+    def add(self, value: float):
+        if value > 0:
+            key = self._get_key(value)
+            self.positive[key] = self.positive.get(key, 0) + 1
+        elif value < 0:
+            key = self._get_key(-value)
+            self.negative[key] = self.negative.get(key, 0) + 1
+        else:
+            self.zero += 1
+        self.count += 1
+
+    def merge(self, other: "QuantileSketch"):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Only sketches with the same relative accuracy can be merged!")
+        for key, n in other.positive.items():
+            self.positive[key] = self.positive.get(key, 0) + n
+        for key, n in other.negative.items():
+            self.negative[key] = self.negative.get(key, 0) + n
+        self.zero += other.zero
+        self.count += other.count
+
+    def quantile(self, q: float) -> Optional[float]:
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        # From the most negative value to the largest one
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return -self._get_value(key)
+        seen += self.zero
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return self._get_value(key)
+        return self._get_value(max(self.positive))
+
+    def to_dict(self) -> dict:
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "positive": {str(k): v for k, v in self.positive.items()},
+            "negative": {str(k): v for k, v in self.negative.items()},
+            "zero": self.zero
+        }
+
+    @staticmethod
+    def from_dict(data: dict) -> "QuantileSketch":
+        sketch = QuantileSketch(data["relative_accuracy"])
+        sketch.positive = {int(k): v for k, v in data["positive"].items()}
+        sketch.negative = {int(k): v for k, v in data["negative"].items()}
+        sketch.zero = data["zero"]
+        sketch.count = sketch.zero + sum(sketch.positive.values()) + sum(sketch.negative.values())
+        return sketch
+
+
+# Count, mean and variance (Welford), min, max and quantiles of a stream of values
+# Streams computed in different processes are merged without their values
+class RunningStats:
+
+    def __init__(self, relative_accuracy: float = 0.01):
+        self.count: int = 0
+        self.mean: float = 0.0
+        self._m2: float = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+        self.sketch: QuantileSketch = QuantileSketch(relative_accuracy)
+
+    def add(self, value: float):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.sketch.add(value)
+
+    def merge(self, other: "RunningStats"):
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.mean, self._m2, self.min, self.max = other.mean, other._m2, other.min, other.max
+        else:
+            count = self.count + other.count
+            delta = other.mean - self.mean
+            self.mean += delta * other.count / count
+            self._m2 += other._m2 + delta * delta * self.count * other.count / count
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+        self.count += other.count
+        self.sketch.merge(other.sketch)
+
+    # Sample variance, None with less than two values
+    @property
+    def variance(self) -> Optional[float]:
+        return self._m2 / (self.count - 1) if self.count > 1 else None
+
+    @property
+    def std(self) -> Optional[float]:
+        variance = self.variance
+        return None if variance is None else math.sqrt(variance)
+
+    # Within the relative accuracy of the sketch, and never outside of min and max
+    def quantile(self, q: float) -> Optional[float]:
+        value = self.sketch.quantile(q)
+        if value is None:
+            return None
+        return min(max(value, self.min), self.max)
+
+    def summary(self, quantiles: Iterable[float] = SUMMARY_QUANTILES) -> dict:
+        result = {"count": self.count, "mean": self.mean if self.count > 0 else None, "std": self.std,
+                  "min": self.min, "max": self.max}
+        for q in quantiles:
+            result[f"p{round(q * 100):02d}"] = self.quantile(q)
+        return result
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "m2": self._m2,
+            "min": self.min,
+            "max": self.max,
+            "sketch": self.sketch.to_dict()
+        }
+
+    @staticmethod
+    def from_dict(data: dict) -> "RunningStats":
+        stats = RunningStats()
+        stats.count = data["count"]
+        stats.mean = data["mean"]
+        stats._m2 = data["m2"]
+        stats.min = data["min"]
+        stats.max = data["max"]
+        stats.sketch = QuantileSketch.from_dict(data["sketch"])
+        return stats
+
+
+# Statistics of trader types over sessions, see 'SESSION_STATS_METRICS'
+# A worker computes the stats of its session, the parent merges them across sessions and tasks
+class BSESessionStats:
+
+    def __init__(self):
+        self.sessions: int = 0
+        self.trader_types: Dict[str, Dict[str, RunningStats]] = {}
+
+    def _get_metrics(self, trader_type: str) -> Dict[str, RunningStats]:
+        if trader_type not in self.trader_types:
+            self.trader_types[trader_type] = {metric: RunningStats() for metric in SESSION_STATS_METRICS}
+        return self.trader_types[trader_type]
+
+    # Add one finished session from the traders of 'market_session', keyed by trader id
+    def add_session(self, traders: dict):
+        types = {}
+        for trader in traders.values():
+            balance, trades, n = types.get(trader.ttype, (0, 0, 0))
+            types[trader.ttype] = (balance + trader.balance, trades + trader.n_trades, n + 1)
+        for trader_type, (balance, trades, n) in types.items():
+            metrics = self._get_metrics(trader_type)
+            metrics["profit"].add(balance / n)
+            if trades > 0:
+                metrics["profit_per_trade"].add(balance / trades)
+            metrics["trades"].add(trades / n)
+        self.sessions += 1
+
+    def merge(self, other: "BSESessionStats"):
+        for trader_type, other_metrics in other.trader_types.items():
+            metrics = self._get_metrics(trader_type)
+            for metric, stats in other_metrics.items():
+                metrics[metric].merge(stats)
+        self.sessions += other.sessions
+
+    # {trader type: {metric: summary of 'RunningStats'}}
+    def summary(self, quantiles: Iterable[float] = SUMMARY_QUANTILES) -> Dict[str, Dict[str, dict]]:
+        return {
+            trader_type: {metric: stats.summary(quantiles) for metric, stats in metrics.items()}
+            for trader_type, metrics in sorted(self.trader_types.items())
+        }
+
+    def to_dict(self) -> dict:
+        return {
+            "version": BSE_SESSION_STATS_VERSION,
+            "sessions": self.sessions,
+            "trader_types": {
+                trader_type: {metric: stats.to_dict() for metric, stats in metrics.items()}
+                for trader_type, metrics in self.trader_types.items()
+            }
+        }
+
+    @staticmethod
+    def from_dict(data: dict) -> "BSESessionStats":
+        stats = BSESessionStats()
+        stats.sessions = data["sessions"]
+        stats.trader_types = {
+            trader_type: {metric: RunningStats.from_dict(i) for metric, i in metrics.items()}
+            for trader_type, metrics in data["trader_types"].items()
+        }
+        return stats
+
+    def save(self, file_path: str):
+        with open(file_path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False)
+
+    # None if the file doesn't exist
+    @staticmethod
+    def load(file_path: str) -> Optional["BSESessionStats"]:
+        try:
+            with open(file_path, "r", encoding="utf-8") as f:
+                return BSESessionStats.from_dict(json.load(f))
+        except FileNotFoundError:
+            return None
+
+
+def merge_session_stats(stats: Iterable[Optional[BSESessionStats]]) -> BSESessionStats:
+    result = BSESessionStats()
+    for i in stats:
+        if i is not None:
+            result.merge(i)
+    return result
+
+
+# Sink of 'market_session' which adds the session to 'stats' when it ends, see 'SessionSink' of BSE.py
+# It only has the callbacks, so the launcher doesn't depend on BSE.py
+class SessionStatsSink:
+
+    def __init__(self, stats: BSESessionStats):
+        self.stats: BSESessionStats = stats
+
+    def on_trade(self, time, trade):
+        pass
+
+    def on_cancel(self, time, order):
+        pass
+
+    def on_stats(self, sess_id, time, best_bid, best_ask, type_stats):
+        pass
+
+    def on_strats_frame(self, time, trader_strats, best_buyer, best_seller):
+        pass
+
+    def on_session_end(self, sess_id, time, exchange, traders):
+        self.stats.add_session(traders)
+
+
+# Stop launching sessions of a task once the mean of 'metric' is precise enough for every trader type
+# The half width of the confidence interval of a mean, z * std / sqrt(n), must be at most 'absolute_precision'
+# or 'relative_precision' times the absolute mean, whichever is larger
+# The normal approximation is only good for enough sessions, so nothing stops before 'min_sessions'
+# Sessions are launched in waves of 'wave_size' per task (default: the amount of workers), checked after each wave
+class BSEStopRule:
+
+    def __init__(
+            self,
+            metric: str = "profit",
+            relative_precision: Optional[float] = 0.05,
+            absolute_precision: Optional[float] = None,
+            confidence: float = 0.95,
+            min_sessions: int = 10,
+            wave_size: Optional[int] = None
+    ):
+        if metric not in SESSION_STATS_METRICS:
+            raise ValueError(f"Unknown metric! Value: {metric} Expected: {SESSION_STATS_METRICS}")
+        if relative_precision is None and absolute_precision is None:
+            raise ValueError("Either 'relative_precision' or 'absolute_precision' is required!")
+        if not 0 < confidence < 1:
+            raise ValueError(f"Confidence must be in (0, 1)! Value: {confidence}")
+        self.metric: str = metric
+        self.relative_precision: Optional[float] = relative_precision
+        self.absolute_precision: Optional[float] = absolute_precision
+        self.confidence: float = confidence
+        self.min_sessions: int = max(2, min_sessions)
+        self.wave_size: Optional[int] = wave_size
+        self._z: float = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+
+    # None with less than two values
+    def get_half_width(self, stats: RunningStats) -> Optional[float]:
+        std = stats.std
+        return None if std is None else self._z * std / math.sqrt(stats.count)
+
+    def get_target(self, stats: RunningStats) -> float:
+        targets = [i for i in (self.absolute_precision,) if i is not None]
+        if self.relative_precision is not None:
+            targets.append(self.relative_precision * abs(stats.mean))
+        return max(targets)
+
+    def is_converged(self, stats: BSESessionStats) -> bool:
+        if stats.sessions < self.min_sessions or len(stats.trader_types) == 0:
+            return False
+        for metrics in stats.trader_types.values():
+            half_width = self.get_half_width(metrics[self.metric])
+            if half_width is None or half_width > self.get_target(metrics[self.metric]):
+                return False
+        return True
+
+    # Recorded in the task config when the task stops
+    def describe(self, stats: BSESessionStats, reason: str) -> dict:
+        return {
+            "reason": reason,
+            "sessions": stats.sessions,
+            "metric": self.metric,
+            "relative_precision": self.relative_precision,
+            "absolute_precision": self.absolute_precision,
+            "confidence": self.confidence,
+            "trader_types": {
+                trader_type: {
+                    "mean": metrics[self.metric].mean if metrics[self.metric].count > 0 else None,
+                    "half_width": self.get_half_width(metrics[self.metric]),
+                    "target": self.get_target(metrics[self.metric])
+                }
+                for trader_type, metrics in sorted(stats.trader_types.items())
+            }
+        }
+
+
+# Stats of sessions by task, filled by the launchers in the parent while sessions finish
+class BSEStatsCollector:
+
+    def __init__(self):
+        self.tasks: Dict[str, BSESessionStats] = {}
+
+    def add(self, task_id: str, stats: Optional[BSESessionStats]):
+        if stats is None:
+            return
+        if task_id not in self.tasks:
+            self.tasks[task_id] = BSESessionStats()
+        self.tasks[task_id].merge(stats)
+
+    def get_task_ids(self) -> List[str]:
+        return sorted(self.tasks)
+
+    def get_task_stats(self, task_id: str) -> BSESessionStats:
+        return self.tasks.get(task_id, BSESessionStats())
+
+    # All tasks merged
+    def get_total_stats(self) -> BSESessionStats:
+        return merge_session_stats(self.tasks.values())
+
+    # {task id: summary of 'BSESessionStats'}
+    def summary(self, quantiles: Iterable[float] = SUMMARY_QUANTILES) -> Dict[str, Dict[str, Dict[str, dict]]]:
+        return {task_id: self.tasks[task_id].summary(quantiles) for task_id in self.get_task_ids()}
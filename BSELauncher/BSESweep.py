@@ -0,0 +1,160 @@
+import os
+import sys
+import copy
+from concurrent.futures import as_completed
+from typing import Optional, List, Dict, Tuple, Union, Iterator
+
+try:
+    from tqdm import tqdm
+except ModuleNotFoundError:
+    print("Dependency 'tqdm' is required! Please run 'python -m pip install tqdm' to install it!")
+    sys.exit(1)
+
+from .BSEConfig import Trader, TraderSpec, MarketSessionSpec
+from .BSETask import BSEMarketTask
+from .BSECache import BSEResultCache
+from .BSEDatabase import BSEResultDatabase
+from .BSEFuture import BSEFutureLauncher, BSETaskResult
+from .BSEShard import get_session_cost, select_shard
+from .utils.process import get_default_worker_size
+
+
+def _get_trader_name(trader: Union[Trader, str]) -> str:
+    return trader.value if isinstance(trader, Trader) else str(trader)
+
+
+# Enumerate every way to split 'total_amount' traders into len(traders) types, in lexicographic order
+# Same order as the nested loops in the '__main__' block of BSE.py
+def generate_trader_compositions(
+        traders: List[Union[Trader, str]],
+        total_amount: int,
+        min_amount: int = 1
+) -> Iterator[Tuple[int, ...]]:
+    if len(traders) == 0 or min_amount < 0:
+        raise ValueError(f"Composition error! Traders: {len(traders)} Min amount: {min_amount}")
+
+    def _generate(prefix: Tuple[int, ...], remain: int, types_left: int) -> Iterator[Tuple[int, ...]]:
+        if types_left == 1:
+            if remain >= min_amount:
+                yield prefix + (remain,)
+        else:
+            for amount in range(min_amount, remain - min_amount * (types_left - 1) + 1):
+                yield from _generate(prefix + (amount,), remain - amount, types_left - 1)
+
+    yield from _generate((), total_amount, len(traders))
+
+
+def get_trader_mix_task_id(sweep_id: str, traders: List[Union[Trader, str]], composition: Tuple[int, ...]) -> str:
+    amount_len = len(str(sum(composition)))
+    return "_".join([sweep_id] + [f"{_get_trader_name(t)}{n:0{amount_len}d}" for t, n in zip(traders, composition)])
+
+
+# NB: buyers and sellers use the same composition
+# With 'common_orders', all compositions get the same customer orders in their sessions, see 'BSEMarketTask'
+def build_trader_mix_tasks(
+        sweep_id: str,
+        spec: MarketSessionSpec,
+        traders: List[Union[Trader, str]],
+        total_amount: int,
+        output_dir: str,
+        min_amount: int = 1,
+        trader_args: Optional[Dict[str, dict]] = None,
+        cache: Optional[BSEResultCache] = None,
+        task_subdir: bool = False,
+        common_orders: bool = False
+) -> List[Tuple[Tuple[int, ...], BSEMarketTask]]:
+    result = []
+    for composition in generate_trader_compositions(traders, total_amount, min_amount):
+        traders_spec = [
+            TraderSpec(t, n, None if trader_args is None else trader_args.get(_get_trader_name(t), None))
+            for t, n in zip(traders, composition)
+        ]
+        task_spec = copy.copy(spec)
+        task_spec.set_sellers_and_buyers(traders_spec)
+        task_id = get_trader_mix_task_id(sweep_id, traders, composition)
+        result.append((
+            composition,
+            BSEMarketTask(task_id, task_spec, output_dir, cache, task_subdir, common_orders=common_orders)
+        ))
+    return result
+
+
+def _write_sweep_table_header(f, traders: List[str]):
+    columns = ["task_id", "sessions"]
+    columns += [f"{t}_n" for t in traders]
+    columns += [f"{t}_avg_balance" for t in traders]
+    f.write(", ".join(columns) + "\n")
+
+
+# Average of the end-of-session average balance per trader of each type
+def _write_sweep_table_row(f, traders: List[str], composition: Tuple[int, ...], task_result: BSETaskResult):
+    summaries = [s.summary for s in task_result.sessions if s.summary is not None]
+    columns = [task_result.task_id, str(len(summaries))]
+    columns += [str(n) for n in composition]
+    for t in traders:
+        values = [s["traders"][t]["avg_balance"] for s in summaries if t in s["traders"]]
+        columns.append("%f" % (sum(values) / len(values)) if len(values) > 0 else "None")
+    f.write(", ".join(columns) + "\n")
+    f.flush()
+
+
+# Run every trader composition with all sessions in parallel
+# Rows of the aggregated table are written as soon as each composition finishes, so they are not in order
+# With 'shard=(i, n)', only the i-th of n cost-balanced parts of the compositions is run
+# With 'database', outputs of the sessions of each composition are added to it when the composition finishes
+# With 'common_orders', the sessions with the same index of all compositions get the same customer orders
+# Return the path of the aggregated table
+def launch_trader_mix_sweep(
+        market_session_func: callable,
+        sweep_id: str,
+        spec: MarketSessionSpec,
+        traders: List[Union[Trader, str]],
+        total_amount: int,
+        output_dir: str,
+        session_num: int = 1,
+        seed: Optional[int] = None,
+        min_amount: int = 1,
+        trader_args: Optional[Dict[str, dict]] = None,
+        cache: Optional[BSEResultCache] = None,
+        combine_avg_balances: bool = True,
+        workers: Optional[int] = None,
+        shard: Optional[Tuple[int, int]] = None,
+        task_subdir: bool = False,
+        database: Optional[BSEResultDatabase] = None,
+        common_orders: bool = False
+) -> str:
+    if session_num < 1:
+        raise ValueError
+    trader_names = [_get_trader_name(t) for t in traders]
+    compositions_tasks = build_trader_mix_tasks(
+        sweep_id, spec, traders, total_amount, output_dir, min_amount, trader_args, cache, task_subdir, common_orders
+    )
+    if shard is not None:
+        shard_task_ids = select_shard(
+            [(task.task_id, get_session_cost(task.spec)) for _, task in compositions_tasks],
+            shard
+        )
+        compositions_tasks = [(c, task) for c, task in compositions_tasks if task.task_id in shard_task_ids]
+    os.makedirs(output_dir, exist_ok=True)
+    table_path = os.path.join(output_dir, f"{sweep_id}_sweep.csv")
+    workers = get_default_worker_size(len(compositions_tasks) * session_num, workers)
+    with open(table_path, mode="w", encoding="utf-8") as f:
+        _write_sweep_table_header(f, trader_names)
+        with tqdm(total=len(compositions_tasks)) as pbar:
+            with BSEFutureLauncher(market_session_func, workers) as launcher:
+                future_compositions = {
+                    launcher.submit_task(task, session_num, combine_avg_balances, seed): composition
+                    for composition, task in compositions_tasks
+                }
+                for future in as_completed(future_compositions):
+                    task_result = future.result()
+                    _write_sweep_table_row(f, trader_names, future_compositions[future], task_result)
+                    if database is not None:
+                        for session in task_result.sessions:
+                            database.add_session(
+                                task_result.task_id, session.session_id, session.session_index, task_result.output_dir
+                            )
+                    pbar.update()
+    if database is not None:
+        database.flush()
+    return table_path
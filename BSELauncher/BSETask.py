@@ -1,28 +1,80 @@
+import io
 import os
+import copy
 import json
 import random
-from typing import Optional, TextIO, List
+import functools
+import traceback
+from typing import Optional, TextIO, List, Dict, Iterable, Tuple
 from multiprocessing import Pool
 
-from .BSEConfig import MarketSessionSpec
+from .BSEConfig import MarketSessionSpec, SessionOutputs
 from .BSEInterface import _call_market_session_func
-from .utils.process import raise_process_error
-from .utils import combine_session_avg_balance_csv_files
+from .BSECache import BSEResultCache
+from .BSEStats import BSESessionStats, SessionStatsSink
+from .BSEFailure import BSESessionFailure
+from .utils.process import raise_process_error, get_session_seed, get_session_order_seed
+from .utils.files import read_avg_balance_csv_sessions, is_avg_balance_session_finished, AvgBalanceCombiner
+from .utils.files import get_task_output_dir, append_session_manifest, reset_task_manifest, stage_session_outputs
+from .utils.files import read_task_manifest
+from .utils.files import get_session_stats_path, get_session_checkpoint_path, remove_task_checkpoints
+from .utils.columns import AvgBalanceColumnWriter, AvgBalanceColumnAppender, get_avg_balance_columns_dir
+from .utils.columns import get_spec_trader_types
 
 BSE_MARKET_TASK_CONFIG_VERSION = 1
 
 
+def _get_session_file_index(csv_path: str) -> int:
+    f_name = os.path.basename(csv_path)
+    return int(f_name[f_name.rindex("_S") + 2:f_name.rindex("_avg_balance")])
+
+
 class BSEMarketTask:
 
     def __init__(
             self,
             task_id: str,
             spec: MarketSessionSpec,
-            output_dir: Optional[str] = None
+            output_dir: Optional[str] = None,
+            cache: Optional[BSEResultCache] = None,
+            task_subdir: bool = False,
+            avg_balance_columns: bool = False,
+            outputs: Optional[SessionOutputs] = None,
+            scratch_dir: Optional[str] = None,
+            common_orders: bool = False,
+            checkpoint_interval: Optional[float] = None
     ):
         self.task_id: str = task_id
         self.spec: MarketSessionSpec = spec
+        # With 'task_subdir', all outputs of the task are in 'output_dir/task_id'
         self.output_dir: Optional[str] = output_dir
+        if output_dir is not None:
+            self.output_dir = get_task_output_dir(output_dir, task_id, task_subdir)
+        # Also write avg_balance rows into binary column files, see 'AvgBalanceColumnWriter'
+        self.avg_balance_columns: bool = avg_balance_columns
+        # Overrides the outputs of the spec, it is recorded in the market params of the task config
+        self.outputs: Optional[SessionOutputs] = outputs
+        # Only sessions launched with a seed are cached
+        self.cache: Optional[BSEResultCache] = cache
+        # Sessions write into a local dir in it, e.g. '/dev/shm', and their outputs are moved into 'output_dir'
+        # when complete, see 'stage_session_outputs'
+        self.scratch_dir: Optional[str] = scratch_dir
+        # Customer orders of each session come from their own random stream, seeded only by the seed and the session
+        # index, so tasks launched with the same seed can be compared session by session (common random numbers)
+        # Requires a seed
+        self.common_orders: bool = common_orders
+        # Sessions with their own avg_balance file are checkpointed every 'checkpoint_interval' simulated seconds,
+        # a session which didn't end resumes from its checkpoint when it is launched again, e.g. by a retry or
+        # by resuming the task, see 'market_session'
+        # Checkpoints are kept next to the outputs, so with 'scratch_dir' they are lost with a failed session
+        if checkpoint_interval is not None:
+            if checkpoint_interval <= 0:
+                raise ValueError(f"Checkpoint interval must be positive! Value: {checkpoint_interval}")
+            if cache is not None or avg_balance_columns:
+                raise ValueError("Checkpoints can't be used with a cache or avg_balance columns!")
+            if outputs is not None and outputs.compression is not None:
+                raise ValueError(f"Compressed outputs can't be checkpointed! Value: {outputs.compression}")
+        self.checkpoint_interval: Optional[float] = checkpoint_interval
 
     def _prepare_output_dir(self):
         if self.output_dir is not None:
@@ -31,15 +83,124 @@ class BSEMarketTask:
             elif not os.path.isdir(self.output_dir):
                 raise FileExistsError(f"A file with the same name already exists! '{self.output_dir}'")
 
-    def _launch(self, market_session_func: callable, session_id: str, spec_dict: dict, dump_f: TextIO):
+    def _build_market_params(self) -> dict:
+        market_params = self.spec.build()
+        if self.outputs is not None:
+            market_params["outputs"] = self.outputs.build()
+        return market_params
+
+    # Finished sessions are listed in the manifest, so their outputs can be found without scanning the output dir
+    def _add_session_to_manifest(self, session_index: int, session_id: str):
+        append_session_manifest(self.output_dir, self.task_id, session_id, session_index)
+
+    # Without resume, sessions start over, so checkpoints of sessions which didn't end are removed too
+    def _reset_manifest(self, resume: bool):
+        if not resume:
+            reset_task_manifest(self.output_dir, self.task_id)
+            remove_task_checkpoints(self.output_dir, self.task_id)
+
+    def _call(
+            self,
+            market_session_func: callable,
+            session_id: str,
+            spec_dict: dict,
+            dump_f: TextIO,
+            sink=None,
+            order_rng: Optional[random.Random] = None,
+            checkpoint_file: Optional[str] = None
+    ):
         _call_market_session_func(
             market_session_func=market_session_func,
             session_id=session_id,
             spec_dict=spec_dict,
             avg_balance_file=dump_f,
-            output_dir=self.output_dir
+            output_dir=self.output_dir,
+            sink=sink,
+            order_rng=order_rng,
+            checkpoint_file=checkpoint_file,
+            checkpoint_interval=self.checkpoint_interval
         )
 
+    def _get_order_rng(self, seed: Optional[int], session_index: int) -> Optional[random.Random]:
+        if not self.common_orders:
+            return None
+        return random.Random(get_session_order_seed(seed, session_index))
+
+    # Copy of this task writing into another output dir
+    def _with_output_dir(self, output_dir: str) -> "BSEMarketTask":
+        if output_dir == self.output_dir:
+            return self
+        task = copy.copy(self)
+        task.output_dir = output_dir
+        return task
+
+    def _launch(
+            self,
+            market_session_func: callable,
+            session_index: int,
+            session_id: str,
+            spec_dict: dict,
+            dump_f: TextIO,
+            seed: Optional[int] = None,
+            session_stats: bool = False,
+            checkpoint_file: Optional[str] = None
+    ) -> Optional[BSESessionStats]:
+        if self.avg_balance_columns:
+            columns_dir = get_avg_balance_columns_dir(self.output_dir, session_id)
+            with AvgBalanceColumnWriter(dump_f, columns_dir, get_spec_trader_types(spec_dict)) as column_writer:
+                return self._launch_session(
+                    market_session_func, session_index, session_id, spec_dict, column_writer, seed, session_stats
+                )
+        else:
+            return self._launch_session(
+                market_session_func, session_index, session_id, spec_dict, dump_f, seed, session_stats,
+                checkpoint_file
+            )
+
+    def _launch_session(
+            self,
+            market_session_func: callable,
+            session_index: int,
+            session_id: str,
+            spec_dict: dict,
+            dump_f: TextIO,
+            seed: Optional[int] = None,
+            session_stats: bool = False,
+            checkpoint_file: Optional[str] = None
+    ) -> Optional[BSESessionStats]:
+        session_seed = get_session_seed(seed, session_index)
+        if session_seed is not None:
+            random.seed(session_seed)
+        # With 'session_stats', the stats of the session are computed by a sink and saved as one of its outputs
+        stats = BSESessionStats() if session_stats else None
+        sink = None if stats is None else SessionStatsSink(stats)
+        stats_path = get_session_stats_path(self.output_dir, session_id)
+        order_rng = self._get_order_rng(seed, session_index)
+        if self.cache is None or seed is None:
+            self._call(market_session_func, session_id, spec_dict, dump_f, sink, order_rng, checkpoint_file)
+        else:
+            # Entries with stats are cached separately, as only they have the stats file
+            # Sessions with common orders get other results, so they are cached separately too
+            key_spec_dict = spec_dict
+            if stats is not None:
+                key_spec_dict = {**key_spec_dict, "session_stats": True}
+            if self.common_orders:
+                key_spec_dict = {**key_spec_dict, "common_orders": True}
+            cache_key = self.cache.get_session_key(market_session_func, key_spec_dict, seed, session_index)
+            if self.cache.restore(cache_key, session_id, self.output_dir, dump_f):
+                return None if stats is None else BSESessionStats.load(stats_path)
+            with io.StringIO() as buffer:
+                self._call(market_session_func, session_id, spec_dict, buffer, sink, order_rng)
+                avg_balance = buffer.getvalue()
+            dump_f.write(avg_balance)
+            if stats is not None:
+                stats.save(stats_path)
+            self.cache.store(cache_key, session_id, self.output_dir, avg_balance)
+            return stats
+        if stats is not None:
+            stats.save(stats_path)
+        return stats
+
     def _generate_session_ids(self, session_num: int) -> List[str]:
         session_index_len = len(str(session_num - 1))
         return [f"{self.task_id}_S{i:0{session_index_len}d}" for i in range(session_num)]
@@ -48,82 +209,283 @@ class BSEMarketTask:
         return os.path.join(self.output_dir, f"{prefix}_avg_balance.csv")
 
     # Use seeds to ensure reproducible results
+    # Each session is seeded separately, so the same session always gets the same result no matter how it is launched
+    # With 'resume', only the sessions without a finished output in the saved task config will be run
+    # With 'session_stats', return the merged stats of the sessions, resumed sessions are read from their stats file
+    # Resumed sessions without a stats file are run again
     def launch(
             self,
             market_session_func: callable,
             session_num: int = 1,
             seed: Optional[int] = None,
-            combine_avg_balances: bool = True
-    ):
+            combine_avg_balances: bool = True,
+            resume: bool = False,
+            session_stats: bool = False
+    ) -> Optional[BSESessionStats]:
         if session_num <= 0:
             raise ValueError("n <= 0")
-        market_params = self.spec.build()
+        market_params = self._build_market_params()
         self._prepare_output_dir()
-        if seed is not None:
-            random.seed(seed)
         session_ids = self._generate_session_ids(session_num)
         if combine_avg_balances:
             csv_paths = [self._generate_avg_balance_path(self.task_id)]
         else:
             csv_paths = [self._generate_avg_balance_path(session_id) for session_id in session_ids]
+        finished_sessions = {}
+        if resume:
+            seed = self._load_resume_seed(market_params, session_ids, seed)
+            finished_sessions = self._get_finished_sessions(csv_paths, market_params["endtime"])
+            if session_stats:
+                finished_sessions = self._get_sessions_with_stats(finished_sessions)
         self._save_task_config(session_num, market_params, session_ids, csv_paths, seed)
+        self._reset_manifest(resume)
+        stats = BSESessionStats() if session_stats else None
+
+        def _add_stats(session_result: Optional[BSESessionStats]):
+            if stats is not None and session_result is not None:
+                stats.merge(session_result)
+
         if combine_avg_balances:
-            with open(csv_paths[0], mode="w", encoding="utf-8") as f:
+            # Finished sessions are copied from the old file, so it is replaced only after the sessions stopped
+            # It is replaced on a failure too, so the sessions finished in this run are kept when resumed again
+            temp_path = f"{csv_paths[0]}.tmp" if len(finished_sessions) > 0 else csv_paths[0]
+            try:
+                with open(temp_path, mode="w", encoding="utf-8") as f:
+                    for i, session_id in enumerate(session_ids):
+                        if session_id in finished_sessions:
+                            f.writelines(finished_sessions[session_id])
+                            if stats is not None:
+                                _add_stats(BSESessionStats.load(get_session_stats_path(self.output_dir, session_id)))
+                        else:
+                            # Only the outputs besides the combined avg_balance file are staged
+                            with stage_session_outputs(self.output_dir, self.scratch_dir, session_id) as output_dir:
+                                _add_stats(self._with_output_dir(output_dir)._launch(
+                                    market_session_func, i, session_id, market_params, f, seed, session_stats
+                                ))
+                            self._add_session_to_manifest(i, session_id)
+            finally:
+                if temp_path != csv_paths[0]:
+                    os.replace(temp_path, csv_paths[0])
+            if self.avg_balance_columns:
+                column_appender = AvgBalanceColumnAppender(get_avg_balance_columns_dir(self.output_dir, self.task_id))
                 for session_id in session_ids:
-                    self._launch(market_session_func, session_id, market_params, f)
+                    column_appender.append(get_avg_balance_columns_dir(self.output_dir, session_id))
+                column_appender.close()
         else:
-            for session_id, csv_path in zip(session_ids, csv_paths):
-                with open(csv_path, mode="w", encoding="utf-8") as f:
-                    self._launch(market_session_func, session_id, market_params, f)
+            for i, (session_id, csv_path) in enumerate(zip(session_ids, csv_paths)):
+                if session_id not in finished_sessions:
+                    _add_stats(self._launch_in_parallel(
+                        market_session_func, i, session_id, market_params, csv_path, seed, session_stats
+                    ))
+                    self._add_session_to_manifest(i, session_id)
+                elif stats is not None:
+                    _add_stats(BSESessionStats.load(get_session_stats_path(self.output_dir, session_id)))
+        return stats
 
     def _launch_in_parallel(
             self,
             market_session_func: callable,
+            session_index: int,
             session_id: str,
             spec_dict: dict,
-            dump_file_path: str
-    ):
-        with open(dump_file_path, mode="w", encoding="utf-8") as f:
-            self._launch(market_session_func, session_id, spec_dict, f)
+            dump_file_path: str,
+            seed: Optional[int] = None,
+            session_stats: bool = False
+    ) -> Optional[BSESessionStats]:
+        with stage_session_outputs(self.output_dir, self.scratch_dir, session_id) as output_dir:
+            if output_dir != self.output_dir:
+                dump_file_path = os.path.join(output_dir, os.path.basename(dump_file_path))
+            task = self._with_output_dir(output_dir)
+            checkpoint_file = None
+            if self.checkpoint_interval is not None:
+                checkpoint_file = get_session_checkpoint_path(output_dir, session_id)
+            # A session resumed from its checkpoint cuts its avg_balance file back to the checkpoint itself
+            mode = "a" if checkpoint_file is not None and os.path.isfile(checkpoint_file) else "w"
+            with open(dump_file_path, mode=mode, encoding="utf-8") as f:
+                return task._launch(
+                    market_session_func, session_index, session_id, spec_dict, f, seed, session_stats, checkpoint_file
+                )
 
-    # Running in parallel can speed things up, but using the specified seed results in exactly the same output
-    # So here you can't set the random seed but use the default
+    # Save the task config of the sessions to be launched in a pool
+    # Return market params, seed, sessions to run as (index, session_id, csv_path)
+    # and the csv paths of finished sessions
+    def _prepare_pool_sessions(
+            self,
+            session_num: int,
+            seed: Optional[int] = None,
+            resume: bool = False,
+            session_indices: Optional[Iterable[int]] = None,
+            session_stats: bool = False
+    ) -> Tuple[dict, Optional[int], List[Tuple[int, str, str]], List[str]]:
+        if session_num <= 0:
+            raise ValueError("n <= 0")
+        market_params = self._build_market_params()
+        session_ids = self._generate_session_ids(session_num)
+        if session_indices is None:
+            session_indices = list(range(session_num))
+        else:
+            session_indices = sorted(session_indices)
+            session_ids = [session_ids[i] for i in session_indices]
+        if len(session_ids) == 0:
+            return market_params, seed, [], []
+        self._prepare_output_dir()
+        csv_paths = [self._generate_avg_balance_path(session_id) for session_id in session_ids]
+        finished_sessions = {}
+        if resume:
+            seed = self._load_resume_seed(market_params, session_ids, seed)
+            finished_sessions = self._get_finished_sessions(csv_paths, market_params["endtime"])
+            if session_stats:
+                finished_sessions = self._get_sessions_with_stats(finished_sessions)
+        self._save_task_config(session_num, market_params, session_ids, csv_paths, seed)
+        self._reset_manifest(resume)
+        sessions = [
+            (i, session_id, csv_path)
+            for i, session_id, csv_path in zip(session_indices, session_ids, csv_paths)
+            if session_id not in finished_sessions
+        ]
+        finished_files = [
+            csv_path for session_id, csv_path in zip(session_ids, csv_paths) if session_id in finished_sessions
+        ]
+        return market_params, seed, sessions, finished_files
+
+    # Running in parallel can speed things up
+    # Sessions are seeded separately, so the results are the same as 'launch' with the same seed
+    # 'session_indices' selects a part of the sessions, e.g. the share of this machine when sharding
+    # avg_balance files are combined in order while the sessions finish
+    # With 'delete_session_avg_balances', the avg_balance file of each session is deleted after combined
+    # A failed session is attempted up to 'retries' more times, a session which still fails is left out of the
+    # combined file and appended to 'failures' as a 'BSESessionFailure'
+    # NB: a worker which crashes hard, e.g. killed by the OOM killer, loses its session without an error,
+    # use 'launch_tasks_sessions_in_parallel' to detect that
     def launch_in_pool(
             self,
             market_session_func: callable,
             session_num: int,
             pool: Pool,
             combine_avg_balances: bool = True,
-            task_complete_callback: Optional[callable] = None
+            task_complete_callback: Optional[callable] = None,
+            seed: Optional[int] = None,
+            resume: bool = False,
+            session_indices: Optional[Iterable[int]] = None,
+            delete_session_avg_balances: bool = False,
+            retries: int = 0,
+            failures: Optional[List[BSESessionFailure]] = None
     ):
-        task_counter = 0
+        market_params, seed, sessions, finished_files = self._prepare_pool_sessions(
+            session_num, seed, resume, session_indices
+        )
+        combiner = None
+        if combine_avg_balances and len(sessions) + len(finished_files) > 0:
+            combiner = AvgBalanceCombiner(
+                self.output_dir,
+                self.task_id,
+                sorted(finished_files + [csv_path for _, _, csv_path in sessions], key=_get_session_file_index),
+                delete_session_avg_balances
+            )
 
-        def _task_complete_handler(_):
-            nonlocal task_counter
-            task_counter += 1
+        # Callbacks of a pool run in its result handler thread one by one
+        def _task_complete_handler(csv_path: str):
             if task_complete_callback is not None:
                 task_complete_callback()
-            if task_counter == session_num and combine_avg_balances:
-                combine_session_avg_balance_csv_files(
-                    output_dir=self.output_dir,
-                    task_id=self.task_id
-                )
+            if combiner is not None:
+                combiner.finish(csv_path)
 
-        if session_num <= 0:
-            raise ValueError("n <= 0")
-        market_params = self.spec.build()
-        self._prepare_output_dir()
-        session_ids = self._generate_session_ids(session_num)
-        csv_paths = [self._generate_avg_balance_path(session_id) for session_id in session_ids]
-        self._save_task_config(session_num, market_params, session_ids, csv_paths)
-        for session_id, csv_path in zip(session_ids, csv_paths):
+        def _session_complete_handler(session_index: int, session_id: str, csv_path: str, _):
+            self._add_session_to_manifest(session_index, session_id)
+            _task_complete_handler(csv_path)
+
+        def _task_error_handler(session_index: int, session_id: str, csv_path: str, ex):
+            raise_process_error(ex)
+            if failures is not None:
+                failures.append(BSESessionFailure(
+                    self.task_id, session_id, session_index, retries + 1, "".join(traceback.format_exception(ex))
+                ))
+            _task_complete_handler(csv_path)
+
+        for csv_path in finished_files:
+            _task_complete_handler(csv_path)
+        for i, session_id, csv_path in sessions:
             pool.apply_async(
-                self._launch_in_parallel,
-                args=(market_session_func, session_id, market_params, csv_path,),
-                callback=_task_complete_handler,
-                error_callback=raise_process_error
+                self._launch_with_retries,
+                args=(market_session_func, i, session_id, market_params, csv_path, seed, retries,),
+                callback=functools.partial(_session_complete_handler, i, session_id, csv_path),
+                error_callback=functools.partial(_task_error_handler, i, session_id, csv_path)
             )
 
+    # A failed attempt is run again in the same worker, each attempt starts the session over with the same seed
+    def _launch_with_retries(
+            self,
+            market_session_func: callable,
+            session_index: int,
+            session_id: str,
+            spec_dict: dict,
+            dump_file_path: str,
+            seed: Optional[int],
+            retries: int
+    ):
+        for attempt in range(retries + 1):
+            try:
+                return self._launch_in_parallel(
+                    market_session_func, session_index, session_id, spec_dict, dump_file_path, seed
+                )
+            except Exception:  # pylint: disable=broad-except
+                if attempt == retries:
+                    raise
+
+    # Sessions of 'launch' not listed in the manifest as (session_index, session_id)
+    def _get_unfinished_sessions(self, session_num: int) -> List[Tuple[int, str]]:
+        finished_sessions = read_task_manifest(self.output_dir, self.task_id) or {}
+        return [
+            (i, session_id) for i, session_id in enumerate(self._generate_session_ids(session_num))
+            if session_id not in finished_sessions
+        ]
+
+    def _get_task_config_path(self) -> str:
+        return os.path.join(self.output_dir, f"{self.task_id}.json")
+
+    # Resumed sessions must use the same seed as before, otherwise the results are not reproducible
+    def _load_resume_seed(self, market_params: dict, session_ids: List[str], seed: Optional[int]) -> Optional[int]:
+        config_path = self._get_task_config_path()
+        if not os.path.isfile(config_path):
+            return seed
+        with open(config_path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        # The sessions may be more or fewer of the same sessions, e.g. in the rounds of 'launch_successive_halving'
+        config_session_ids, session_ids = set(config["session_ids"]), set(session_ids)
+        if not (config_session_ids <= session_ids or session_ids <= config_session_ids) or \
+                config["market_params"] != json.loads(json.dumps(market_params)):
+            raise ValueError(f"Task config doesn't match the task! Can't resume from '{config_path}'")
+        if seed is not None and seed != config["seed"]:
+            raise ValueError(f"Seed doesn't match the task config! Value: {seed} Config: {config['seed']}")
+        return config["seed"]
+
+    # Rows of the sessions whose end-of-session 'trade_stats' row has been written
+    @staticmethod
+    def _get_finished_sessions(csv_paths: List[str], end_time: int) -> Dict[str, List[str]]:
+        result = {}
+        for csv_path in csv_paths:
+            for session_id, rows in read_avg_balance_csv_sessions(csv_path).items():
+                if is_avg_balance_session_finished(rows, end_time):
+                    result[session_id] = rows
+        return result
+
+    # Finished sessions without a stats file, e.g. run before 'session_stats' was used, are left out to run again,
+    # so the merged stats of a resumed task cover all of its sessions
+    def _get_sessions_with_stats(self, finished_sessions: Dict[str, List[str]]) -> Dict[str, List[str]]:
+        return {
+            session_id: rows for session_id, rows in finished_sessions.items()
+            if os.path.isfile(get_session_stats_path(self.output_dir, session_id))
+        }
+
+    # Why the launch of the task stopped, see 'BSEStopRule'
+    def _save_stop_reason(self, stop: dict):
+        config_path = self._get_task_config_path()
+        with open(config_path, "r", encoding="utf-8") as f:
+            task_config = json.load(f)
+        task_config["stop"] = stop
+        with open(config_path, "w", encoding="utf-8") as f:
+            json.dump(task_config, f, ensure_ascii=False)
+
     def _save_task_config(
             self,
             session_num: int,
@@ -132,6 +494,9 @@ class BSEMarketTask:
             dump_avg_balance: List[str],
             seed: Optional[int] = None
     ):
+        # Every launch saves the task config first, so it checks the seed for all of them
+        if self.common_orders and seed is None:
+            raise ValueError(f"'common_orders' requires a seed! Task: {self.task_id}")
         task_config = {
             "version": BSE_MARKET_TASK_CONFIG_VERSION,
             "task_id": self.task_id,
@@ -139,9 +504,9 @@ class BSEMarketTask:
             "session_ids": session_ids,
             "market_params": market_params,
             "seed": seed,
+            "common_orders": self.common_orders,
             "output_dir": self.output_dir,
             "dump_avg_balance": dump_avg_balance
         }
-        config_path = os.path.join(self.output_dir, f"{self.task_id}.json")
-        with open(config_path, "w", encoding="utf-8") as f:
+        with open(self._get_task_config_path(), "w", encoding="utf-8") as f:
             json.dump(task_config, f, ensure_ascii=False)
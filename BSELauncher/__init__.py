@@ -1,4 +1,15 @@
 from .BSEConfig import Trader, StepMode, TimeMode, TraderSpec, PriceStrategy, OrderStrategy, OrderSpec, MarketSessionSpec
+from .BSEConfig import AvgBalanceMode, Compression, SessionOutputs
 from .BSEInterface import launch_market_session
 from .BSELauncher import launch_tasks_in_parallel, launch_tasks_sessions_in_parallel
+from .BSECache import BSEResultCache
+from .BSEDatabase import BSEResultDatabase
+from .BSEStats import RunningStats, QuantileSketch, BSESessionStats, BSEStatsCollector, BSEStopRule
+from .BSEStats import merge_session_stats
 from .BSETask import BSEMarketTask
+from .BSEFailure import BSESessionFailure
+from .BSEFuture import BSESessionResult, BSETaskResult, BSETaskFuture, BSEFutureLauncher, launch_tasks_sessions_async
+from .BSEShard import split_into_shards, select_shard, merge_task_shards, merge_shards, merge_sweep_tables
+from .BSESweep import generate_trader_compositions, build_trader_mix_tasks, launch_trader_mix_sweep
+from .BSESearch import launch_successive_halving
+from .BSECluster import run_cluster_worker, start_local_cluster_workers, launch_tasks_sessions_on_cluster
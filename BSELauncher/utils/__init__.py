@@ -1,4 +1,4 @@
-from .files import get_task_config_files
+from .files import get_task_config_files, get_task_output_dir, read_task_manifest
 from .files import get_session_avg_balance_csv_files, get_session_lob_frames_csv_files, get_session_strategies_csv_files
 from .files import combine_session_avg_balance_csv_files
 from .progress import show_seconds_progress, show_seconds_progress_by_config, show_seconds_progress_by_avg_balance
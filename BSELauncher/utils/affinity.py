@@ -0,0 +1,109 @@
+import os
+import glob
+import multiprocessing
+from typing import List, Set, Optional
+
+_SYS_CPU_DIR = "/sys/devices/system/cpu"
+_SYS_NODE_DIR = "/sys/devices/system/node"
+
+
+# Parse a kernel cpu list, e.g. '0-3,8-11'
+def _parse_cpu_list(text: str) -> List[int]:
+    result = []
+    for part in text.strip().split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            result += list(range(int(start), int(end) + 1))
+        elif len(part) > 0:
+            result.append(int(part))
+    return result
+
+
+def _read_cpu_list(file_path: str) -> Optional[List[int]]:
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            return _parse_cpu_list(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def is_cpu_affinity_supported() -> bool:
+    return hasattr(os, "sched_setaffinity") and hasattr(os, "sched_getaffinity")
+
+
+def get_allowed_cpus() -> Set[int]:
+    if is_cpu_affinity_supported():
+        return os.sched_getaffinity(0)
+    else:
+        return set(range(os.cpu_count() or 1))
+
+
+# CPUs of each NUMA node, all allowed CPUs are regarded as one node if the topology is unknown
+def get_numa_nodes(allowed_cpus: Optional[Set[int]] = None) -> List[List[int]]:
+    if allowed_cpus is None:
+        allowed_cpus = get_allowed_cpus()
+    nodes = []
+    node_dirs = glob.glob(os.path.join(_SYS_NODE_DIR, "node[0-9]*"))
+    for node_dir in sorted(node_dirs, key=lambda x: int(os.path.basename(x)[4:])):
+        cpus = _read_cpu_list(os.path.join(node_dir, "cpulist"))
+        if cpus is not None:
+            cpus = [i for i in cpus if i in allowed_cpus]
+            if len(cpus) > 0:
+                nodes.append(cpus)
+    if len(nodes) == 0:
+        nodes = [sorted(allowed_cpus)]
+    return nodes
+
+
+# Keep the first CPU of every physical core and skip its SMT siblings
+def get_physical_core_cpus(cpus: List[int]) -> List[int]:
+    result = []
+    seen_siblings = set()
+    for cpu in cpus:
+        siblings = _read_cpu_list(os.path.join(_SYS_CPU_DIR, f"cpu{cpu}", "topology", "thread_siblings_list"))
+        key = cpu if siblings is None else min(siblings)
+        if key not in seen_siblings:
+            seen_siblings.add(key)
+            result.append(cpu)
+    return result
+
+
+# CPUs for workers in placement order, the CPUs of one NUMA node are used before the next node
+def get_worker_cpus(physical_cores_only: bool = False) -> List[int]:
+    result = []
+    for node_cpus in get_numa_nodes():
+        result += get_physical_core_cpus(node_cpus) if physical_cores_only else node_cpus
+    return result
+
+
+# One CPU for each worker, CPUs are shared only if there are more workers than CPUs
+def assign_worker_cpus(workers: int, physical_cores_only: bool = False) -> List[int]:
+    if not is_cpu_affinity_supported():
+        raise OSError("CPU affinity is only supported on Linux!")
+    cpus = get_worker_cpus(physical_cores_only)
+    return [cpus[i % len(cpus)] for i in range(workers)]
+
+
+def _is_pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Shared slots of pids, so a respawned worker takes over the CPU of the worker it replaces
+def create_cpu_slots(cpus: List[int]):
+    return multiprocessing.Array("i", len(cpus))
+
+
+# Pool initializer, pin the worker to a free CPU of 'cpus'
+def pin_worker_to_cpu(cpus: List[int], cpu_slots):
+    with cpu_slots.get_lock():
+        for i, pid in enumerate(cpu_slots):
+            if pid == 0 or not _is_pid_alive(pid):
+                cpu_slots[i] = os.getpid()
+                os.sched_setaffinity(0, {cpus[i]})
+                return
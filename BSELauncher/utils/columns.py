@@ -0,0 +1,176 @@
+import os
+import json
+import shutil
+import struct
+from typing import Optional, List, Dict, TextIO, Tuple, Set
+
+from .files import parse_avg_balance_line, _append_file
+
+try:
+    import numpy
+except ModuleNotFoundError:
+    # Only required to load the columns
+    numpy = None
+
+AVG_BALANCE_COLUMNS_VERSION = 1
+
+_SCHEMA_FILE = "schema.json"
+_NONE_PRICE = -1
+
+# (numpy dtype, struct format), all little-endian
+_INT32 = ("<i4", "<i")
+_INT64 = ("<i8", "<q")
+_FLOAT64 = ("<f8", "<d")
+
+
+def get_avg_balance_columns_dir(output_dir: str, prefix: str) -> str:
+    return os.path.join(output_dir, f"{prefix}_avg_balance_columns")
+
+
+# Trader types of a market session in sorted order, every type has the same columns in every row
+def get_spec_trader_types(spec_dict: dict) -> List[str]:
+    trader_spec = spec_dict["trader_spec"]
+    return sorted(set(t[0] for t in trader_spec["sellers"] + trader_spec["buyers"]))
+
+
+def _get_columns(trader_types: List[str]) -> List[Tuple[str, Tuple[str, str]]]:
+    columns = [("session", _INT32), ("time", _INT32), ("best_bid", _INT32), ("best_ask", _INT32)]
+    for t in trader_types:
+        columns += [(f"{t}_sum", _INT64), (f"{t}_n", _INT32), (f"{t}_avg", _FLOAT64)]
+    return columns
+
+
+def _session_index(session_id: str) -> int:
+    return int(session_id[session_id.rindex("_S") + 2:])
+
+
+# Text file adapter for 'avg_bals' of 'market_session', every written row also goes to one binary file per column
+# 'None' prices are stored as -1, missing trader types as 0 with a NaN average
+class AvgBalanceColumnWriter:
+
+    def __init__(self, f: TextIO, columns_dir: str, trader_types: List[str]):
+        self.f: TextIO = f
+        self.columns_dir: str = columns_dir
+        self.trader_types: List[str] = trader_types
+        self._columns = _get_columns(trader_types)
+        self._line: str = ""
+        if os.path.isdir(columns_dir):
+            shutil.rmtree(columns_dir)
+        os.makedirs(columns_dir)
+        with open(os.path.join(columns_dir, _SCHEMA_FILE), "w", encoding="utf-8") as schema_f:
+            json.dump(
+                {
+                    "version": AVG_BALANCE_COLUMNS_VERSION,
+                    "trader_types": trader_types,
+                    "columns": [[name, dtype] for name, (dtype, _) in self._columns]
+                },
+                schema_f
+            )
+        self._column_files = [open(os.path.join(columns_dir, f"{name}.bin"), "wb") for name, _ in self._columns]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _write_row(self, line: str):
+        row = parse_avg_balance_line(line)
+        if row is None:
+            return
+        values = [
+            _session_index(row["session_id"]),
+            row["time"],
+            _NONE_PRICE if row["best_bid"] is None else row["best_bid"],
+            _NONE_PRICE if row["best_ask"] is None else row["best_ask"]
+        ]
+        for t in self.trader_types:
+            stats = row["traders"].get(t, None)
+            values += [0, 0, float("nan")] if stats is None else [stats["balance_sum"], stats["n"], stats["avg_balance"]]
+        for column_f, (_, (_, fmt)), value in zip(self._column_files, self._columns, values):
+            column_f.write(struct.pack(fmt, value))
+
+    # 'trade_stats' writes a row in pieces, so a row is parsed once its line break is written
+    def write(self, s: str) -> int:
+        self.f.write(s)
+        self._line += s
+        while "\n" in self._line:
+            line, self._line = self._line.split("\n", 1)
+            self._write_row(line)
+        return len(s)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        self.f.flush()
+        for column_f in self._column_files:
+            column_f.flush()
+
+    def close(self):
+        for column_f in self._column_files:
+            column_f.close()
+        self._column_files = []
+
+
+# Append the column files of sessions to the column files of a task, without reading them into memory
+# Column files are only open while a session is appended, so they don't hold file descriptors between sessions
+class AvgBalanceColumnAppender:
+
+    def __init__(self, columns_dir: str):
+        self.columns_dir: str = columns_dir
+        # Names of the column files created so far, None before the first session
+        self._created: Optional[Set[str]] = None
+        if os.path.isdir(columns_dir):
+            shutil.rmtree(columns_dir)
+
+    def append(self, session_columns_dir: str, delete: bool = False):
+        if not os.path.isfile(os.path.join(session_columns_dir, _SCHEMA_FILE)):
+            return
+        if self._created is None:
+            os.makedirs(self.columns_dir)
+            shutil.copyfile(
+                os.path.join(session_columns_dir, _SCHEMA_FILE), os.path.join(self.columns_dir, _SCHEMA_FILE)
+            )
+            self._created = set()
+        for f_name in os.listdir(session_columns_dir):
+            if not f_name.endswith(".bin"):
+                continue
+            flags = os.O_WRONLY if f_name in self._created else os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+            # Not O_APPEND, as copy_file_range doesn't support it
+            fd = os.open(os.path.join(self.columns_dir, f_name), flags, 0o666)
+            try:
+                os.lseek(fd, 0, os.SEEK_END)
+                _append_file(os.path.join(session_columns_dir, f_name), fd)
+            finally:
+                os.close(fd)
+            self._created.add(f_name)
+        if delete:
+            shutil.rmtree(session_columns_dir)
+
+    # Nothing is open between sessions, kept for the callers which close it when all sessions are appended
+    def close(self):
+        pass
+
+
+# Memory-map the columns of a task or a session, the arrays share the page cache and nothing is copied
+def load_avg_balance_columns(columns_dir: str) -> Dict[str, "numpy.ndarray"]:
+    if numpy is None:
+        raise ModuleNotFoundError(
+            "Dependency 'numpy' is required! Please run 'python -m pip install numpy' to install it!"
+        )
+    with open(os.path.join(columns_dir, _SCHEMA_FILE), "r", encoding="utf-8") as f:
+        schema = json.load(f)
+    result = {}
+    for name, dtype in schema["columns"]:
+        f_path = os.path.join(columns_dir, f"{name}.bin")
+        if os.path.getsize(f_path) == 0:
+            result[name] = numpy.empty(0, dtype=dtype)
+        else:
+            result[name] = numpy.memmap(f_path, dtype=dtype, mode="r")
+    return result
+
+
+def load_task_avg_balance_columns(output_dir: str, task_id: str) -> Dict[str, "numpy.ndarray"]:
+    return load_avg_balance_columns(get_avg_balance_columns_dir(output_dir, task_id))
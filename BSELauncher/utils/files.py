@@ -1,6 +1,49 @@
 import os
 import io
-from typing import Union, Optional, Tuple, List, Iterable
+import bz2
+import gzip
+import lzma
+import json
+import errno
+import shutil
+import tempfile
+import contextlib
+import collections
+from typing import Union, Optional, Tuple, List, Dict, Iterable, TextIO
+
+SESSION_OUTPUT_SUFFIXES = {
+    "avg_balance": "_avg_balance.csv",
+    "strats": "_strats.csv",
+    "lob_frames": "_LOB_frames.csv",
+    "tape": "_tape.csv",
+    "blotters": "_blotters.csv",
+    "stats": "_stats.json"
+}
+
+SESSION_CHECKPOINT_SUFFIX = "_checkpoint.pkl"
+
+
+# Extensions of the compressed outputs of 'market_session'
+COMPRESSION_OPENERS = {
+    ".gz": gzip.open,
+    ".xz": lzma.open,
+    ".bz2": bz2.open
+}
+
+
+def get_compression_extension(file_path: str) -> str:
+    for ext in COMPRESSION_OPENERS:
+        if file_path.endswith(ext):
+            return ext
+    return ""
+
+
+# Open an output file for reading text, compressed files are decompressed while reading
+def open_output_file(file_path: str) -> TextIO:
+    ext = get_compression_extension(file_path)
+    if ext == "":
+        return open(file_path, "r", encoding="utf-8")
+    return COMPRESSION_OPENERS[ext](file_path, "rt", encoding="utf-8")
 
 
 def _all_file_exists(files_path: Iterable[str]) -> bool:
@@ -10,56 +53,292 @@ def _all_file_exists(files_path: Iterable[str]) -> bool:
     return True
 
 
-def get_task_config_files(output_dir: str, task_id: Union[str, Iterable[str]]) -> List[str]:
-    if isinstance(task_id, str):
-        task_id = [task_id]
-    result = []
-    for i in task_id:
-        f_path = os.path.join(output_dir, f"{i}.json")
-        if os.path.isfile(f_path):
-            result.append(f_path)
-    return result
+# Outputs of a task are in 'output_dir/task_id' with 'task_subdir', otherwise in 'output_dir'
+def get_task_output_dir(output_dir: str, task_id: str, task_subdir: bool = False) -> str:
+    return os.path.join(output_dir, task_id) if task_subdir else output_dir
 
 
-def _generate_task_config_files(output_dir: str, task_id: Union[str, Iterable[str]]) -> List[str]:
+def get_task_config_files(
+        output_dir: str,
+        task_id: Union[str, Iterable[str]],
+        task_subdir: bool = False
+) -> List[str]:
+    config_files = _generate_task_config_files(output_dir, task_id, task_subdir)
+    return [f_path for f_path in config_files if os.path.isfile(f_path)]
+
+
+def _generate_task_config_files(
+        output_dir: str,
+        task_id: Union[str, Iterable[str]],
+        task_subdir: bool = False
+) -> List[str]:
     if isinstance(task_id, str):
         task_id = [task_id]
-    return [os.path.join(output_dir, f"{i}.json") for i in task_id]
+    return [os.path.join(get_task_output_dir(output_dir, i, task_subdir), f"{i}.json") for i in task_id]
+
+
+def get_task_manifest_path(output_dir: str, task_id: str) -> str:
+    return os.path.join(output_dir, f"{task_id}_manifest.jsonl")
 
 
-def _get_session_csv_files(output_dir: str, task_id: str, file_end: str) -> List[Tuple[str, int]]:
+# One line per finished session, so a session can be added by appending without rewriting the manifest
+def append_session_manifest(output_dir: str, task_id: str, session_id: str, session_index: int):
+    output_files = get_session_output_files(output_dir, session_id)
+    outputs = {name: os.path.basename(f_path) for name, f_path in output_files.items()}
+    line = json.dumps({"session_id": session_id, "session_index": session_index, "outputs": outputs}) + "\n"
+    with open(get_task_manifest_path(output_dir, task_id), mode="a", encoding="utf-8") as f:
+        f.write(line)
+
+
+def reset_task_manifest(output_dir: str, task_id: str):
+    manifest_path = get_task_manifest_path(output_dir, task_id)
+    if os.path.isfile(manifest_path):
+        os.remove(manifest_path)
+
+
+# Finished sessions keyed by session id, None if the task has no manifest
+# A session listed more than once, e.g. after resuming, keeps its last line
+def read_task_manifest(output_dir: str, task_id: str) -> Optional[Dict[str, dict]]:
+    manifest_path = get_task_manifest_path(output_dir, task_id)
+    if not os.path.isfile(manifest_path):
+        return None
+    result = {}
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        for line in f:
+            # The last line may be incomplete while it is being written
+            if line.endswith("\n"):
+                session = json.loads(line)
+                result[session["session_id"]] = session
+    return result
+
+
+# Read the manifest if it exists, otherwise scan the output dir
+# NB: files deleted after the session finished, e.g. combined avg_balance files, are skipped
+def _get_session_csv_files(output_dir: str, task_id: str, output_name: str) -> List[Tuple[str, int]]:
+    manifest = read_task_manifest(output_dir, task_id)
+    if manifest is not None:
+        return [
+            (session["outputs"][output_name], session["session_index"])
+            for session in manifest.values()
+            if output_name in session["outputs"]
+            and os.path.isfile(os.path.join(output_dir, session["outputs"][output_name]))
+        ]
+    file_end = SESSION_OUTPUT_SUFFIXES[output_name]
     f_start = f"{task_id}_S"
-    return [
-        (f, int(f[len(f_start):-len(file_end)]))
-        for f in os.listdir(output_dir)
-        if f.startswith(f_start) and f.endswith(file_end)
-    ]
+    result = []
+    for f in os.listdir(output_dir):
+        ext = get_compression_extension(f)
+        f_name = f[:len(f) - len(ext)]
+        if f_name.startswith(f_start) and f_name.endswith(file_end):
+            result.append((f, int(f_name[len(f_start):-len(file_end)])))
+    return result
 
 
 def get_session_avg_balance_csv_files(output_dir: str, task_id: str) -> List[Tuple[str, int]]:
-    return _get_session_csv_files(output_dir, task_id, "_avg_balance.csv")
+    return _get_session_csv_files(output_dir, task_id, "avg_balance")
 
 
 def get_session_lob_frames_csv_files(output_dir: str, task_id: str) -> List[Tuple[str, int]]:
-    return _get_session_csv_files(output_dir, task_id, "_LOB_frames.csv")
+    return _get_session_csv_files(output_dir, task_id, "lob_frames")
 
 
 def get_session_strategies_csv_files(output_dir: str, task_id: str) -> List[Tuple[str, int]]:
-    return _get_session_csv_files(output_dir, task_id, "_strats.csv")
+    return _get_session_csv_files(output_dir, task_id, "strats")
+
+
+# Existing output files of a session, keyed by the names in SESSION_OUTPUT_SUFFIXES
+# A compressed file is found by its extension
+def get_session_output_files(output_dir: str, session_id: str) -> Dict[str, str]:
+    result = {}
+    for name, suffix in SESSION_OUTPUT_SUFFIXES.items():
+        for ext in ("",) + tuple(COMPRESSION_OPENERS):
+            f_path = os.path.join(output_dir, f"{session_id}{suffix}{ext}")
+            if os.path.isfile(f_path):
+                result[name] = f_path
+                break
+    return result
+
+
+# Stats of a session, see 'BSESessionStats'
+def get_session_stats_path(output_dir: str, session_id: str) -> str:
+    return os.path.join(output_dir, f"{session_id}{SESSION_OUTPUT_SUFFIXES['stats']}")
+
+
+# Checkpoint of a running session, deleted by 'market_session' when the session ends, so it is not an output
+def get_session_checkpoint_path(output_dir: str, session_id: str) -> str:
+    return os.path.join(output_dir, f"{session_id}{SESSION_CHECKPOINT_SUFFIX}")
+
+
+# Checkpoints left by sessions of a task which didn't end
+def remove_task_checkpoints(output_dir: str, task_id: str):
+    if not os.path.isdir(output_dir):
+        return
+    for f_name in os.listdir(output_dir):
+        if f_name.startswith(f"{task_id}_S") and f_name.endswith(SESSION_CHECKPOINT_SUFFIX):
+            os.remove(os.path.join(output_dir, f_name))
+
+
+# Session id of an avg_balance file of a session
+# Also compressed ones, the avg_balance file of a session is published last,
+# as resume, progress and combining regard a session with it as finished
+def is_avg_balance_file(file_path: str) -> bool:
+    ext = get_compression_extension(file_path)
+    return file_path[:len(file_path) - len(ext)].endswith(SESSION_OUTPUT_SUFFIXES["avg_balance"])
+
+
+def get_avg_balance_session_id(csv_path: str) -> str:
+    return os.path.basename(csv_path)[:-len(SESSION_OUTPUT_SUFFIXES["avg_balance"])]
 
 
 def combine_session_avg_balance_csv_files(output_dir: str, task_id: str) -> str:
     avg_balance_files = get_session_avg_balance_csv_files(output_dir, task_id)
     avg_balance_files = sorted(avg_balance_files, key=lambda x: x[1])
-    dump_file_path = os.path.join(output_dir, f"{task_id}_avg_balance.csv")
-    with open(dump_file_path, mode="wb") as f_in:
-        for f_name, _ in avg_balance_files:
-            with open(os.path.join(output_dir, f_name), mode="rb") as f_out:
-                f_in.write(f_out.read())
-    return dump_file_path
+    session_files = [os.path.join(output_dir, f_name) for f_name, _ in avg_balance_files]
+    combiner = AvgBalanceCombiner(output_dir, task_id, session_files)
+    for f_path in session_files:
+        combiner.finish(f_path)
+    return combiner.close()
+
+
+# Append the whole file to the end of 'dst_fd' inside the kernel, without reading it into memory
+def _append_file(src_path: str, dst_fd: int):
+    with open(src_path, mode="rb") as f_src:
+        src_fd = f_src.fileno()
+        size = os.fstat(src_fd).st_size
+        copied = 0
+        try:
+            copy_func = os.copy_file_range if hasattr(os, "copy_file_range") else None
+            while copied < size:
+                if copy_func is not None:
+                    n = copy_func(src_fd, dst_fd, size - copied)
+                else:
+                    n = os.sendfile(dst_fd, src_fd, copied, size - copied)
+                if n == 0:
+                    break
+                copied += n
+        except (AttributeError, OSError):
+            # Not supported by the platform or the file system, copy the rest in user space
+            f_src.seek(copied)
+            with open(dst_fd, mode="ab", closefd=False) as f_dst:
+                shutil.copyfileobj(f_src, f_dst)
+
+
+# Combine the avg_balance files of sessions in the order of 'session_files' while the sessions finish
+# A session file is appended as soon as all sessions before it are finished
+# The column files of 'AvgBalanceColumnWriter' are combined in the same way if they exist
+# With 'delete_session_files', each file is deleted after appended, then the sessions can't be resumed
+# The combined file is only open from the first appended session until the last one, so many tasks can be combined
+# at once without running out of file descriptors
+class AvgBalanceCombiner:
+
+    def __init__(self, output_dir: str, task_id: str, session_files: List[str], delete_session_files: bool = False):
+        # Imported here, as 'columns' depends on this module
+        from .columns import AvgBalanceColumnAppender, get_avg_balance_columns_dir
+        self.file_path: str = os.path.join(output_dir, f"{task_id}_avg_balance.csv")
+        self.session_files: List[str] = session_files
+        self.delete_session_files: bool = delete_session_files
+        self._finished: set = set()
+        self._skipped: set = set()
+        self._next: int = 0
+        self._fd: Optional[int] = None
+        self._closed: bool = False
+        self._column_appender = AvgBalanceColumnAppender(get_avg_balance_columns_dir(output_dir, task_id))
+
+    # A failed session is also finished, its file is appended if it exists
+    def finish(self, session_file: str):
+        self._finished.add(session_file)
+        while self._next < len(self.session_files) and self.session_files[self._next] in self._finished:
+            f_path = self.session_files[self._next]
+            if f_path not in self._skipped and os.path.isfile(f_path):
+                _append_file(f_path, self._open())
+                if self.delete_session_files:
+                    os.remove(f_path)
+            self._column_appender.append(f"{f_path[:-len('.csv')]}_columns", self.delete_session_files)
+            self._next += 1
+        if self._next == len(self.session_files):
+            self.close()
+
+    # A session which is not run, e.g. after stopping early, an old file of it is not appended
+    def skip(self, session_file: str):
+        self._skipped.add(session_file)
+        self.finish(session_file)
+
+    def _open(self) -> int:
+        if self._fd is None:
+            self._fd = os.open(self.file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        return self._fd
+
+    def is_closed(self) -> bool:
+        return self._closed
+
+    # The combined file is created even if no session file was appended
+    def close(self) -> str:
+        if not self._closed:
+            self._closed = True
+            os.close(self._open())
+            self._fd = None
+            self._column_appender.close()
+        return self.file_path
+
+
+# Move a file or dir into 'dst_path', readers of the destination see either nothing or the complete output
+# Across file systems it is copied to a hidden temp name next to the destination first, then renamed
+def _move_output(src_path: str, dst_path: str):
+    # A dir, e.g. avg_balance columns, can only replace an empty dir
+    if os.path.isdir(dst_path):
+        shutil.rmtree(dst_path)
+    try:
+        os.replace(src_path, dst_path)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    temp_path = os.path.join(os.path.dirname(dst_path), f".{os.path.basename(dst_path)}.tmp")
+    if os.path.isdir(src_path):
+        if os.path.isdir(temp_path):
+            shutil.rmtree(temp_path)
+        shutil.copytree(src_path, temp_path)
+    else:
+        shutil.copyfile(src_path, temp_path)
+    os.replace(temp_path, dst_path)
+
+
+# Publish the outputs of a finished session from its staging dir into the output dir
+# The avg_balance file is moved last, so once it is visible all other outputs of the session are there too
+def publish_staged_outputs(staging_dir: str, output_dir: str):
+    f_names = sorted(os.listdir(staging_dir), key=is_avg_balance_file)
+    for f_name in f_names:
+        _move_output(os.path.join(staging_dir, f_name), os.path.join(output_dir, f_name))
+    shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+# Dir for the outputs of one session, in 'scratch_dir' if given, e.g. '/dev/shm' or a local disk
+# When the session is complete its outputs are published into 'output_dir', see 'publish_staged_outputs'
+# A failed session leaves nothing in 'output_dir'
+@contextlib.contextmanager
+def stage_session_outputs(output_dir: str, scratch_dir: Optional[str], session_id: str):
+    if scratch_dir is None:
+        yield output_dir
+        return
+    if not os.path.isdir(scratch_dir):
+        os.makedirs(scratch_dir)
+    staging_dir = tempfile.mkdtemp(prefix=f"{session_id}.", dir=scratch_dir)
+    try:
+        yield staging_dir
+        publish_staged_outputs(staging_dir, output_dir)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
 
 
 def tail_file(file_path: str, n: int, encoding: Optional[str] = None) -> str:
+    if get_compression_extension(file_path) != "":
+        # Compressed files can't be read backwards
+        with open_output_file(file_path) as f:
+            lines = collections.deque(f, maxlen=n + 1)
+        # Same as below, an incomplete last line comes with n complete lines before it
+        if len(lines) > n and lines[-1].endswith("\n"):
+            lines.popleft()
+        return "".join(lines)
     f_size = os.path.getsize(file_path)
     if f_size == 0:
         return ""
@@ -81,3 +360,59 @@ def tail_file(file_path: str, n: int, encoding: Optional[str] = None) -> str:
             return buffer_bytes.decode()
         else:
             return buffer_bytes.decode(encoding=encoding)
+
+
+# Parse one 'trade_stats' row: session_id, time, best bid, best ask, then (type, sum, n, avg) for each trader type
+def parse_avg_balance_line(line: str) -> Optional[dict]:
+    cols = [i.strip() for i in line.strip().split(",")]
+    if len(cols) > 0 and cols[-1] == "":
+        cols = cols[:-1]
+    if len(cols) < 4 or (len(cols) - 4) % 4 != 0:
+        return None
+    try:
+        traders = {}
+        for i in range(4, len(cols), 4):
+            traders[cols[i]] = {
+                "balance_sum": int(cols[i + 1]),
+                "n": int(cols[i + 2]),
+                "avg_balance": float(cols[i + 3])
+            }
+        return {
+            "session_id": cols[0],
+            "time": int(cols[1]),
+            "best_bid": None if cols[2] == "None" else int(cols[2]),
+            "best_ask": None if cols[3] == "None" else int(cols[3]),
+            "traders": traders
+        }
+    except ValueError:
+        return None
+
+
+def read_last_avg_balance_row(csv_path: str) -> Optional[dict]:
+    if not os.path.isfile(csv_path):
+        return None
+    return parse_avg_balance_line(tail_file(csv_path, 1, encoding="utf-8"))
+
+
+# Group the complete rows of an avg_balance file by session id, a row is complete when it ends with a line break
+def read_avg_balance_csv_sessions(csv_path: str) -> Dict[str, List[str]]:
+    result = {}
+    if not os.path.isfile(csv_path):
+        return result
+    with open_output_file(csv_path) as f:
+        for line in f:
+            if line.endswith("\n") and "," in line:
+                session_id = line[:line.index(",")]
+                if session_id in result:
+                    result[session_id].append(line)
+                else:
+                    result[session_id] = [line]
+    return result
+
+
+# The last row of a finished session is the end-of-session summary written after 'endtime'
+def is_avg_balance_session_finished(rows: List[str], end_time: Union[int, float]) -> bool:
+    if len(rows) == 0:
+        return False
+    row = parse_avg_balance_line(rows[-1])
+    return row is not None and row["time"] >= int(end_time)
@@ -1,4 +1,5 @@
 import os
+import hashlib
 import traceback
 from typing import Optional
 
@@ -10,8 +11,27 @@ def raise_process_error(ex):
         raise ex
 
 
-def get_default_worker_size(min_size: int, setup_workers: Optional[int]) -> int:
+def get_default_worker_size(min_size: int, setup_workers: Optional[int], cpu_count: Optional[int] = None) -> int:
     if setup_workers is None:
-        return max(1, min(min_size, os.cpu_count() - 1))
+        if cpu_count is None:
+            cpu_count = os.cpu_count()
+        return max(1, min(min_size, cpu_count - 1))
     else:
         return setup_workers
+
+
+# Derive an independent seed for each session, so a session can be reproduced without running the sessions before it
+def get_session_seed(seed: Optional[int], session_index: int) -> Optional[int]:
+    if seed is None:
+        return None
+    digest = hashlib.sha256(f"{seed}:{session_index}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], byteorder="big")
+
+
+# Seed of the customer orders of a session, independent of the task, so tasks launched with the same seed
+# get the same customer orders in their sessions with the same index
+def get_session_order_seed(seed: Optional[int], session_index: int) -> Optional[int]:
+    if seed is None:
+        return None
+    digest = hashlib.sha256(f"{seed}:{session_index}:orders".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], byteorder="big")
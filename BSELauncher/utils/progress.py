@@ -2,9 +2,9 @@ import os
 import sys
 import time
 import json
-from typing import Optional, Dict, Union, Iterable
+from typing import Optional, Dict, Union, Iterable, List
 
-from .files import _generate_task_config_files, tail_file, _all_file_exists
+from .files import _generate_task_config_files, tail_file, _all_file_exists, read_task_manifest
 
 try:
     from tqdm import tqdm
@@ -28,13 +28,31 @@ def _get_avg_balance_progress(csv_path: str) -> Optional[int]:
     return 0
 
 
+# avg_balance files of the sessions listed in the manifests of tasks, their progress is the end time
+def _get_finished_avg_balance_files(task_configs: Iterable[dict]) -> Dict[str, int]:
+    result = {}
+    for config in task_configs:
+        manifest = read_task_manifest(config["output_dir"], config["task_id"])
+        if manifest is None:
+            continue
+        for session in manifest.values():
+            if "avg_balance" in session["outputs"]:
+                f_path = os.path.join(config["output_dir"], session["outputs"]["avg_balance"])
+                result[os.path.normpath(f_path)] = config["market_params"]["endtime"]
+    return result
+
+
 def _get_all_avg_balance_progress(
         avg_balance_csv_files: Iterable[str],
-        last_status: Optional[Dict[str, int]] = None
+        last_status: Optional[Dict[str, int]] = None,
+        finished_files: Optional[Dict[str, int]] = None
 ) -> Dict[str, int]:
     result = {}
     path_list = [p for p in avg_balance_csv_files if os.path.isfile(p)]
     for f_path in path_list:
+        if finished_files is not None and os.path.normpath(f_path) in finished_files:
+            result[f_path] = finished_files[os.path.normpath(f_path)]
+            continue
         progress = _get_avg_balance_progress(f_path)
         if progress is None:
             if last_status is not None and f_path in last_status:
@@ -46,14 +64,20 @@ def _get_all_avg_balance_progress(
     return result
 
 
+# With 'task_configs', files of finished sessions are found in the manifests and not read again
 def show_seconds_progress_by_avg_balance(
         avg_balance_csv_files: Union[str, Iterable[str]],
         total_seconds: int,
-        refresh_seconds: float = 1.0
+        refresh_seconds: float = 1.0,
+        task_configs: Optional[List[dict]] = None
 ):
     if isinstance(avg_balance_csv_files, str):
         avg_balance_csv_files = [avg_balance_csv_files]
-    last_progress = _get_all_avg_balance_progress(avg_balance_csv_files)
+
+    def _get_finished_files() -> Optional[Dict[str, int]]:
+        return None if task_configs is None else _get_finished_avg_balance_files(task_configs)
+
+    last_progress = _get_all_avg_balance_progress(avg_balance_csv_files, finished_files=_get_finished_files())
     last_num = sum(last_progress.values())
 
     with tqdm(initial=last_num, total=total_seconds) as pbar:
@@ -61,7 +85,9 @@ def show_seconds_progress_by_avg_balance(
             while last_num < total_seconds:
                 time.sleep(refresh_seconds)
 
-                current_progress = _get_all_avg_balance_progress(avg_balance_csv_files, last_progress)
+                current_progress = _get_all_avg_balance_progress(
+                    avg_balance_csv_files, last_progress, _get_finished_files()
+                )
                 current_num = sum(current_progress.values())
 
                 pbar.update(current_num - last_num)
@@ -84,6 +110,7 @@ def show_seconds_progress_by_config(
         while not _all_file_exists(task_config):
             time.sleep(refresh_seconds)
 
+    configs = []
     avg_balance_csv_files = []
     session_nums = 0
     end_times = 0
@@ -91,6 +118,7 @@ def show_seconds_progress_by_config(
     for config_path in task_config:
         with open(config_path, "r", encoding="utf-8") as f:
             config = json.load(f)
+        configs.append(config)
         session_nums += config["session_num"]
         end_times += config["market_params"]["endtime"]
         avg_balance_csv_files += config["dump_avg_balance"]
@@ -98,21 +126,24 @@ def show_seconds_progress_by_config(
     show_seconds_progress_by_avg_balance(
         avg_balance_csv_files,
         session_nums * end_times * task_nums,
-        refresh_seconds
+        refresh_seconds,
+        configs
     )
 
 
+# 'task_subdir' is the same as 'BSEMarketTask'
 def show_seconds_progress(
         output_dir: str,
         task_id: Union[str, Iterable[str]],
         wait_all_configs: bool = False,
-        refresh_seconds: float = 1.0
+        refresh_seconds: float = 1.0,
+        task_subdir: bool = False
 ):
     if wait_all_configs and not os.path.isdir(output_dir):
         print("Waiting for output dir ...")
         while not os.path.isdir(output_dir):
             time.sleep(refresh_seconds)
-    task_configs = _generate_task_config_files(output_dir, task_id)
+    task_configs = _generate_task_config_files(output_dir, task_id, task_subdir)
     show_seconds_progress_by_config(
         task_config=task_configs,
         wait_all_configs=wait_all_configs,
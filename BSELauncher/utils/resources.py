@@ -0,0 +1,143 @@
+import os
+import sys
+import math
+import time
+from typing import Optional, List
+
+from .affinity import get_allowed_cpus
+
+try:
+    import resource
+except ModuleNotFoundError:
+    # Not available on Windows
+    resource = None
+
+_PROC_MEMINFO = "/proc/meminfo"
+_PROC_VMSTAT = "/proc/vmstat"
+_CGROUP_CPU_MAX = "/sys/fs/cgroup/cpu.max"
+
+
+# Peak RSS of this process in bytes, None if unknown
+# NB: it is the peak over the whole lifetime of the process, so a reused pool worker reports its largest session
+def get_peak_rss() -> Optional[int]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes on Linux
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+# MemAvailable in bytes, None if unknown
+def get_available_memory() -> Optional[int]:
+    try:
+        with open(_PROC_MEMINFO, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def get_load_average() -> Optional[float]:
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+
+
+# Total pages swapped in and out since boot, None if unknown
+def get_swapped_pages() -> Optional[int]:
+    try:
+        result = 0
+        with open(_PROC_VMSTAT, "r", encoding="utf-8") as f:
+            for line in f:
+                name, value = line.split()
+                if name in ("pswpin", "pswpout"):
+                    result += int(value)
+        return result
+    except (OSError, ValueError):
+        return None
+
+
+# CPUs this process may use: its affinity, limited by the CPU quota of its cgroup (v2)
+def get_available_cpu_count() -> int:
+    result = len(get_allowed_cpus())
+    try:
+        with open(_CGROUP_CPU_MAX, "r", encoding="utf-8") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            result = min(result, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    return max(1, result)
+
+
+# Amount of sessions allowed to run at the same time, at most 'max_workers'
+# Only 'sample_sessions' sessions run until their peak RSS is measured, then the limit fits into
+# 'memory_fraction' of the available memory and the CPUs which are not used by other jobs
+# 'cpus' is the amount of CPUs the sessions may use, e.g. of the CPUs the workers are pinned to,
+# by default 'get_available_cpu_count'
+# No new session is allowed while the system is swapping
+class AdaptiveWorkerSize:
+
+    def __init__(
+            self,
+            max_workers: int,
+            sample_sessions: int = 3,
+            memory_fraction: float = 0.8,
+            refresh_seconds: float = 1.0,
+            cpus: Optional[int] = None
+    ):
+        self.max_workers: int = max_workers
+        self.sample_sessions: int = sample_sessions
+        self.memory_fraction: float = memory_fraction
+        self.refresh_seconds: float = refresh_seconds
+        self.cpus: int = get_available_cpu_count() if cpus is None else cpus
+        self._peak_rss: List[int] = []
+        self._swapped_pages: Optional[int] = get_swapped_pages()
+        self._refresh_time: Optional[float] = None
+        self._limit: int = max(1, min(max_workers, sample_sessions))
+
+    def add_peak_rss(self, peak_rss: Optional[int]):
+        if peak_rss is not None:
+            self._peak_rss.append(peak_rss)
+
+    def _get_memory_limit(self, running: int) -> int:
+        available = get_available_memory()
+        if available is None:
+            return self.max_workers
+        # Memory of running sessions is already excluded from MemAvailable
+        return running + int(available * self.memory_fraction) // max(self._peak_rss)
+
+    def _get_load_limit(self, running: int) -> int:
+        load = get_load_average()
+        if load is None:
+            return self.max_workers
+        other_load = max(0.0, load - running)
+        return self.cpus - int(round(other_load))
+
+    def _is_swapping(self) -> bool:
+        swapped_pages = get_swapped_pages()
+        if swapped_pages is None or self._swapped_pages is None:
+            return False
+        is_swapping = swapped_pages > self._swapped_pages
+        self._swapped_pages = swapped_pages
+        return is_swapping
+
+    def _refresh(self, running: int):
+        if len(self._peak_rss) < self.sample_sessions:
+            limit = min(self.max_workers, self.sample_sessions)
+        else:
+            limit = min(self.max_workers, self._get_memory_limit(running), self._get_load_limit(running))
+        if self._is_swapping():
+            limit = min(limit, running)
+        self._limit = max(1, limit)
+
+    # 'running' is the amount of sessions running now
+    def get_worker_size(self, running: int) -> int:
+        now = time.monotonic()
+        if self._refresh_time is None or now - self._refresh_time >= self.refresh_seconds:
+            self._refresh_time = now
+            self._refresh(running)
+        return self._limit
@@ -0,0 +1,69 @@
+import os
+import time
+import shutil
+
+from BSELauncher import *
+from BSE import market_session
+
+TASK_ID = "Bench"
+OUTPUT_DIR = "benchmark_outputs"
+SESSIONS_AMOUNT = 30
+START_TIME = 0
+END_TIME = 60 * 10
+TASKS_SIZE = 2
+SEED = 1
+
+# (name, options of 'launch_tasks_sessions_in_parallel')
+MODES = [
+    ("Unpinned", {}),
+    ("Pinned", {"cpu_affinity": True}),
+    ("Pinned physical cores", {"cpu_affinity": True, "physical_cores_only": True}),
+]
+
+if __name__ == '__main__':
+    trader_spec = [
+        TraderSpec(Trader.ZIP, 10),
+        TraderSpec(Trader.ZIC, 10),
+        TraderSpec(Trader.SHVR, 10),
+        TraderSpec(Trader.GVWY, 10)
+    ]
+    order_spec = [
+        OrderStrategy(
+            time=(START_TIME, END_TIME),
+            ranges=[PriceStrategy(180, 200)],
+            step_mode=StepMode.RANDOM
+        )
+    ]
+    market_spec = MarketSessionSpec(
+        session_time=(START_TIME, END_TIME),
+        sellers=trader_spec,
+        buyers=trader_spec,
+        orders_spec=OrderSpec(
+            supply=order_spec,
+            demand=order_spec,
+            interval=5,
+            time_mode=TimeMode.DRIP_POISSON
+        )
+    )
+
+    results = []
+    for name, options in MODES:
+        if os.path.exists(OUTPUT_DIR):
+            shutil.rmtree(OUTPUT_DIR)
+        tasks = [
+            BSEMarketTask(f"{TASK_ID}_{i}", market_spec, OUTPUT_DIR)
+            for i in range(0, TASKS_SIZE)
+        ]
+        start = time.perf_counter()
+        launch_tasks_sessions_in_parallel(
+            market_session,
+            *tasks,
+            session_num=SESSIONS_AMOUNT,
+            seed=SEED,
+            **options
+        )
+        results.append((name, time.perf_counter() - start))
+
+    shutil.rmtree(OUTPUT_DIR)
+    for name, seconds in results:
+        print(f"{name}: {seconds:.2f}s")
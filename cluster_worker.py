@@ -0,0 +1,16 @@
+import sys
+
+from BSELauncher import run_cluster_worker
+from BSE import market_session
+
+COORDINATOR_HOST = "127.0.0.1"
+COORDINATOR_PORT = 50000
+AUTHKEY = b"BSELauncher"
+
+if __name__ == '__main__':
+    host = sys.argv[1] if len(sys.argv) > 1 else COORDINATOR_HOST
+    run_cluster_worker(
+        market_session,
+        address=(host, COORDINATOR_PORT),
+        authkey=AUTHKEY
+    )